@@ -337,7 +337,7 @@ def locToTilt(locs, convention="latitude*0.76", **k):
 
     return tilt
 
-def _presim(locs, source, elev=300, module="WINAICO WSx-240P6", azimuth=180, tilt="ninja", totalSystemCapacity=None, tracking="fixed", modulesPerString=1, inverter=None, stringsPerInverter=1, rackingModel='open_rack_cell_glassback', airmassModel='kastenyoung1989', transpositionModel='perez', cellTempModel="sandia", generationModel="single-diode", inverterModel="sandia", interpolation="bilinear", loss=0.18, trackingGCR=2/7, trackingMaxAngle=60, frankCorrection=False, ghiScaling=None):
+def _presim(locs, source, elev=300, module="WINAICO WSx-240P6", azimuth=180, tilt="ninja", totalSystemCapacity=None, tracking="fixed", modulesPerString=1, inverter=None, stringsPerInverter=1, rackingModel='open_rack_cell_glassback', airmassModel='kastenyoung1989', transpositionModel='perez', cellTempModel="sandia", generationModel="single-diode", inverterModel="sandia", interpolation="bilinear", loss=0.18, trackingGCR=2/7, trackingMaxAngle=60, frankCorrection=False, ghiScaling=None, _indicies=None):
 
     ### Check a few inputs so it doesn't need to be done repeatedly
     if cellTempModel.lower() == "sandia": sandiaCellTemp = True
@@ -363,10 +363,14 @@ def _presim(locs, source, elev=300, module="WINAICO WSx-240P6", azimuth=180, til
     if isinstance(source, NCSource):
         times = source.timeindex
 
-        idx = source.loc2Index(locs, asInt=False)
-        k = dict( locations=locs, interpolation=interpolation, forceDataFrame=True, _indicies=idx )
+        idx = source.loc2IndexSet(locs) if _indicies is None else _indicies
 
-        ghi = source.get("ghi", **k)
+        # Extract all available variables in one pass
+        variables = ["ghi", "windspeed", "pressure", "air_temp"]
+        variables.extend([v for v in ["dhi", "dni", "dew_temp", "albedo"] if v in source.data])
+        weather = source.get_many(variables, locations=locs, interpolation=interpolation, _indicies=idx)
+
+        ghi = weather["ghi"]
         if ghiScaling:
             merraAvg = gk.raster.interpolateValues( source.LONG_RUN_AVERAGE_GHI_SOURCE, locs, mode="linear-spline" )*24/1000 # make into kW/m2/day
             worldBankAvg = gk.raster.interpolateValues( ghiScaling, locs )
@@ -378,17 +382,14 @@ def _presim(locs, source, elev=300, module="WINAICO WSx-240P6", azimuth=180, til
             #print("SCALING GHI", scaling.mean())
 
             ghi *= scaling
-        dhi = source.get("dhi", **k) if "dhi" in source.data else None
-        dni = source.get("dni", **k) if "dni" in source.data else None
-
-        windspeed = source.get("windspeed", **k)
-        pressure = source.get("pressure", **k)
-        air_temp = source.get("air_temp", **k)
-        if "dew_temp" in source.data: dew_temp = source.get("dew_temp", **k)
-        else: dew_temp = None
-
-        if "albedo" in source.data: albedo = source.get("albedo", **k)
-        else: albedo = 0.2
+        dhi = weather.get("dhi", None)
+        dni = weather.get("dni", None)
+
+        windspeed = weather["windspeed"]
+        pressure = weather["pressure"]
+        air_temp = weather["air_temp"]
+        dew_temp = weather.get("dew_temp", None)
+        albedo = weather.get("albedo", 0.2)
 
     else: # source should be a dictionary
         times = source["times"]
@@ -1,15 +1,49 @@
 from reskit.util.util_ import *
 from ._pv import *
-from reskit.weather.sources import MerraSource, CosmoSource
+from reskit.weather.sources import MerraSource, CosmoSource, WeatherServer
 from reskit.weather.windutil import *
 import warnings
 
+def _load_source(source, placements, cosmoSource, verbose, globalStart, gid, extractionCache=None):
+    """Opens the weather source around the given placements and loads the PV variables, returning the source and 
+    whether the frank correction should be applied
+    
+    * If the source is the address of a weather server, the served source is used as it is
+    * With an extraction cache, variables are loaded lazily, so that placements found in the cache are never read"""
+    if WeatherServer.isAddress(source):
+        return WeatherServer.connect(source), cosmoSource
+
+    cacheKwargs = dict(lazy=True, extractionCache=extractionCache) if extractionCache else dict()
+    if cosmoSource: 
+        source = CosmoSource(source, bounds=placements, indexPad=2, **cacheKwargs)
+        frankCorrection=True
+
+    else: 
+        source = MerraSource(source, bounds=placements, indexPad=2, verbose=verbose, **cacheKwargs)
+        frankCorrection=False
+    source.loadSet_PV(verbose=verbose, _clockstart=globalStart, _header=" %s:"%str(gid))
+
+    return source, frankCorrection
+
+def _tile_placements(source, placements, cosmoSource, memoryBudget, verbose):
+    """Splits placements into tiles of the weather grid, so that the weather data which _load_source() loads for any 
+    one tile fits within the memory budget"""
+    if cosmoSource: grid = CosmoSource(source, verbose=False)
+    else: grid = MerraSource(source, verbose=False)
+
+    # The COSMO PV set holds six variables, as well as the one which is derived from them, while the MERRA PV set 
+    # streams the wind speed from its components and holds five variables
+    tiles = grid.tileLocations(placements, memoryBudget, variables=7 if cosmoSource else 5, indexPad=2)
+    if verbose: print("Split placements into %d tiles"%len(tiles))
+
+    return tiles
+
 def _batch_simulator(cosmoSource, source, loss, verbose, module, globalStart, extract, 
                      tracking, interpolation, cellTempModel, 
                      rackingModel, airmassModel, transpositionModel, 
                      generationModel, placements, capacity, tilt, azimuth, 
                      elev, locationID, gid, batchSize, trackingGCR, 
-                     trackingMaxAngle, output, **k):
+                     trackingMaxAngle, output, sharedFromPath=False, extractionCache=None, **k):
     if verbose: 
         startTime = dt.now()
         globalStart = globalStart
@@ -21,16 +55,9 @@ def _batch_simulator(cosmoSource, source, loss, verbose, module, globalStart, ex
 
     ### Open Source and load weather data
     if isinstance(source, str):
-        if cosmoSource: 
-            source = CosmoSource(source, bounds=placements, indexPad=2)
-            frankCorrection=True
-    
-        else: 
-            source = MerraSource(source, bounds=placements, indexPad=2, verbose=verbose)
-            frankCorrection=False
-        source.loadSet_PV(verbose=verbose, _clockstart=globalStart, _header=" %s:"%str(gid))
+        source, frankCorrection = _load_source(source, placements, cosmoSource, verbose, globalStart, gid, extractionCache)
     else:
-        frankCorrection=False
+        frankCorrection = cosmoSource and sharedFromPath
     # do simulations
     result = []
     if batchSize is None: batchSize = 1e10
@@ -112,7 +139,7 @@ def _batch_simulator(cosmoSource, source, loss, verbose, module, globalStart, ex
 
 ##################################################################
 ## Distributed PV production from a weather source
-def PVWorkflowTemplate( placements, source, elev, ghiScaling, module, azimuth, tilt, extract, output, jobs, batchSize, verbose, capacity, tracking, loss, interpolation, rackingModel, airmassModel, transpositionModel, cellTempModel, generationModel, trackingMaxAngle, trackingGCR, cosmoSource, **k):
+def PVWorkflowTemplate( placements, source, elev, ghiScaling, module, azimuth, tilt, extract, output, jobs, batchSize, verbose, capacity, tracking, loss, interpolation, rackingModel, airmassModel, transpositionModel, cellTempModel, generationModel, trackingMaxAngle, trackingGCR, cosmoSource, memoryBudget=None, extractionCache=None, **k):
 
     startTime = dt.now()
     if verbose: 
@@ -176,60 +203,84 @@ def PVWorkflowTemplate( placements, source, elev, ghiScaling, module, azimuth, t
                      rackingModel=rackingModel, airmassModel=airmassModel,
                      transpositionModel=transpositionModel, trackingGCR=trackingGCR, 
                      generationModel=generationModel, trackingMaxAngle=trackingMaxAngle,
-                     output=output, cosmoSource=cosmoSource, **k
+                     output=output, cosmoSource=cosmoSource, extractionCache=extractionCache, **k
                     )
 
+    def groupKwargs(gid, grp, batchSize):
+        kwargs = simKwargs.copy()
+        kwargs["placements"] = grp
+        kwargs["capacity"] = capacity[grp[:]].values
+        kwargs["tilt"] = tilt if isinstance(tilt, str) else tilt[grp[:]].values
+        kwargs["azimuth"] = azimuth[grp[:]].values
+        kwargs["elev"] = elev if isinstance(elev, str) else elev[grp[:]].values
+        kwargs["locationID"] = locationID[grp[:]].values
+        kwargs["gid"] = gid
+        kwargs["batchSize"] = batchSize
+        return kwargs
+
+    # Split placements into tiles which each load no more than their share of the memory budget
+    tiles = None
+    if not memoryBudget is None and isinstance(source, str) and not WeatherServer.isAddress(source):
+        if verbose: print("Tiling placements at +%.2fs"%((dt.now()-startTime).total_seconds()))
+        tiles = _tile_placements(source, placements, cosmoSource, memoryBudget/jobs, verbose)
+
     if batchSize is None: batchSize = 1e10
     if useMulti:
+        if tiles is None:
+            # Load the weather data for all placements once, and share it with the workers
+            if verbose: print("Sharing weather data at +%.2fs"%((dt.now()-startTime).total_seconds()))
+            if isinstance(source, str):
+                sharedSource, _ = _load_source(source, placements, cosmoSource, verbose, startTime, "shared", extractionCache)
+                simKwargs["sharedFromPath"] = True
+            else:
+                sharedSource = source
+            simKwargs["source"] = sharedSource.toSharedMemory()
+
         from multiprocessing import Pool
         pool = Pool(jobs)
         placements.makePickleable()
         res = []
 
         # Split locations into groups
-        groups = []
-        for grp in placements.splitKMeans(jobs):
-            if grp.count > (batchSize/jobs)*3: # Should the batch be broken into smaller groupings?
-                subgroups = int(np.round(grp.count/(3*batchSize/jobs)))
-                for sgi in range(int(subgroups)):
-                    groups.append( gk.LocationSet(grp[sgi::subgroups]) )
-            else:
-                groups.append( grp )
+        if tiles is None:
+            groups = []
+            for grp in placements.splitKMeans(jobs):
+                if grp.count > (batchSize/jobs)*3: # Should the batch be broken into smaller groupings?
+                    subgroups = int(np.round(grp.count/(3*batchSize/jobs)))
+                    for sgi in range(int(subgroups)):
+                        groups.append( gk.LocationSet(grp[sgi::subgroups]) )
+                else:
+                    groups.append( grp )
+        else: # each worker loads its own tile
+            groups = tiles
+            for grp in groups: grp.makePickleable()
 
         # Submit groups
         if verbose: print("Submitting %d simulation groups at +%.2fs"%( len(groups), (dt.now()-startTime).total_seconds()) )
         for i,grp in enumerate(groups):
-            kwargs = simKwargs.copy()
-            kwargs["placements"] = grp
-            kwargs["capacity"] = capacity[grp[:]].values
-            kwargs["tilt"] = tilt if isinstance(tilt, str) else tilt[grp[:]].values
-            kwargs["azimuth"] = azimuth[grp[:]].values
-            kwargs["elev"] = elev if isinstance(elev, str) else elev[grp[:]].values
-            kwargs["locationID"] = locationID[grp[:]].values
-            kwargs["gid"] = i
-            kwargs["batchSize"] = int(np.round(batchSize/jobs))
-            
-            res.append(pool.apply_async(_batch_simulator, (), kwargs))
-
-        finalRes = []
-        for r in res: finalRes.extend(r.get())
-        res = finalRes
-
-        pool.close()
-        pool.join()
-        pool = None
+            res.append(pool.apply_async(_batch_simulator, (), groupKwargs(i, grp, int(np.round(batchSize/jobs)))))
 
-    else:
-        simKwargs["placements"] = placements
-        simKwargs["capacity"] = capacity.values
-        simKwargs["tilt"] = tilt if isinstance(tilt, str) else tilt.values
-        simKwargs["azimuth"] = azimuth.values
-        simKwargs["elev"] = elev if isinstance(elev, str) else elev.values
-        simKwargs["locationID"] = locationID.values
-        simKwargs["gid"] = 0
-        simKwargs["batchSize"] = batchSize
-
-        res = _batch_simulator(**simKwargs)
+        try:
+            finalRes = []
+            for r in res: finalRes.extend(r.get())
+            res = finalRes
+
+            pool.close()
+            pool.join()
+            pool = None
+        finally:
+            # Free the shared data, but give a user's source its data back
+            if tiles is None:
+                sharedSource.releaseSharedMemory(keep=sharedSource is source)
+                sharedSource = None
+
+    elif tiles is None:
+        res = _batch_simulator(**groupKwargs(0, placements, batchSize))
+
+    else: # tiles are loaded and simulated one after the other
+        res = []
+        for i,grp in enumerate(tiles):
+            res.extend(_batch_simulator(**groupKwargs(i, grp, batchSize)))
 
     ## Finalize
     if extract == "capacityFactor": res = pd.concat(res)
@@ -246,11 +297,11 @@ def PVWorkflowTemplate( placements, source, elev, ghiScaling, module, azimuth, t
 
     return res
     
-def workflowOpenFieldFixed(placements, source, elev=300, module="WINAICO WSx-240P6", azimuth=180, tilt="ninja", ghiScaling=None, extract="totalProduction", output=None, jobs=1, batchSize=None, verbose=True, capacity=None, cosmoSource=False, **k):                           
+def workflowOpenFieldFixed(placements, source, elev=300, module="WINAICO WSx-240P6", azimuth=180, tilt="ninja", ghiScaling=None, extract="totalProduction", output=None, jobs=1, batchSize=None, verbose=True, capacity=None, cosmoSource=False, memoryBudget=None, extractionCache=None, **k):                           
     return PVWorkflowTemplate(# Controllable args
                               placements=placements, source=source, elev=elev, module=module, azimuth=azimuth, 
                               tilt=tilt, extract=extract, output=output, cosmoSource=cosmoSource,
-                              jobs=jobs, batchSize=batchSize, verbose=verbose, capacity=capacity,
+                              jobs=jobs, batchSize=batchSize, verbose=verbose, capacity=capacity, memoryBudget=memoryBudget, extractionCache=extractionCache,
 
                               # Set args
                               tracking="fixed",  loss=0.18, interpolation="bilinear", ghiScaling=ghiScaling,
@@ -258,11 +309,11 @@ def workflowOpenFieldFixed(placements, source, elev=300, module="WINAICO WSx-240
                               transpositionModel='perez', cellTempModel="sandia", generationModel="single-diode", 
                               trackingMaxAngle=None, trackingGCR=None, **k)
                          
-def workflowOpenFieldTracking(placements, source, elev=300, module="WINAICO WSx-240P6", azimuth=180, tilt="ninja", ghiScaling=None, extract="totalProduction", output=None, jobs=1, batchSize=None, verbose=True, capacity=None, cosmoSource=False,):
+def workflowOpenFieldTracking(placements, source, elev=300, module="WINAICO WSx-240P6", azimuth=180, tilt="ninja", ghiScaling=None, extract="totalProduction", output=None, jobs=1, batchSize=None, verbose=True, capacity=None, cosmoSource=False, memoryBudget=None, extractionCache=None):
     return PVWorkflowTemplate(# Controllable args
                               placements=placements, source=source, elev=elev, module=module, azimuth=azimuth, 
                               tilt=tilt, extract=extract, output=output, cosmoSource=cosmoSource,
-                              jobs=jobs, batchSize=batchSize, verbose=verbose, capacity=capacity,
+                              jobs=jobs, batchSize=batchSize, verbose=verbose, capacity=capacity, memoryBudget=memoryBudget, extractionCache=extractionCache,
 
                               # Set args
                               tracking="single-axis", trackingMaxAngle=60, loss=0.18, ghiScaling=ghiScaling,
@@ -286,14 +337,7 @@ def workflowRooftop(placements, source, elev=300, module="LG Electronics LG370Q1
             capacity = 1 
 
     if isinstance(source, str):
-        if cosmoSource: 
-            source = CosmoSource(source, bounds=locs, indexPad=2)
-            frankCorrection=True
-    
-        else: 
-            source = MerraSource(source, bounds=locs, indexPad=2, verbose=verbose)
-            frankCorrection=False
-        source.loadSet_PV(verbose=verbose, _clockstart=globalStart, _header=" %s:"%str(0))
+        source, frankCorrection = _load_source(source, locs, cosmoSource, verbose, globalStart, 0)
     else:
         frankCorrection=False
 
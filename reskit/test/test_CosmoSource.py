@@ -1,18 +1,64 @@
+import numpy as np
+import pandas as pd
+from os.path import join, isdir, isfile
+from os import remove
+
+from reskit.weather.sources import CosmoSource, NCSource
+from reskit.weather.synthetic import makeCosmoLike
+from reskit.util import ResError
+
+## Make testing globals
+def makeCosmoSource(directory=join("outputs","synthetic-cosmo-levels")):
+    """Writes a small COSMO-like dataset with all wind speed levels"""
+    if not isdir(directory): 
+        makeCosmoLike(directory, latN=10, lonN=12, byVariable=False, 
+                      variables=["windspeed_10","windspeed_50","windspeed_100","windspeed_140"])
+    return directory
+
 def test___init__():
     # (s, source, bounds=None, indexPad=0, **kwargs):
     print( "__init__ not tested...")
 
 def test_loc2Index():
     # (s, loc, outsideOkay=False, asInt=True):
-    print( "loc2Index not tested...")
+    print("")
+    print("Testing loc2Index...")
+    # A grid which is large enough to hold a smaller window
+    directory = join("outputs","synthetic-cosmo-wide")
+    if not isdir(directory): makeCosmoLike(directory, latN=30, lonN=30, variables=["windspeed_100"])
+    full = CosmoSource(directory, verbose=False)
+    window = CosmoSource(directory, bounds=(full.lons[3,3], full.lats[3,3], full.lons[6,6], full.lats[6,6]), verbose=False)
+    inside, outside = (full.lons[8,8], full.lats[8,8]), (full.lons[28,28], full.lats[28,28])
+    if window._latStop >= 28 or window._lonStop >= 28: raise RuntimeError("  loc2Index: Fail")
+
+    idx = window.loc2Index(inside)
+    if (idx.yi+window._latStart, idx.xi+window._lonStart) != (8,8): raise RuntimeError("  loc2Index: Fail")
+    try:
+        window.loc2Index(outside)
+        raise RuntimeError("  loc2Index: Fail")
+    except ResError: pass
+    if not window.loc2Index(outside, outsideOkay=True) is None: raise RuntimeError("  loc2Index: Fail")
+    print("  loc2Index: Success")
 
 def test_loadRadiation():
     # (s):
     print( "loadRadiation not tested...")
 
 def test_loadWindSpeedLevels():
-    # (s):
-    print( "loadWindSpeedLevels not tested...")
+    # (s, heights=None):
+    print("")
+    print("Testing loadWindSpeedLevels...")
+    for heights, expected in [(None, [10,50,100,140]), ([100,120,135], [100,140]), (80, [50,100]),
+                              ((60,110), [50,100,140]), ([5,20], [10,50]), ([150,160], [100,140])]:
+        source = CosmoSource(makeCosmoSource(), verbose=False)
+        source.loadWindSpeedLevels(heights)
+        if list(source.data) != ["windspeed_%d"%h for h in expected]:
+            raise RuntimeError("  loadWindSpeedLevels: Fail")
+
+        if not heights is None:
+            ws = source.getWindSpeedAtHeights((source.lons[4,5], source.lats[4,5]), np.max(heights))
+            if not np.isfinite(ws.values).all(): raise RuntimeError("  loadWindSpeedLevels: Fail")
+    print("  loadWindSpeedLevels: Success")
 
 def test_loadWindSpeedAtHeight():
     # (s, height=100):
@@ -31,8 +77,61 @@ def test_loadSet_PV():
     print( "loadSet_PV not tested...")
 
 def test_getWindSpeedAtHeights():
-    # (s, locations, heights, spatialInterpolation='near', forceDataFrame=False, outsideOkay=False, _indicies=None):
-    print( "getWindSpeedAtHeights not tested...")
+    # (s, locations, heights, spatialInterpolation='near', verticalInterpolation='linear', forceDataFrame=False, outsideOkay=False, _indicies=None):
+    print("")
+    print("Testing getWindSpeedAtHeights...")
+    source = CosmoSource(makeCosmoSource(), verbose=False)
+    source.loadWindSpeedLevels()
+
+    rs = np.random.RandomState(3)
+    yi, xi = rs.randint(3, 7, 20), rs.randint(3, 8, 20)
+    locs = list(zip(source.lons[yi,xi]+0.01, source.lats[yi,xi]-0.01))
+    heights = rs.uniform(10, 150, 20)
+    heights[:4] = [10, 50, 100, 140]
+
+    for interpolation in ["near", "bilinear", "cubic"]:
+        for vertical in ["linear", "log"]:
+            ws = source.getWindSpeedAtHeights(locs, heights, spatialInterpolation=interpolation, verticalInterpolation=vertical)
+            for i, h in enumerate(heights):
+                lower, upper = (10,50) if h < 50 else ((50,100) if h < 100 else (100,140))
+                if vertical == "linear": fac = (h-lower)/(upper-lower)
+                else: fac = np.log(h/lower)/np.log(upper/lower)
+
+                lo = NCSource.get(source, "windspeed_%d"%lower, locs[i], interpolation=interpolation)
+                up = NCSource.get(source, "windspeed_%d"%upper, locs[i], interpolation=interpolation)
+                if not np.isclose(ws.iloc[:,i], lo*(1-fac)+up*fac, rtol=1e-4).all():
+                    raise RuntimeError("  getWindSpeedAtHeights: Fail")
+
+    # Locations outside the grid are NaN
+    ws = source.getWindSpeedAtHeights(locs[:3]+[(0,0)], 80, spatialInterpolation="bilinear", outsideOkay=True)
+    if not (np.isnan(ws.iloc[:,3]).all() and np.isfinite(ws.iloc[:,:3].values).all()):
+        raise RuntimeError("  getWindSpeedAtHeights: Fail")
+    print("  getWindSpeedAtHeights: Success")
+
+    # A single location gives a Series, unless a DataFrame is forced
+    single = source.getWindSpeedAtHeights(locs[0], 80)
+    forced = source.getWindSpeedAtHeights(locs[0], 80, forceDataFrame=True)
+    if isinstance(single, pd.Series) and isinstance(forced, pd.DataFrame) and np.isclose(single, forced.iloc[:,0]).all():
+        print("  Single location: Success")
+    else: raise RuntimeError("  Single location: Fail")
+
+    # A rerun with an extraction cache does not read any wind speeds
+    cachePath = join("outputs", "cosmo-extraction-cache.sqlite")
+    for ext in ["", "-wal", "-shm"]:
+        if isfile(cachePath+ext): remove(cachePath+ext)
+
+    def fail(yi, xi): raise RuntimeError("  Cached wind speeds: Fail")
+    expected = source.getWindSpeedAtHeights(locs, heights, spatialInterpolation="bilinear")
+    for attempt in range(3):
+        cached = CosmoSource(makeCosmoSource(), verbose=False, lazy=True, extractionCache=cachePath)
+        cached.loadWindSpeedLevels()
+        if attempt == 1: 
+            result = cached.getWindSpeedAtHeights(locs[:5], heights[:5], spatialInterpolation="bilinear") # partly cached
+        if attempt == 2:
+            for data in cached.data.values(): data.take = fail # Everything is cached, so nothing is read
+        result = cached.getWindSpeedAtHeights(locs, heights, spatialInterpolation="bilinear")
+        if not np.isclose(result, expected, rtol=1e-4).all(): raise RuntimeError("  Cached wind speeds: Fail")
+    print("  Cached wind speeds: Success")
 
 
 if __name__ == "__main__":
@@ -44,4 +143,4 @@ if __name__ == "__main__":
     test_loadTemperature()
     test_loadPressure()
     test_loadSet_PV()
-    test_getWindSpeedAtHeights()
\ No newline at end of file
+    test_getWindSpeedAtHeights()
@@ -0,0 +1,890 @@
+import netCDF4 as nc
+import pickle
+import numpy as np
+import pandas as pd
+from os.path import join, basename, isfile, isdir
+from os import remove
+from collections import OrderedDict
+from contextlib import contextmanager
+from importlib import import_module
+from functools import partial
+from glob import glob
+
+from reskit.weather.sources import NCSource, IndexSet, LocationMajorSource, WeatherServer
+from reskit.util import ResError
+
+## Make testing globals
+MERRA = join("data","merra-like.nc4")
+CURVILINEAR = join("outputs","curvilinear-like.nc4")
+
+def makeCurvilinearSource(path=CURVILINEAR, ny=40, nx=50, nt=24):
+    """Writes a small netCDF4 file with 2-dimensional (dependent) lat/lon coordinates"""
+    ds = nc.Dataset(path, "w")
+    ds.createDimension("time", nt)
+    ds.createDimension("rlat", ny)
+    ds.createDimension("rlon", nx)
+
+    timeV = ds.createVariable("time", "f8", ("time",))
+    timeV.units = "hours since 2015-01-01 00:00:00"
+    timeV[:] = np.arange(nt)
+
+    yy, xx = np.meshgrid(np.arange(ny), np.arange(nx), indexing="ij")
+    ds.createVariable("lat", "f8", ("rlat","rlon"))[:] = 45 + 0.1*yy + 0.02*xx
+    ds.createVariable("lon", "f8", ("rlat","rlon"))[:] = 5 + 0.12*xx - 0.015*yy
+    ds.createVariable("windspeed", "f4", ("time","rlat","rlon"))[:] = np.random.RandomState(0).random_sample((nt,ny,nx))*10
+    ds.close()
+
+    return path
+
+def splitMerraSource(directory=join("outputs","merra-split")):
+    """Writes the U50M variable of the MERRA-like file as daily files, and V50M 
+    (without its last time step) as a separate file"""
+    import os
+    if not os.path.isdir(directory): os.mkdir(directory)
+    raw = nc.Dataset(MERRA)
+
+    def write(path, variable, steps):
+        ds = nc.Dataset(path, "w")
+        ds.createDimension("time", None)
+        ds.createDimension("lat", raw["lat"].size)
+        ds.createDimension("lon", raw["lon"].size)
+
+        ds.createVariable("time", "f8", ("time",)).units = raw["time"].units
+        ds["time"][:] = raw["time"][steps]
+        ds.createVariable("lat", "f8", ("lat",))[:] = raw["lat"][:]
+        ds.createVariable("lon", "f8", ("lon",))[:] = raw["lon"][:]
+        ds.createVariable(variable, "f4", ("time","lat","lon"))[:] = raw[variable][steps]
+        ds.close()
+
+    for i,start in enumerate(range(0, raw["time"].size, 24)):
+        write(join(directory, "U50M.%d.nc4"%i), "U50M", np.s_[start:start+24])
+    write(join(directory, "V50M.nc4"), "V50M", np.s_[:-1])
+    
+    raw.close()
+    return directory
+
+def bruteForceIndex(source, lon, lat):
+    """Finds the closest grid cell by checking all cells"""
+    dist = (source.lons-lon)**2 + (source.lats-lat)**2
+    return np.unravel_index(np.argmin(dist), dist.shape)
+
+def getFromSource(source, var, locs):
+    """Extracts data in a worker process"""
+    return source.get(var, locs)
+
+## Make testing scripts
+def test_loc2Index_curvilinear():
+    print("")
+    print("Testing curvilinear index retrieving...")
+    source = NCSource(makeCurvilinearSource(), verbose=False)
+
+    rs = np.random.RandomState(1)
+    locs = list(zip(rs.uniform(5.5, 9, 200), rs.uniform(46, 49, 200)))
+
+    idx = source.loc2Index(locs)
+    for i,(lon,lat) in zip(idx, locs):
+        if tuple(i) != bruteForceIndex(source, lon, lat):
+            raise RuntimeError("  Bulk access: Fail")
+    print("  Bulk access: Success")
+
+    # Fractional indices should stay close to the integer indices
+    idxF = source.loc2Index(locs, asInt=False)
+    if all( abs(f.yi-i.yi)<=0.6 and abs(f.xi-i.xi)<=0.6 for f,i in zip(idxF, idx)): print("  Fractional access: Success")
+    else: raise RuntimeError("  Fractional access: Fail")
+
+    # Locations far from the grid should be caught
+    try:
+        source.loc2Index((20.0, 60.0))
+        caught = False
+    except ResError as e:
+        caught = True
+    if caught and source.loc2Index([(20.0, 60.0), locs[0]], outsideOkay=True)[0] is None: print("  Out of bounds caught: Success")
+    else: raise RuntimeError("  Out of bounds caught: Fail")
+
+def test_loc2Index_axis():
+    print("")
+    print("Testing axis index retrieving...")
+
+    # Non-uniform axis
+    axis = np.array([0, 1, 3, 4, 10.])
+    values = np.random.RandomState(2).uniform(-1, 11, 1000)
+    I, distI = NCSource._locateOnAxis(axis, values)
+
+    if (I == np.argmin(np.abs(values[:,None]-axis), axis=1)).all(): print("  Non-uniform axis: Success")
+    else: raise RuntimeError("  Non-uniform axis: Fail")
+
+    # Descending axis
+    Id, distId = NCSource._locateOnAxis(axis[::-1], values)
+    if (Id == axis.size-1-I).all() and np.isclose(distId, -distI).all(): print("  Descending axis: Success")
+    else: raise RuntimeError("  Descending axis: Fail")
+
+    # Regular MERRA grid
+    source = NCSource(MERRA, verbose=False)
+    idx = source.loc2Index([(6.0, 50.1), (6.6, 50.6), (7.6, 50.8)], outsideOkay=True)
+    if idx[0] == (0,1) and idx[1] == (1,2) and idx[2] is None: print("  Grid access: Success")
+    else: raise RuntimeError("  Grid access: Fail")
+
+def test_IndexSet():
+    print("")
+    print("Testing IndexSet...")
+    source = NCSource(MERRA, verbose=False)
+    source.load("U50M")
+    locs = [(6.0, 50.1), (7.6, 50.8), (6.6, 50.6)]
+
+    idx = source.loc2IndexSet(locs, outsideOkay=True)
+    if isinstance(idx, IndexSet) and (idx.valid == [True, False, True]).all() and idx.fingerprint == source.fingerprint: 
+        print("  Creation: Success")
+    else: raise RuntimeError("  Creation: Fail")
+
+    # Should act like a list of Index tuples
+    legacy = IndexSet.load(list(source.loc2Index(locs, outsideOkay=True)))
+    if (legacy.yi == idx.yi).all() and (legacy.xi == idx.xi).all() and (legacy.valid == idx.valid).all():
+        print("  Legacy conversion: Success")
+    else: raise RuntimeError("  Legacy conversion: Fail")
+
+    # Should survive pickling
+    tmp = pickle.loads(pickle.dumps(idx))
+    if (tmp.yf[tmp.valid] == idx.yf[idx.valid]).all() and tmp.fingerprint == idx.fingerprint: print("  Pickling: Success")
+    else: raise RuntimeError("  Pickling: Fail")
+
+    # Get with precomputed indicies
+    ws = source.get("U50M", locs, outsideOkay=True, _indicies=idx)
+    if np.isclose(ws.iloc[:,0], source.data["U50M"][:,0,1]).all() and ws.iloc[:,1].isnull().all(): 
+        print("  Get from IndexSet: Success")
+    else: raise RuntimeError("  Get from IndexSet: Fail")
+
+def test_get_interpolation():
+    print("")
+    print("Testing interpolated getting...")
+    source = NCSource(MERRA, verbose=False)
+    source.load("U50M")
+    data = source.data["U50M"]
+
+    # A location on a grid node, and one in the middle of four nodes
+    locs = [(6.25, 50.5), (6.5625, 50.75)]
+    ws = source.get("U50M", locs, interpolation="bilinear")
+
+    if np.isclose(ws.iloc[:,0], data[:,1,1]).all(): print("  Bilinear at node: Success")
+    else: raise RuntimeError("  Bilinear at node: Fail")
+
+    if np.isclose(ws.iloc[:,1], data[:,1:3,1:3].mean(axis=(1,2))).all(): print("  Bilinear between nodes: Success")
+    else: raise RuntimeError("  Bilinear between nodes: Fail")
+
+    ws = source.get("U50M", locs, interpolation="cubic")
+    if np.isclose(ws.iloc[:,0], data[:,1,1]).all(): print("  Cubic at node: Success")
+    else: raise RuntimeError("  Cubic at node: Fail")
+
+    # Weights should be reused for other variables at the same locations
+    idx = source.loc2IndexSet(locs)
+    first = source._interpolationWeights(idx, "bilinear")
+    if source._interpolationWeights(idx, "bilinear") is first: print("  Weight reuse: Success")
+    else: raise RuntimeError("  Weight reuse: Fail")
+
+def test_get_many():
+    print("")
+    print("Testing multi-variable getting...")
+    source = NCSource(MERRA, verbose=False)
+    source.load("U50M")
+    source.load("V50M")
+    locs = [(6.0, 50.1), (6.6, 50.6), (6.3, 50.9)]
+
+    for interpolation in ["near", "bilinear"]:
+        many = source.get_many(["U50M", "V50M"], locs, interpolation=interpolation)
+        for var in ["U50M", "V50M"]:
+            single = source.get(var, locs, interpolation=interpolation)
+            if not (np.isclose(many[var], single).all() and (many[var].index == source.timeindex).all()):
+                raise RuntimeError("  %s get_many: Fail"%interpolation)
+        print("  %s get_many: Success"%interpolation)
+
+def test_timeBounds():
+    print("")
+    print("Testing time bounds...")
+    raw = nc.Dataset(MERRA)
+    full = NCSource(MERRA, verbose=False, tz="GMT")
+    source = NCSource(MERRA, verbose=False, tz="GMT", timeBounds=("2015-01-01 10:00", "2015-01-02 09:59"))
+
+    if source.timeindex.size == 24 and (source.timeindex == full.timeindex[10:34]).all(): print("  Time index: Success")
+    else: raise RuntimeError("  Time index: Fail")
+
+    source.load("U50M")
+    if source.data["U50M"].shape[0] == 24 and (source.data["U50M"] == raw["U50M"][10:34]).all(): print("  Windowed load: Success")
+    else: raise RuntimeError("  Windowed load: Fail")
+
+    try:
+        NCSource(MERRA, verbose=False, timeBounds=("2016-01-01", "2016-02-01"))
+        caught = False
+    except ResError as e:
+        caught = True
+    if caught: print("  Empty window caught: Success")
+    else: raise RuntimeError("  Empty window caught: Fail")
+
+def test_lazy():
+    print("")
+    print("Testing lazy loading...")
+    eager = NCSource(makeCurvilinearSource(), verbose=False)
+    lazy = NCSource(CURVILINEAR, verbose=False, lazy=True)
+    for source in [eager, lazy]:
+        source.load("windspeed", processor=lambda x: x*2)
+        source.data["squared"] = source._derive(np.multiply, "windspeed", "windspeed")
+
+    if not isinstance(lazy.data["windspeed"], np.ndarray): print("  Handle registered: Success")
+    else: raise RuntimeError("  Handle registered: Fail")
+
+    rs = np.random.RandomState(3)
+    locs = list(zip(rs.uniform(5.5, 9, 50), rs.uniform(46, 49, 50)))
+    for interpolation in ["near", "bilinear", "cubic"]:
+        for var in ["windspeed", "squared"]:
+            if not np.isclose(eager.get(var, locs, interpolation=interpolation), lazy.get(var, locs, interpolation=interpolation)).all():
+                raise RuntimeError("  Lazy %s get: Fail"%interpolation)
+        print("  Lazy %s get: Success"%interpolation)
+
+def test_pickle():
+    print("")
+    print("Testing cache directories...")
+    source = NCSource(MERRA, verbose=False)
+    source.load("U50M")
+    source.load("T2M", name="air_temp", processor=lambda x: x-273.15)
+    source.pickle(join("outputs","merra-like.cache"))
+
+    cached = NCSource.fromPickle(join("outputs","merra-like.cache"))
+    if isinstance(cached.data["U50M"], np.memmap) and list(cached.data.keys()) == ["U50M", "air_temp"]: print("  Memory mapped: Success")
+    else: raise RuntimeError("  Memory mapped: Fail")
+
+    locs = [(6.0, 50.1), (6.6, 50.6)]
+    for var in ["U50M", "air_temp"]:
+        if not (np.isclose(cached.get(var, locs, interpolation="bilinear"), source.get(var, locs, interpolation="bilinear")).all() and
+                (cached.timeindex == source.timeindex).all() and cached.fingerprint == source.fingerprint):
+            raise RuntimeError("  Reopened data: Fail")
+    print("  Reopened data: Success")
+
+    # Legacy pickle files should still be readable (older sources only had 
+    # these attributes)
+    legacyAttributes = ["variables", "fill", "_allLats", "_allLons", "_maximal_lon_difference", 
+                        "_maximal_lat_difference", "dependent_coordinates", "_lonN", "_latN", 
+                        "_latStart", "_latStop", "_lonStart", "_lonStop", "bounds", "lats", "lons", 
+                        "extent", "timeName", "_timeindex_raw", "timeindex", "data"]
+    old = NCSource.__new__(NCSource)
+    old.__dict__.update({k:v for k,v in source.__dict__.items() if k in legacyAttributes})
+    old.data = OrderedDict([("U50M", np.array(source.data["U50M"])), ])
+    with open(join("outputs","merra-like.pkl"), "wb") as fo: pickle.dump(old, fo)
+
+    legacy = NCSource.fromPickle(join("outputs","merra-like.pkl"))
+    legacy.load("T2M", name="air_temp", processor=lambda x: x-273.15)
+    if ((legacy.data["U50M"] == source.data["U50M"]).all() and legacy.fingerprint == source.fingerprint and
+            np.isclose(legacy.get("U50M", locs, interpolation="bilinear"), source.get("U50M", locs, interpolation="bilinear")).all() and
+            np.isclose(legacy.get("air_temp", locs), source.get("air_temp", locs)).all()): 
+        print("  Legacy pickle: Success")
+    else: raise RuntimeError("  Legacy pickle: Fail")
+
+def test_sharedMemory():
+    print("")
+    print("Testing shared memory...")
+    from multiprocessing import Pool
+    source = NCSource(MERRA, verbose=False)
+    source.load("U50M")
+    expected = source.data["U50M"].copy()
+    locs = [(6.0, 50.1), (6.6, 50.6)]
+
+    unshared = len(pickle.dumps(source))
+    source.toSharedMemory()
+    if len(pickle.dumps(source)) <= unshared-expected.nbytes/2: print("  Lightweight pickling: Success")
+    else: raise RuntimeError("  Lightweight pickling: Fail")
+
+    pool = Pool(2)
+    try:
+        res = [pool.apply_async(getFromSource, (source, "U50M", locs)) for i in range(2)]
+        res = [r.get() for r in res]
+    finally:
+        pool.close()
+        pool.join()
+    
+    if all(np.isclose(r, source.get("U50M", locs)).all() for r in res): print("  Worker access: Success")
+    else: raise RuntimeError("  Worker access: Fail")
+
+    source.releaseSharedMemory()
+    if isinstance(source.data["U50M"], np.ndarray) and (source.data["U50M"] == expected).all(): print("  Release: Success")
+    else: raise RuntimeError("  Release: Fail")
+
+def test_catalog():
+    print("")
+    print("Testing catalogs...")
+    import os, json
+    catalog = join("outputs","merra-like.catalog.json")
+    if os.path.isfile(catalog): os.remove(catalog)
+
+    direct = NCSource(MERRA, verbose=False)
+    created = NCSource(MERRA, verbose=False, catalog=catalog)
+    if os.path.isfile(catalog): print("  Catalog creation: Success")
+    else: raise RuntimeError("  Catalog creation: Fail")
+
+    # Reopening should not need the catalog to change
+    mtime = os.path.getmtime(catalog)
+    cached = NCSource(MERRA, verbose=False, catalog=catalog)
+    for source in [created, cached]:
+        if not ((source.timeindex == direct.timeindex).all() and (source.lats == direct.lats).all() and 
+                (source.lons == direct.lons).all() and (source.variables == direct.variables).all().all()):
+            raise RuntimeError("  Catalog contents: Fail")
+    if os.path.getmtime(catalog) == mtime: print("  Catalog contents: Success")
+    else: raise RuntimeError("  Catalog contents: Fail")
+
+    # Out of date entries should be replaced
+    with open(catalog) as fi: entries = json.load(fi)
+    for entry in entries.values(): entry["size"] = -1
+    with open(catalog, "w") as fo: json.dump(entries, fo)
+    NCSource(MERRA, verbose=False, catalog=catalog)
+    with open(catalog) as fi: entries = json.load(fi)
+    if all(entry["size"] > 0 for entry in entries.values()): print("  Stale entries: Success")
+    else: raise RuntimeError("  Stale entries: Fail")
+
+def loadManyInWorker(i):
+    from reskit.weather.sources import MerraSource
+    source = MerraSource(MERRA, verbose=False)
+    source.loadSet_Wind(densityCorrection=True)
+    source.loadMany(["U50M", dict(variable="T2M", name="air_temp", processor=lambda x: x-273.15)])
+    return source.data
+
+def loadSplitU50M(i):
+    source = NCSource(join("outputs","merra-split"), verbose=False)
+    source.load("U50M")
+    return source.data["U50M"]
+
+@contextmanager
+def concurrentReads(count, timeout=60):
+    """Makes every netCDF read of the weather sources wait until count reads 
+    have started, so that reads which are made one after another fail with a
+    BrokenBarrierError (the worker processes inherit the patch when forked)"""
+    from multiprocessing import Barrier
+    module = import_module("reskit.weather.sources.NCSource")
+    read = module._readValues
+    barrier = Barrier(count)
+    def wait(*args):
+        barrier.wait(timeout)
+        return read(*args)
+
+    module._shutdownReadPool() # so that the workers are forked with the patch
+    module._readValues = wait
+    try: yield
+    finally: 
+        module._readValues = read
+        module._shutdownReadPool()
+
+def test_multiFile():
+    print("")
+    print("Testing multi-file sources...")
+    whole = NCSource(MERRA, verbose=False)
+    split = NCSource(splitMerraSource(), verbose=False)
+
+    if (whole.timeindex == split.timeindex).all(): print("  Time index: Success")
+    else: raise RuntimeError("  Time index: Fail")
+
+    for source in [whole, split]:
+        source.load("U50M")
+        source.load("V50M")
+    
+    if (whole.data["U50M"] == split.data["U50M"]).all(): print("  Time concatenation: Success")
+    else: raise RuntimeError("  Time concatenation: Fail")
+
+    if (whole.data["V50M"][:-1] == split.data["V50M"][:-1]).all() and (split.data["V50M"][-1] == split.data["V50M"][-2]).all():
+        print("  Forward fill: Success")
+    else: raise RuntimeError("  Forward fill: Fail")
+
+    windowed = NCSource(join("outputs","merra-split"), verbose=False, timeBounds=("2015-01-01 20:00", "2015-01-02 04:00"))
+    windowed.load("U50M")
+    if (windowed.data["U50M"] == whole.data["U50M"][20:28]).all(): print("  Windowed concatenation: Success")
+    else: raise RuntimeError("  Windowed concatenation: Fail")
+
+    # Each file's read waits until all of them have started, which only 
+    # succeeds if the reads are made at the same time
+    segments, fill = split._timeSegments("U50M")
+    with concurrentReads(len(segments)):
+        concurrent = NCSource(join("outputs","merra-split"), verbose=False)
+        concurrent.MAX_READ_WORKERS = len(segments)
+        concurrent.load("U50M")
+    if (concurrent.data["U50M"] == whole.data["U50M"]).all(): print("  Concurrent segments: Success")
+    else: raise RuntimeError("  Concurrent segments: Fail")
+
+    # Worker processes can not be started from pool workers, so the segments 
+    # are read one after another there
+    from multiprocessing import Pool
+    pool = Pool(2)
+    try: 
+        loaded = pool.map(loadSplitU50M, range(2))
+    finally:
+        pool.close()
+        pool.join()
+    if all((u == whole.data["U50M"]).all() for u in loaded): print("  Segments in pool workers: Success")
+    else: raise RuntimeError("  Segments in pool workers: Fail")
+
+def test_loadMany():
+    print("")
+    print("Testing concurrent loading...")
+    single = NCSource(MERRA, verbose=False)
+    single.load("U50M")
+    single.load("T2M", name="air_temp", processor=lambda x: x-273.15)
+
+    many = NCSource(MERRA, verbose=False)
+    many.loadMany(["U50M", dict(variable="T2M", name="air_temp", processor=lambda x: x-273.15)])
+    
+    if list(many.data.keys()) == ["U50M", "air_temp"] and all((many.data[k] == single.data[k]).all() for k in single.data):
+        print("  Load many: Success")
+    else: raise RuntimeError("  Load many: Fail")
+
+    # Each variable's read waits until the other has started
+    with concurrentReads(2):
+        concurrent = NCSource(MERRA, verbose=False)
+        concurrent.loadMany(["U50M", dict(variable="T2M", name="air_temp", processor=lambda x: x-273.15)], workers=2)
+    if all((concurrent.data[k] == single.data[k]).all() for k in single.data): print("  Concurrent reads: Success")
+    else: raise RuntimeError("  Concurrent reads: Fail")
+
+    # Variables which are combined are read along with the others
+    reference = NCSource(MERRA, verbose=False)
+    reference.loadDerived(["U2M", "V2M"], lambda u,v: np.sqrt(u*u+v*v), "windspeed")
+    with concurrentReads(3):
+        combined = NCSource(MERRA, verbose=False)
+        combined.loadMany(["PS", dict(variable=["U2M", "V2M"], name="windspeed", processor=lambda u,v: np.sqrt(u*u+v*v))], workers=3)
+    if list(combined.data.keys()) == ["PS", "windspeed"] and np.isclose(combined.data["windspeed"], reference.data["windspeed"]).all():
+        print("  Combined variables: Success")
+    else: raise RuntimeError("  Combined variables: Fail")
+
+    # Pool workers read the variables one after another
+    from multiprocessing import Pool
+    pool = Pool(2)
+    try: 
+        loaded = pool.map(loadManyInWorker, range(2))
+    finally:
+        pool.close()
+        pool.join()
+    if all((data["air_temp"] == single.data["air_temp"]).all() and "windspeed" in data for data in loaded): 
+        print("  Load many in pool workers: Success")
+    else: raise RuntimeError("  Load many in pool workers: Fail")
+
+def test_dtype():
+    print("")
+    print("Testing data types...")
+    raw = nc.Dataset(MERRA)["T2M"][:]
+
+    source = NCSource(MERRA, verbose=False)
+    source.load("T2M", processor=lambda x: x-np.float64(273.15))
+    data = source.data["T2M"]
+    if data.dtype == np.float32 and not np.ma.isMaskedArray(data) and np.isclose(data, raw-273.15).all(): 
+        print("  Default float32: Success")
+    else: raise RuntimeError("  Default float32: Fail")
+
+    source = NCSource(MERRA, verbose=False, dtype=np.float64)
+    source.load("T2M")
+    if source.data["T2M"].dtype == np.float64 and (source.data["T2M"] == raw).all(): print("  Optional float64: Success")
+    else: raise RuntimeError("  Optional float64: Fail")
+
+def test_locationMajor():
+    print("")
+    print("Testing location-major stores...")
+    for path, variables in [(MERRA, ["U50M", "T2M"]), (makeCurvilinearSource(), ["windspeed"])]:
+        source = NCSource(path, verbose=False, tz="GMT")
+        for var in variables: source.load(var)
+
+        requests = variables[:-1] + [dict(variable=variables[-1], name="other", processor=lambda x: x*2)]
+        store = LocationMajorSource.create(source, join("outputs", basename(path).replace(".nc4", ".location-major.nc4")), requests, chunkCells=4, maxMemory=2000, verbose=False)
+        if not ((store.timeindex == source.timeindex).all() and list(store.variables.keys()) == variables[:-1]+["other"]):
+            raise RuntimeError("  Store creation: Fail")
+        
+        store.loadMany(variables[:-1]+["other"])
+        # Locations near the interior grid cells, in random order
+        lats, lons = np.broadcast_arrays(source.lats[:,None], source.lons[None,:]) if source.lats.ndim==1 else (source.lats, source.lons)
+        lats, lons = lats[1:-1,1:-1], lons[1:-1,1:-1]
+        sel = np.random.RandomState(4).permutation(lats.size)[:20]
+        locs = list(zip(lons.ravel()[sel]+0.01, lats.ravel()[sel]-0.01))
+        for interpolation in ["near", "bilinear", "cubic"]:
+            for var in variables:
+                expected = source.get(var, locs, interpolation=interpolation)
+                if var == variables[-1]: 
+                    expected = expected*2
+                    var = "other"
+                if not np.isclose(store.get(var, locs, interpolation=interpolation), expected).all():
+                    raise RuntimeError("  Store %s get: Fail"%interpolation)
+    print("  Store creation: Success")
+    print("  Store get: Success")
+
+def test_quantize():
+    print("")
+    print("Testing quantized storage...")
+    locs = [(6.0, 50.5), (6.8, 50.8), (6.5, 51.0)]
+    source = NCSource(MERRA, verbose=False)
+    source.load("T2M")
+    source.load("U50M")
+
+    packed = NCSource(MERRA, verbose=False)
+    packed.loadMany([dict(variable="T2M", quantize=True), dict(variable="U50M", quantize=True)])
+    var = packed.data["T2M"]
+    if not (var.packed.dtype == np.int16 and var.shape == source.data["T2M"].shape):
+        raise RuntimeError("  Quantized storage: Fail")
+    print("  Quantized storage: Success")
+
+    for interpolation in ["near", "bilinear", "cubic"]:
+        for name in ["T2M", "U50M"]:
+            expected = source.get(name, locs, interpolation=interpolation)
+            result = packed.get(name, locs, interpolation=interpolation)
+            if not np.allclose(result, expected, rtol=0, atol=2*packed.data[name].scale):
+                raise RuntimeError("  Quantized %s get: Fail"%interpolation)
+    print("  Quantized get: Success")
+
+    packed.pickle(join("outputs","merra-like.quantized.cache"))
+    cached = NCSource.fromPickle(join("outputs","merra-like.quantized.cache"))
+    shared = packed.toSharedMemory()
+    try:
+        for other in [cached, pickle.loads(pickle.dumps(shared))]:
+            if not (other.get("T2M", locs).values == packed.get("T2M", locs).values).all():
+                raise RuntimeError("  Quantized persistence: Fail")
+    finally:
+        shared.releaseSharedMemory()
+    print("  Quantized persistence: Success")
+
+def test_subset():
+    print("")
+    print("Testing subsets...")
+    source = NCSource(MERRA, verbose=False)
+    source.load("U50M")
+    source.load("T2M", quantize=True)
+    sub = source.subset((6.0, 50.2, 6.5, 51.2))
+
+    if sub.data["U50M"].shape[1:] == (sub.lats.size, sub.lons.size) and sub.lats.size < source.lats.size \
+       and np.shares_memory(sub.data["U50M"], source.data["U50M"]) and np.shares_memory(sub.lats, source.lats):
+        print("  Subset views: Success")
+    else: raise RuntimeError("  Subset views: Fail")
+
+    locs = [(5.8, 50.6), (6.1, 50.8), (6.2, 50.9)]
+    for interpolation in ["near", "bilinear"]:
+        for var in ["U50M", "T2M"]:
+            if not np.isclose(sub.get(var, locs, interpolation=interpolation), source.get(var, locs, interpolation=interpolation)).all():
+                raise RuntimeError("  Subset %s get: Fail"%interpolation)
+    if not sub.loc2Index((6.1, 50.8)) == (source.loc2Index((6.1, 50.8)).yi - (sub._latStart-source._latStart), source.loc2Index((6.1, 50.8)).xi - (sub._lonStart-source._lonStart)):
+        raise RuntimeError("  Subset indices: Fail")
+
+    eager = NCSource(makeCurvilinearSource(), verbose=False)
+    lazy = NCSource(CURVILINEAR, verbose=False, lazy=True)
+    rs = np.random.RandomState(5)
+    locs = list(zip(rs.uniform(6.5, 7.5, 20), rs.uniform(46.5, 47.5, 20)))
+    for source in [eager, lazy]:
+        source.load("windspeed")
+        source.data["squared"] = source._derive(np.multiply, "windspeed", "windspeed")
+        sub = source.subset((6, 46, 8, 48), indexPad=2)
+        if not sub.lats.size < source.lats.size: raise RuntimeError("  Subset views: Fail")
+        for interpolation in ["near", "bilinear", "cubic"]:
+            for var in ["windspeed", "squared"]:
+                if not np.isclose(sub.get(var, locs, interpolation=interpolation), eager.get(var, locs, interpolation=interpolation)).all():
+                    raise RuntimeError("  Subset %s get: Fail"%interpolation)
+    print("  Subset get: Success")
+
+class _Unpickled(object):
+    """Writes a file when it is unpickled"""
+    def __init__(s, path): s.path = path
+    def __reduce__(s): return (open, (s.path, "w"))
+
+def test_weatherServer():
+    print("")
+    print("Testing weather servers...")
+    import os, socket, struct
+    merra = NCSource(MERRA, verbose=False, tz="Europe/Berlin")
+    merra.load("U50M")
+    merra.load("T2M", quantize=True)
+    curvilinear = NCSource(makeCurvilinearSource(), verbose=False, lazy=True)
+    curvilinear.load("windspeed")
+    
+    server = WeatherServer(join("outputs", "weather.sock"), merra=merra, curvilinear=curvilinear).start()
+    try:
+        address = join("outputs", "weather.sock")
+        if not (WeatherServer.isAddress(address) and not WeatherServer.isAddress(MERRA)): 
+            raise RuntimeError("  Server address: Fail")
+
+        if os.stat(address).st_mode & 0o777 == 0o600: print("  Socket permissions: Success")
+        else: raise RuntimeError("  Socket permissions: Fail")
+
+        remote = WeatherServer.connect(address)
+        if (type(remote) is NCSource and list(remote.data.keys()) == ["U50M", "T2M"] and (remote.timeindex == merra.timeindex).all() 
+                and remote.fingerprint == merra.fingerprint and remote.variables.equals(merra.variables)):
+            print("  Server connection: Success")
+        else: raise RuntimeError("  Server connection: Fail")
+
+        # The server never unpickles what it receives
+        marker = join("outputs", "weather.unpickled")
+        if isfile(marker): remove(marker)
+        payload = pickle.dumps(_Unpickled(marker))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        sock.sendall(struct.pack("!Q", len(payload)) + payload)
+        sock.recv(1) # Returns once the server hung up
+        sock.close()
+        if not isfile(marker) and (remote.data["U50M"].take([0], [0])[:,0] == merra.data["U50M"][:,0,0]).all(): 
+            print("  No unpickling: Success")
+        else: raise RuntimeError("  No unpickling: Fail")
+
+        locs = [(5.8, 50.6), (6.1, 50.8), (6.2, 50.9)]
+        rs = np.random.RandomState(6)
+        curvLocs = list(zip(rs.uniform(5.5, 9, 20), rs.uniform(46, 49, 20)))
+        for interpolation in ["near", "bilinear", "cubic"]:
+            for var in ["U50M", "T2M"]:
+                if not np.isclose(remote.get(var, locs, interpolation=interpolation), merra.get(var, locs, interpolation=interpolation)).all():
+                    raise RuntimeError("  Server %s get: Fail"%interpolation)
+
+            # Sources are selected by name, and can be handed to other processes
+            remote = pickle.loads(pickle.dumps(WeatherServer.connect(address+"#curvilinear")))
+            if not np.isclose(remote.get("windspeed", curvLocs, interpolation=interpolation), curvilinear.get("windspeed", curvLocs, interpolation=interpolation)).all():
+                raise RuntimeError("  Server %s get: Fail"%interpolation)
+            remote = WeatherServer.connect(address)
+        print("  Server get: Success")
+        
+        try:
+            remote.get("U50M", [(-100, 0)])
+            raise RuntimeError("  Server errors: Fail")
+        except ResError:
+            pass
+        try:
+            remote.data["U50M"].variable = "missing"
+            remote.get("U50M", locs)
+            raise RuntimeError("  Server errors: Fail")
+        except ResError:
+            print("  Server errors: Success")
+    finally:
+        server.close()
+
+def test_tileLocations():
+    print("")
+    print("Testing tiling...")
+    source = NCSource(makeCurvilinearSource(), verbose=False)
+    source.load("windspeed")
+    rs = np.random.RandomState(7)
+    locs = list(zip(rs.uniform(5.5, 9, 300), rs.uniform(46, 49, 300)))
+    budget = source.timeindex.size*4*2*16**2
+
+    tiles = source.tileLocations(locs, budget, variables=2, indexPad=2)
+    if len(tiles) > 1 and sorted((l.lon, l.lat) for tile in tiles for l in tile) == sorted(locs): print("  Tile coverage: Success")
+    else: raise RuntimeError("  Tile coverage: Fail")
+
+    for tile in tiles:
+        tileSource = NCSource(CURVILINEAR, bounds=tile, indexPad=2, verbose=False)
+        tileSource.load("windspeed")
+        if tileSource.data["windspeed"].nbytes*2 > budget: raise RuntimeError("  Tile budget: Fail")
+        if not np.isclose(tileSource.get("windspeed", tile, interpolation="bilinear"), source.get("windspeed", tile, interpolation="bilinear")).all():
+            raise RuntimeError("  Tile get: Fail")
+    print("  Tile budget: Success")
+    print("  Tile get: Success")
+
+    try:
+        source.tileLocations(locs, budget/100, variables=2, indexPad=2)
+        raise RuntimeError("  Tiny budget: Fail")
+    except ResError:
+        print("  Tiny budget: Success")
+
+def test_aggregate():
+    print("")
+    print("Testing aggregates...")
+    locs = [(5.8, 50.6), (6.1, 50.8), (6.2, 50.9)]
+    speed = lambda u,v: np.sqrt(u*u+v*v)
+    for path in [MERRA, splitMerraSource()]:
+        source = NCSource(path, verbose=False, tz="Europe/Berlin")
+        source.load("U50M")
+        source.load("V50M")
+        source.data["windspeed"] = speed(source.data["U50M"], source.data["V50M"])
+        hourly = source.get("windspeed", locs, interpolation="bilinear")
+        local = hourly.index.tz_localize(None)
+
+        expected = dict(daily=hourly.groupby(local.normalize()).mean().values,
+                        monthly=hourly.groupby(local.to_period("M")).mean().values,
+                        diurnal=hourly.groupby([local.month, local.hour]).mean().values)
+        for aggregation in ["daily", "monthly", "diurnal"]:
+            for attempt in range(2): # The second attempt reads the saved aggregate
+                name = source.loadAggregate(["U50M", "V50M"], aggregation, name="windspeed", processor=speed, 
+                                            maxMemory=2000, cacheDir="outputs")
+                result = source.get(name, locs, interpolation="bilinear")
+                if not (name == "windspeed@"+aggregation and np.isclose(result.values, expected[aggregation]).all()):
+                    raise RuntimeError("  Aggregate %s: Fail"%aggregation)
+        if not (source.get("windspeed@daily", locs).index[0] == pd.Timestamp("2015-01-01", tz="Europe/Berlin")):
+            raise RuntimeError("  Aggregate index: Fail")
+    print("  Aggregate means: Success")
+    print("  Aggregate index: Success")
+
+    # Aggregates are saved without pickles, and processors which can not be
+    # identified by their code are not mistaken for other processors
+    saved = glob(join("outputs", "%s.*.aggregate.*"%basename(MERRA)))
+    if saved and all(p.endswith(".npy") or p.endswith(".json") for p in saved): print("  Saved aggregates: Success")
+    else: raise RuntimeError("  Saved aggregates: Fail")
+
+    source = NCSource(MERRA, verbose=False)
+    plain = source.get(source.loadAggregate("U50M", "monthly", cacheDir="outputs"), locs)
+    for attempt in range(2):
+        for processor, cacheKey in [(partial(np.multiply, 100.), None), (partial(np.multiply, 100.), "percent")]:
+            scaled = source.get(source.loadAggregate("U50M", "monthly", processor=processor, cacheDir="outputs", cacheKey=cacheKey), locs)
+            if not np.isclose(scaled, plain*100, rtol=1e-5).all(): raise RuntimeError("  Unidentified processors: Fail")
+    print("  Unidentified processors: Success")
+
+def test_extractionCache():
+    print("")
+    print("Testing extraction caches...")
+    cachePath = join("outputs", "extraction-cache.sqlite")
+    for ext in ["", "-wal", "-shm"]:
+        if isfile(cachePath+ext): remove(cachePath+ext)
+
+    eager = NCSource(makeCurvilinearSource(), verbose=False)
+    eager.load("windspeed")
+    rs = np.random.RandomState(8)
+    locs = list(zip(rs.uniform(5.5, 9, 30), rs.uniform(46, 49, 30)))
+
+    def fail(yi, xi): raise RuntimeError("  Cached get: Fail")
+    for attempt in range(3):
+        source = NCSource(CURVILINEAR, verbose=False, lazy=True, extractionCache=cachePath)
+        source.load("windspeed")
+        if attempt == 1: locs = locs[10:] + list(zip(rs.uniform(5.5, 9, 10), rs.uniform(46, 49, 10))) # partly cached
+        if attempt == 2: 
+            source = pickle.loads(pickle.dumps(source))
+            source.data["windspeed"].take = fail # Everything is cached, so nothing is read
+        
+        for interpolation in ["near", "bilinear"]:
+            result = source.get_many(["windspeed"], locs, interpolation=interpolation)["windspeed"]
+            if not np.isclose(result, eager.get("windspeed", locs, interpolation=interpolation)).all():
+                raise RuntimeError("  Cached get: Fail")
+            single = source.get("windspeed", locs[3], interpolation=interpolation)
+            if not np.isclose(single, eager.get("windspeed", locs[3], interpolation=interpolation)).all():
+                raise RuntimeError("  Cached get: Fail")
+    print("  Cached get: Success")
+
+def test_synthetic():
+    print("")
+    print("Testing synthetic datasets...")
+    from reskit.weather.sources import MerraSource, CosmoSource
+    from reskit.weather.synthetic import makeMerraLike, makeCosmoLike
+    import shutil
+
+    directory = join("outputs", "synthetic-merra")
+    if isdir(directory): shutil.rmtree(directory)
+    paths = makeMerraLike(directory, latN=6, lonN=5, split="month", variables=["U50M","T2M"])
+    if len(paths) != 24: raise RuntimeError("  MERRA-like files: Fail")
+
+    merra = MerraSource(directory, verbose=False)
+    merra.load("U50M")
+    if merra.timeindex.size != 8760 or merra.data["U50M"].shape != (8760, 6, 5):
+        raise RuntimeError("  MERRA-like files: Fail")
+    raw = nc.Dataset(paths[0])
+    if raw["U50M"].standard_name != "eastward_wind_at_50_meters" or raw["time"].units != "minutes since 2015-01-01 00:30:00":
+        raise RuntimeError("  MERRA-like files: Fail")
+    raw.close()
+    if merra.loc2Index((merra.lons[3], merra.lats[2])) != (2, 3): raise RuntimeError("  MERRA-like files: Fail")
+    print("  MERRA-like files: Success")
+
+    directory = join("outputs", "synthetic-cosmo")
+    if isdir(directory): shutil.rmtree(directory)
+    paths = makeCosmoLike(directory, latN=8, lonN=9, byVariable=False, variables=["windspeed_50","windspeed_100"])
+
+    cosmo = CosmoSource(paths, verbose=False)
+    cosmo.loadMany(["windspeed_50","windspeed_100"])
+    if cosmo.loc2Index((cosmo.lons[4,6], cosmo.lats[4,6])) != (4, 6): raise RuntimeError("  COSMO-like files: Fail")
+    if not (cosmo.data["windspeed_100"] > cosmo.data["windspeed_50"]).all(): raise RuntimeError("  COSMO-like files: Fail")
+    print("  COSMO-like files: Success")
+
+def test_loadDerived():
+    print("")
+    print("Testing derived loads...")
+    speed = lambda u, v: np.sqrt(u*u+v*v)
+    both = lambda u, v: (np.sqrt(u*u+v*v), np.arctan2(v, u))
+
+    whole = NCSource(splitMerraSource(), verbose=False)
+    whole.loadMany(["U50M", "V50M"])
+    expected = speed(whole.data["U50M"], whole.data["V50M"])
+
+    # Chunks of 8 time steps, with a forward filled last step in V50M
+    source = NCSource(join("outputs","merra-split"), verbose=False)
+    rowBytes = source.lats.size*source.lons.size*4*2
+    source.loadDerived(["U50M", "V50M"], both, ["windspeed", "winddir"], maxMemory=8*rowBytes)
+    if list(source.data) != ["windspeed", "winddir"] or not np.isclose(source.data["windspeed"], expected).all() \
+       or not np.isclose(source.data["winddir"], np.arctan2(whole.data["V50M"], whole.data["U50M"])).all():
+        raise RuntimeError("  Streamed load: Fail")
+    print("  Streamed load: Success")
+
+    lazy = NCSource(join("outputs","merra-split"), verbose=False, lazy=True)
+    lazy.loadDerived(["U50M", "V50M"], both, ["windspeed", "winddir"])
+    locs = [(lazy.lons[1], lazy.lats[2]), (lazy.lons[2], lazy.lats[1])]
+    for name in ["windspeed", "winddir"]:
+        if not np.isclose(lazy.get(name, locs), source.get(name, locs)).all():
+            raise RuntimeError("  Lazy load: Fail")
+    print("  Lazy load: Success")
+
+def test_shear():
+    print("")
+    print("Testing shear exponents...")
+    from reskit.weather.sources import MerraSource
+    from reskit.weather.synthetic import makeMerraLike
+    from reskit.weather.windutil import projectByPowerLaw
+    import shutil
+
+    # Synthetic wind speeds follow a power law with an exponent of 0.14
+    directory = join("outputs", "synthetic-merra-shear")
+    if isdir(directory): shutil.rmtree(directory)
+    makeMerraLike(directory, latN=6, lonN=5, years=1, split="year", variables=["U2M","V2M","U10M","V10M","U50M","V50M"])
+
+    source = MerraSource(directory, verbose=False, timeBounds=("2015-03-01", "2015-03-10"))
+    source.loadSet_Wind(shear=True)
+    if list(source.data) != ["windspeed", "alpha"] or source.data["alpha"].shape != source.data["windspeed"].shape:
+        raise RuntimeError("  Shear exponents: Fail")
+
+    source.loadMany(["U2M","V2M","U50M","V50M"])
+    ws2 = np.sqrt(source.data["U2M"]**2+source.data["V2M"]**2)
+    calm = ws2 < 0.5
+    if not np.isclose(source.data["alpha"][~calm], 0.14, atol=1e-4).all():
+        raise RuntimeError("  Shear exponents: Fail")
+    print("  Shear exponents: Success")
+
+    locs = [(source.lons[2], source.lats[3]), (source.lons[1], source.lats[2])]
+    weather = source.get_many(["windspeed", "alpha"], locs, interpolation="near")
+    ws = projectByPowerLaw(weather["windspeed"], measuredHeight=50, targetHeight=np.array([100, 120]), alpha=weather["alpha"].values)
+    expected = source.get("windspeed", locs[0])*2**0.14
+    good = ~calm[:, 3, 2]
+    if not np.isclose(ws.iloc[:,0][good], expected[good], rtol=1e-4).all(): raise RuntimeError("  Hub height projection: Fail")
+    print("  Hub height projection: Success")
+
+def test_windowBounds():
+    print("")
+    print("Testing locations outside the working window...")
+    from reskit.weather.sources import MerraSource
+    # The window covers rows 49.5-51.0 of a grid which reaches 52.0
+    source = MerraSource(join("data","weather_data"), bounds=(5.5,49.9,6.3,50.6), indexPad=0, verbose=False)
+    source.load("U50M")
+
+    try:
+        source.loc2Index((6.25, 52.0))
+        raise RuntimeError("  Outside window: Fail")
+    except ResError: pass
+    if not source.loc2Index((6.25, 52.0), outsideOkay=True) is None: raise RuntimeError("  Outside window: Fail")
+    ws = source.get("U50M", [(6.0, 50.2), (6.25, 52.0)], outsideOkay=True)
+    if not (ws.iloc[:,1].isnull().all() and ws.iloc[:,0].notnull().all()): raise RuntimeError("  Outside window: Fail")
+    print("  Outside window: Success")
+
+    # Beyond the last row's center, so it cannot be interpolated
+    try:
+        source.get("U50M", (6.25, 51.2), interpolation="bilinear")
+        raise RuntimeError("  Window edge: Fail")
+    except ResError: pass
+    print("  Window edge: Success")
+
+if __name__ == "__main__":
+    test_loc2Index_curvilinear()
+    test_loc2Index_axis()
+    test_IndexSet()
+    test_get_interpolation()
+    test_get_many()
+    test_timeBounds()
+    test_lazy()
+    test_pickle()
+    test_sharedMemory()
+    test_catalog()
+    test_multiFile()
+    test_loadMany()
+    test_dtype()
+    test_locationMajor()
+    test_quantize()
+    test_subset()
+    test_weatherServer()
+    test_tileLocations()
+    test_aggregate()
+    test_extractionCache()
+    test_synthetic()
+    test_loadDerived()
+    test_shear()
+    test_windowBounds()
@@ -59,6 +59,27 @@ def test_simulatePVModuleDistribution():
     print( "simulatePVModuleDistribution not tested..." )
 
 
+def test_tiledWorkflow():
+    print("Testing tiled workflow...")
+    import numpy as np
+    from reskit.solarpower import workflowOpenFieldFixed
+    from reskit.solarpower._workflow import _tile_placements
+    from test_windpower import makeWideMerraSource
+    source = makeWideMerraSource()
+    rs = np.random.RandomState(0)
+    locs = list(zip(rs.uniform(5.975, 6.419, 100), rs.uniform(50.494, 50.950, 100)))
+    budget = 240000
+
+    if len(_tile_placements(source, locs, False, budget/2, False)) > 1: print("  Tiled placements: Success")
+    else: raise RuntimeError("  Tiled placements: Fail")
+
+    # Each of the pool's workers opens and loads its own tile
+    reference = workflowOpenFieldFixed(locs, source, verbose=False)
+    tiled = workflowOpenFieldFixed(locs, source, verbose=False, jobs=2, memoryBudget=budget)
+
+    if np.isclose(tiled, reference).all(): print("  Tiled workflow in pool workers: Success")
+    else: raise RuntimeError("  Tiled workflow in pool workers: Fail")
+
 if __name__ == "__main__":
     test_my_sapm_celltemp()
     test_spencerSolPos()
@@ -75,4 +96,5 @@ if __name__ == "__main__":
     test_simulation()
     test_simulatePVModule()
     test_simulatePVModuleDistribution()
+    test_tiledWorkflow()
     
\ No newline at end of file
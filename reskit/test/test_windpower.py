@@ -10,6 +10,35 @@ from reskit.weather import MerraSource, computeContextMean
 from reskit.util import ResError, Location
 
 ## make some constants
+MERRA = join("data","merra-like.nc4")
+GWA = join("data","gwa50-like.tif")
+CLC = join("data","clc-aachen_clipped.tif")
+
+def makeWideMerraSource(path=join("outputs","merra-wide.nc4")):
+    """Writes the MERRA-like file onto a finer and wider grid (repeating its nearest
+    cells), so that placements around Aachen can be split into several tiles"""
+    raw = nc.Dataset(MERRA)
+    lats = np.arange(47, 54.01, 0.25)
+    lons = np.arange(2.5, 10.01, 0.3125)
+    yi = np.abs(raw["lat"][:][None,:]-lats[:,None]).argmin(axis=1)
+    xi = np.abs(raw["lon"][:][None,:]-lons[:,None]).argmin(axis=1)
+
+    ds = nc.Dataset(path, "w")
+    ds.createDimension("time", None)
+    ds.createDimension("lat", lats.size)
+    ds.createDimension("lon", lons.size)
+
+    ds.createVariable("time", "f8", ("time",)).units = raw["time"].units
+    ds["time"][:] = raw["time"][:]
+    ds.createVariable("lat", "f8", ("lat",))[:] = lats
+    ds.createVariable("lon", "f8", ("lon",))[:] = lons
+    for var in ["PS","SWGDN","T2MDEW","T2M","U2M","U50M","V2M","V50M"]:
+        ds.createVariable(var, "f4", ("time","lat","lon"))[:] = raw[var][:][:,yi][:,:,xi]
+    ds.close()
+
+    raw.close()
+    return path
+
 windspeed = np.linspace(0,35,351)
 windspeeds = np.column_stack([windspeed, windspeed+2, windspeed+5])
 
@@ -128,7 +157,27 @@ def test_singleTurbineWorkflow():
         print("  Basic workflow with multiple turbines: Success")
     else: raise RuntimeError("Basic workflow with multiple turbines: Fail")
 
+def test_tiledWorkflow():
+    print("Testing tiled workflow...")
+    from reskit.windpower._workflow import _tile_placements
+    source = makeWideMerraSource()
+    rs = np.random.RandomState(0)
+    locs = list(zip(rs.uniform(5.975, 6.419, 100), rs.uniform(50.494, 50.950, 100)))
+    budget = 360000
+
+    if len(_tile_placements(source, locs, False, True, budget/2, False)) > 1: print("  Tiled placements: Success")
+    else: raise RuntimeError("  Tiled placements: Fail")
+
+    # Each of the pool's workers opens and loads its own tile
+    reference = workflowOnshore(locs, source, CLC, GWA, hubHeight=100, powerCurve="E-126_EP4", verbose=False)
+    tiled = workflowOnshore(locs, source, CLC, GWA, hubHeight=100, powerCurve="E-126_EP4", verbose=False, 
+                            jobs=2, memoryBudget=budget)
+
+    if np.isclose(tiled, reference).all(): print("  Tiled workflow in pool workers: Success")
+    else: raise RuntimeError("  Tiled workflow in pool workers: Fail")
+
 if __name__ == '__main__':
     test_SyntheticPowerCurve()
     test_simulateTurbine()
     test_singleTurbineWorkflow()
+    test_tiledWorkflow()
@@ -3,3 +3,4 @@
 
 from . import sources
 from . import windutil
+from . import synthetic
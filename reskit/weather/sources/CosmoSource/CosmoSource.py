@@ -1,5 +1,18 @@
 from ..NCSource import *
 import pytz
+from scipy.sparse import hstack
+
+
+def _blend(lower, upper, fac):
+    out = upper*fac
+    out += lower*(1-fac)
+    return out
+
+
+def _kelvinToCelsius(x):
+    x -= 273.15  # in place, since loaded data is newly read
+    return x
+
 
 # Define constants
 
@@ -17,6 +30,9 @@ class CosmoSource(NCSource):
     # a LARGE ooverestimate of how much space should be inbetween a given point and the nearest index
     MAX_LAT_DIFFERENCE = 0.6
 
+    # The heights (in meters) of the available wind speed levels
+    WIND_SPEED_LEVELS = [10, 50, 100, 140]
+
     def __init__(s, source, bounds=None, indexPad=0, **kwargs):
         """Initialize a COSMO style netCDF4 file source
 
@@ -46,7 +62,7 @@ class CosmoSource(NCSource):
                           indexPad=indexPad, _maxLonDiff=s.MAX_LON_DIFFERENCE, _maxLatDiff=s.MAX_LAT_DIFFERENCE,
                           tz=pytz.FixedOffset(60), **kwargs)
 
-    def loc2Index(s, loc, outsideOkay=False, asInt=True):
+    def loc2Index(s, loc, outsideOkay=False, asInt=True, _asSet=False):
         """Returns the closest X and Y indexes corresponding to a given location 
         or set of locations
 
@@ -72,8 +88,8 @@ class CosmoSource(NCSource):
             * y index can be accessed with '.yi'
             * x index can be accessed with '.xi'
 
-        If multiple locations are given: list
-            * Format: [ (yIndex1, xIndex1), (yIndex2, xIndex2), ...]
+        If multiple locations are given: IndexSet
+            * Behaves like [ (yIndex1, xIndex1), (yIndex2, xIndex2), ...]
             * Order matches the given order of locations
 
         """
@@ -90,11 +106,13 @@ class CosmoSource(NCSource):
             _latStart = 0
             _latN = 824
             _lonN = 848
+            fingerprint = None
         else:
             _lonStart = s._lonStart
             _latStart = s._latStart
-            _latN = s._latN
-            _lonN = s._lonN
+            _latN = s._latStop - s._latStart # The working window, not the full grid
+            _lonN = s._lonStop - s._lonStart
+            fingerprint = s.fingerprint
 
         # Ensure loc is a list
         locations = LocationSet(loc)
@@ -107,41 +125,73 @@ class CosmoSource(NCSource):
         lonI = (rlonCoords - rlonStart)/rlonRes - _lonStart
         latI = (rlatCoords - rlatStart)/rlatRes - _latStart
 
-        # Check for out of bounds
-        s = (latI < 0) | (latI >= _latN) | (lonI < 0) | (lonI >= _lonN)
-        if s.any():
+        # Check for out of bounds (the closest cell must be in the working window)
+        outside = (latI < -0.5) | (latI >= _latN-0.5) | (lonI < -0.5) | (lonI >= _lonN-0.5)
+        if outside.any():
             if not outsideOkay:
                 print("The following locations are out of bounds")
-                print(locations[s])
+                print(locations[outside])
                 raise ResError("Locations are outside the boundaries")
 
-        # Make int, maybe
-        if asInt:
-            lonI = np.round(lonI).astype(int)
-            latI = np.round(latI).astype(int)
-
         # Make output
-        if locations.count == 1:
-            if s[0] is True:
-                return None
-            else:
-                return Index(yi=latI[0], xi=lonI[0])
+        idx = IndexSet(np.round(latI), np.round(lonI), latI, lonI, valid=~outside, 
+                       fingerprint=fingerprint, asInt=asInt)
+        if locations.count == 1 and not _asSet:
+            return idx[0]
         else:
-            return [None if ss else Index(yi=y, xi=x) for ss, y, x in zip(s, latI, lonI)]
+            return idx
 
     def loadRadiation(s):
         """frankCorrection: "Bias correction of a novel European reanalysis data set for solar energy applications" """
         s.load("SWDIFDS_RAD", "dhi")
         s.load("SWDIRS_RAD", "dni_flat")
-        s.data["ghi"] = s.data["dhi"]+s.data["dni_flat"]
+        s.data["ghi"] = s._derive(np.add, "dhi", "dni_flat")
 
         del s.data["dni_flat"], s.data["dhi"]
 
-    def loadWindSpeedLevels(s):
-        s.load("windspeed_10", name="windspeed_10")
-        s.load("windspeed_50", name="windspeed_50")
-        s.load("windspeed_100", name="windspeed_100")
-        s.load("windspeed_140", name="windspeed_140")
+    @classmethod
+    def _levelBands(cls, heights):
+        """The index of the lower of the two levels which bracket each height, 
+        where heights outside the levels use the nearest two levels"""
+        levels = np.array(cls.WIND_SPEED_LEVELS, dtype=float)
+        return np.clip(np.searchsorted(levels, heights, side="right")-1, 0, levels.size-2)
+
+    @classmethod
+    def bracketingLevels(cls, heights=None):
+        """The names of the wind speed levels which are needed to compute the 
+        wind speed at the given heights
+
+        Parameters
+        ----------
+        heights : numeric or array_like; optional
+            The heights (in meters), or the range of heights (as (min, max))
+              * If None, all levels are returned
+
+        Returns
+        -------
+        list of str
+        """
+        if heights is None: 
+            return ["windspeed_%d"%h for h in cls.WIND_SPEED_LEVELS]
+
+        heights = np.asarray(heights, dtype=float)
+        if heights.size == 0: return []
+        bands = cls._levelBands([np.nanmin(heights), np.nanmax(heights)])
+        return ["windspeed_%d"%h for h in cls.WIND_SPEED_LEVELS[bands[0]:bands[1]+2]]
+
+    def loadWindSpeedLevels(s, heights=None):
+        """Load the wind speed levels
+
+        Parameters
+        ----------
+        heights : numeric or array_like; optional
+            The heights (in meters) at which wind speeds will be requested, such
+            as the hub heights of the placements to simulate, or a range of
+            heights as (min, max)
+              * Only the levels which bracket these heights are loaded
+              * If None, all levels are loaded
+        """
+        s.loadMany(s.bracketingLevels(heights))
 
     def loadWindSpeedAtHeight(s, height=100):
         """NEEDS UPDATING!"""
@@ -176,9 +226,7 @@ class CosmoSource(NCSource):
 
                 fac = (height-50)/(100-50)
 
-                newWspd = s.data["windspeed_100"] * \
-                    fac+s.data["windspeed_50"]*(1-fac)
-                s.data["windspeed"] = newWspd
+                s.data["windspeed"] = s._derive(_blend, "windspeed_50", "windspeed_100", fac=fac)
 
                 del s.data["windspeed_50"]
                 del s.data["windspeed_100"]
@@ -189,14 +237,12 @@ class CosmoSource(NCSource):
 
                 fac = (height-100)/(140-100)
 
-                newWspd = s.data["windspeed_140"] * \
-                    fac+s.data["windspeed_100"]*(1-fac)
-                s.data["windspeed"] = newWspd
+                s.data["windspeed"] = s._derive(_blend, "windspeed_100", "windspeed_140", fac=fac)
 
                 del s.data["windspeed_100"]
                 del s.data["windspeed_140"]
 
-    def loadTemperature(s, processor=lambda x: x-273.15):
+    def loadTemperature(s, processor=_kelvinToCelsius):
         """load the typical pressure variable"""
         s.load("2t", name="air_temp", processor=processor)
 
@@ -205,33 +251,64 @@ class CosmoSource(NCSource):
         s.load("sp", name="pressure")
 
     def loadSet_PV(s, verbose=False, _clockstart=None, _header=""):
+        """Load basic PV power simulation variables
+
+          * 'ghi' from SWDIFDS_RAD and SWDIRS_RAD
+          * 'windspeed' from windspeed_10
+          * 'air_temp' from 2t
+          * 'pressure' from sp
+        """
         if verbose:
             from datetime import datetime as dt
             if _clockstart is None:
                 _clockstart = dt.now()
-            print(_header, "Loading radiation at: +%.2fs" %
+            print(_header, "Loading PV variables at: +%.2fs" %
                   (dt.now()-_clockstart).total_seconds())
-        s.loadRadiation()
 
-        if verbose:
-            print(_header, "Loading wind speed at: +%.2fs" %
-                  (dt.now()-_clockstart).total_seconds())
-        s.loadWindSpeedAtHeight(10)
+        s.loadMany([dict(variable="SWDIFDS_RAD", name="dhi"),
+                    dict(variable="SWDIRS_RAD", name="dni_flat"),
+                    dict(variable="windspeed_10", name="windspeed"),
+                    dict(variable="sp", name="pressure"),
+                    dict(variable="2t", name="air_temp", processor=_kelvinToCelsius), ])
 
-        if verbose:
-            print(_header, "Loading pressure at: +%.2fs" %
-                  (dt.now()-_clockstart).total_seconds())
-        s.loadPressure()
+        s.data["ghi"] = s._derive(np.add, "dhi", "dni_flat")
+        del s.data["dni_flat"], s.data["dhi"]
 
         if verbose:
-            print(_header, "Loading temperature at: +%.2fs" %
+            print(_header, "Done loading data at: +%.2fs" %
                   (dt.now()-_clockstart).total_seconds())
-        s.loadTemperature()
 
-    def getWindSpeedAtHeights(s, locations, heights, spatialInterpolation='near', forceDataFrame=False, outsideOkay=False, _indicies=None):
+    def loadSet_Wind(s, densityCorrection=False, heights=None):
+        """Load basic Wind power simulation variables
+
+          * 'windspeed_10', 'windspeed_50', 'windspeed_100', and 'windspeed_140'
+            - If heights are given, only the levels which bracket them
+          * If densityCorrection is True:
+            - 'air_temp' from 2t
+            - 'pressure' from sp
         """
-        Retrieve complete time series for a variable from the source's loaded data 
-        table at the given location(s)
+        variables = s.bracketingLevels(heights)
+        if densityCorrection:
+            variables.append(dict(variable="sp", name="pressure"))
+            variables.append(dict(variable="2t", name="air_temp", processor=_kelvinToCelsius))
+        s.loadMany(variables)
+
+    def getWindSpeedAtHeights(s, locations, heights, spatialInterpolation='near', verticalInterpolation='linear', forceDataFrame=False, outsideOkay=False, _indicies=None):
+        """
+        Retrieve complete time series of the wind speed at the given height of
+        each location, from the wind speed levels in the source's loaded data 
+        table
+
+        * The horizontal interpolation weights of each location are computed
+          once, and only the two levels which bracket the height of each 
+          location are gathered
+        * The vertical blend is applied in the same pass, and the result is 
+          written into a single (time, locations) matrix
+        * Heights below 10 m or above 140 m are extrapolated from the nearest 
+          two levels
+        * When the source has an extraction cache, the series at each height 
+          are stored in it, and only locations which are not found are 
+          extracted
 
         Parameters
         ----------
@@ -243,6 +320,11 @@ class CosmoSource(NCSource):
                     of geometries is okay
                   * geokit,Location, or geokit.LocationSet are best, though
 
+            heights : numeric or array_like
+                The height (in meters) at which to compute the wind speed
+                  * Either a single height for all locations, or one height for 
+                    each location
+
             spatialInterpolation : str, optional
                 The interpolation method to use
                   * 'near' => For each location, extract the time series at the 
@@ -254,66 +336,119 @@ class CosmoSource(NCSource):
                     surrounding +/- 2 index locations to create an estimated time 
                     series at the given location using a cubic scheme
 
+            verticalInterpolation : str, optional
+                The blend between the two levels which bracket a height
+                  * 'linear' => Linear in height
+                  * 'log' => Linear in the logarithm of height, as in the
+                    logarithmic wind profile
+
             forceDataFrame : bool, optional
                 Instructs the returned value to take the form of a DataFrame 
                 regardless of how many locations are specified
 
-
             outsideOkay : bool, optional
                 Determines if points which are outside the source's lat/lon grid
                 are allowed
-                * If True, points outside this space will return as None
+                * If True, points outside this space will return as NaN
                 * If False, an error is raised 
 
+            _indicies : IndexSet, optional
+                Precomputed indicies for the given locations, as returned by
+                loc2IndexSet()
+
         Returns
         -------
 
         If a single location is given: pandas.Series
           * Indexes match to times
-
+        
         If multiple locations are given: pandas.DataFrame
           * Indexes match to times
           * Columns match to the given order of locations
 
         """
-        k = dict(interpolation=spatialInterpolation, forceDataFrame=forceDataFrame,
-                 outsideOkay=outsideOkay, _indicies=_indicies)
-
         locations = gk.LocationSet(locations)
-        heights = np.array(heights)
+
+        heights = np.array(heights, dtype=float)
         if heights.size == 1:
-            heights = np.array([heights]*locations.count)
+            heights = np.full(locations.count, heights.item())
         elif not heights.size == locations.count:
             raise RuntimeError("Heights and locations sizes don't match")
-        _0_50 = heights < 50
-        _50_100 = np.logical_and(heights >= 50, heights < 100)
-        _100_ = heights >= 100
-
-        newWindspeed = np.empty((len(s.timeindex), locations.count))
-
-        if _0_50.any():
-            raise RuntimeError("This hasn't been implemented yet below 50m :(")
-        if _50_100.any():
-            ws50 = NCSource.get(s, "windspeed_50",
-                                locations=locations[_50_100], **k)
-            ws100 = NCSource.get(s, "windspeed_100",
-                                 locations=locations[_50_100], **k)
-
-            fac = (heights[_50_100]-50)/(100-50)
-            tmp = ws100*fac + ws50*(1-fac)
-
-            newWindspeed[:, _50_100] = tmp
-
-        if _100_.any():
-            ws100 = NCSource.get(s, "windspeed_100",
-                                 locations=locations[_100_], **k)
-            ws140 = NCSource.get(s, "windspeed_140",
-                                 locations=locations[_100_], **k)
-
-            fac = (heights[_100_]-100)/(140-100)
-            tmp = ws140*fac + ws100*(1-fac)
-            if tmp.shape[0] == 1:
-                tmp = tmp[0, :]
-            newWindspeed[:, _100_] = tmp
-
-        return pd.DataFrame(newWindspeed, columns=locations, index=s.timeindex)
+        if not verticalInterpolation in ['linear', 'log']:
+            raise ResError("verticalInterpolation not one of: 'linear' or 'log'")
+
+        cache = s.__dict__.get("_extractionCache")
+        if cache is None:
+            indicies = s._resolveIndicies(locations, outsideOkay, _indicies)
+            output = s._windSpeedAtHeights(indicies, heights, spatialInterpolation, verticalInterpolation)
+        else:
+            # Look up the series at each height, and extract the missing ones together
+            output = np.empty((len(s.timeindex), locations.count), dtype=np.float32)
+            missing = np.zeros(locations.count, dtype=bool)
+            groups = []
+            for height in np.unique(heights):
+                sel = np.flatnonzero(heights == height)
+                key = s._extractionKey("windspeed@%gm"%height, (spatialInterpolation, verticalInterpolation))
+                output[:, sel], missing[sel] = cache.fetch(key, locations.lons[sel], locations.lats[sel], len(s.timeindex))
+                groups.append( (key, sel) )
+
+            if missing.any():
+                indicies = s._resolveIndicies(locations, outsideOkay, _indicies)
+                output[:, missing] = s._windSpeedAtHeights(indicies[missing], heights[missing], spatialInterpolation, verticalInterpolation)
+
+                # Locations outside of the grid are not stored
+                store = missing & indicies.valid
+                for key, sel in groups:
+                    sel = sel[store[sel]]
+                    if sel.size: cache.store(key, locations.lons[sel], locations.lats[sel], output[:, sel])
+
+        # Make output as Series objects
+        if forceDataFrame or output.shape[1] > 1:
+            return pd.DataFrame(output, columns=locations, index=s.timeindex)
+        else:
+            return pd.Series(output[:,0], index=s.timeindex, name=locations[0])
+
+    def _windSpeedAtHeights(s, indicies, heights, spatialInterpolation, verticalInterpolation):
+        """Extracts the wind speed at the given height of each location in an
+        IndexSet, returning a (time, locations) matrix"""
+        # Find the levels which bracket each height, and the weight of the upper one
+        levels = np.array(s.WIND_SPEED_LEVELS, dtype=float)
+        band = s._levelBands(heights)
+        lower, upper = levels[band], levels[band+1]
+        if verticalInterpolation == 'linear':
+            fac = (heights-lower)/(upper-lower)
+        else:
+            fac = np.log(heights/lower)/np.log(upper/lower)
+
+        # Horizontal weights of the valid locations, as a (locations, cells) matrix
+        valid = indicies.valid
+        lonN = s.lons.shape[-1]
+        if spatialInterpolation == 'near':
+            cells, cols = np.unique(indicies.yi[valid]*lonN + indicies.xi[valid], return_inverse=True)
+            weights = csr_matrix((np.ones(cols.size), (np.arange(cols.size), cols.ravel())), shape=(cols.size, cells.size))
+        else:
+            cells, weights = s._interpolationWeights(indicies, spatialInterpolation)
+
+        output = np.full((len(s.timeindex), indicies.count), np.nan, dtype=s.dtype)
+        validI = np.flatnonzero(valid)
+        for b in np.unique(band[valid]):
+            names = ["windspeed_%d"%levels[b], "windspeed_%d"%levels[b+1]]
+            for name in names:
+                if not name in s.data: raise ResError("Wind speed level %s is not loaded. Try loadWindSpeedLevels(heights)"%name)
+
+            # Select the locations in this band, and the cells which they use
+            rows = np.flatnonzero(band[valid] == b)
+            w = weights[rows]
+            used = np.unique(w.indices)
+            w = w[:, used]
+            cellsY, cellsX = np.divmod(cells[used], lonN)
+
+            # Blend the two levels into the horizontal weights, so that both 
+            # are applied with one product
+            f = fac[validI[rows]]
+            w = hstack([w.multiply((1-f)[:,None]), w.multiply(f[:,None])]).tocsr()
+            values = np.concatenate([s._gather(name, cellsY, cellsX) for name in names], axis=1)
+
+            output[:, validI[rows]] = w.dot(values.T).T
+
+        return output
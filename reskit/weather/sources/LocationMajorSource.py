@@ -0,0 +1,225 @@
+from .NCSource import *
+from .NCSource import _LazyVariable, _readSegments, _NC_LOCK
+
+
+class _CellMajorVariable(_LazyVariable):
+    """A handle to a variable in a location-major store, where the complete
+    time series of each grid cell is stored contiguously"""
+    MAX_GAP = 64
+
+    def __init__(s, path, variable, shape, dtype=np.float32, processor=None):
+        s.path = path
+        s.variable = variable
+        s.shape = shape
+        s.dtype = dtype
+        s.processor = processor
+        s.width = shape[2]
+        s.latStart = 0
+        s.lonStart = 0
+
+    def take(s, yi, xi):
+        """Extracts the time series at the given cells of the grid as a (time,
+        cells) matrix
+
+        Cells which are close to one another in the store are read together in
+        a single contiguous read
+        """
+        cells = (np.asarray(yi, dtype=int)+s.latStart)*s.width + np.asarray(xi, dtype=int)+s.lonStart
+        if cells.size == 0: return np.empty((s.shape[0], 0), dtype=s.dtype)
+
+        unique, inverse = np.unique(cells, return_inverse=True)
+        splits = np.flatnonzero(np.diff(unique) > s.MAX_GAP)+1
+
+        values = np.empty((unique.size, s.shape[0]), dtype=s.dtype)
+        with _NC_LOCK:
+            ds = nc.Dataset(s.path, keepweakref=True)
+            var = ds[s.variable]
+            var.set_auto_mask(False)
+
+            start = 0
+            for run in np.split(unique, splits):
+                block = var[run[0]:run[-1]+1, :]
+                values[start:start+run.size] = block[run-run[0]]
+                start += run.size
+            ds.close()
+
+        if not s.processor is None:
+            values = np.asarray(s.processor(values), dtype=s.dtype)
+
+        return values[inverse].T
+
+    def read(s, ySlice, xSlice):
+        """Reads a rectangular (time, lat, lon) hyperslab of the grid"""
+        yi, xi = np.mgrid[ySlice, xSlice]
+        return s.take(yi.ravel(), xi.ravel()).reshape(s.shape[0], yi.shape[0], yi.shape[1])
+
+
+class LocationMajorSource(NCSource):
+    """The LocationMajorSource object reads weather data from a location-major
+    store, which holds the complete time series of each grid cell contiguously
+
+    * Stores are created from any NCSource with LocationMajorSource.create()
+    * Loading a variable only registers it, and get() reads the time series of
+      the needed grid cells directly, so point extraction for scattered
+      locations does not require loading a regional cube
+    """
+
+    def __init__(s, path, tz=None, verbose=True):
+        """Open a location-major store
+
+        Parameters
+        ----------
+        path : str
+            The path to the store, as written by LocationMajorSource.create()
+
+        tz: str; optional
+            Applies the indicated timezone onto the time axis
+            * If None, the timezone of the source which the store was made
+              from is used, if it is known
+        """
+        if verbose: print(path)
+        s._sources = [path, ]
+        s.path = path
+        s.fingerprint = md5(repr([(path, getsize(path), getmtime(path))]).encode()).hexdigest()
+
+        ds = nc.Dataset(path, keepweakref=True)
+        s.lats = np.ma.getdata(ds["lat"][:])
+        s.lons = np.ma.getdata(ds["lon"][:])
+        s._timeindex_raw = pd.DatetimeIndex(np.ma.getdata(ds["time"][:]).astype("datetime64[ns]"))
+        if tz is None and "tz" in ds.ncattrs(): tz = ds.tz
+        maxLonDiff, maxLatDiff = ds.maxLonDiff, ds.maxLatDiff
+
+        s.variables = OrderedDict()
+        for var in ds.variables:
+            if ds[var].dimensions == ("cell", "time"):
+                s.variables[var] = np.dtype(ds[var].dtype)
+        ds.close()
+
+        # Set the grid
+        s.dependent_coordinates = len(s.lats.shape) == 2
+        s._allLats = s.lats
+        s._allLons = s.lons
+        s._latN = s.lats.shape[0]
+        s._lonN = s.lons.shape[-1]
+        s._latStart, s._latStop = 0, s._latN
+        s._lonStart, s._lonStop = 0, s._lonN
+        s._maximal_lon_difference = maxLonDiff
+        s._maximal_lat_difference = maxLatDiff
+        if s.dependent_coordinates:
+            s._buildSpatialIndex()
+
+        s.bounds = None
+        s.extent = gk.Extent(s.lons.min(), s.lats.min(), s.lons.max(), s.lats.max(), srs=gk.srs.EPSG4326)
+
+        # Set the time index
+        s.timeName = "time"
+        s._timeStart, s._timeStop = 0, s._timeindex_raw.size
+        s.timeindex = s._timeindex_raw if tz is None else s._timeindex_raw.tz_localize(tz)
+
+        s.fill = False
+        s.lazy = True
+        s.dtype = None
+        s.data = OrderedDict()
+
+    def _read(s, variable, heightIdx=None, processor=None, quantize=False):
+        """Makes a handle to a variable in the store"""
+        if not variable in s.variables:
+            raise ResError("Variable %s is not in the store"%variable)
+        if not heightIdx is None:
+            raise ResError("Height indices are resolved when the store is created")
+        if quantize:
+            raise ResError("Variables in a store cannot be quantized")
+
+        shape = (s.timeindex.size, s._latN, s._lonN)
+        return _CellMajorVariable(s.path, variable, shape, dtype=s.variables[variable], processor=processor)
+
+    @staticmethod
+    def create(source, path, variables, chunkCells=64, maxMemory=512e6, verbose=True):
+        """Writes variables of an NCSource into a location-major store
+
+        * The store covers the source's bounds and time window
+        * Variables are read a block of grid rows at a time, so the source does
+          not need to have them loaded
+
+        Parameters
+        ----------
+        source : NCSource
+            The source to convert
+
+        path : str
+            The path of the netCDF4 file to create
+
+        variables : list
+            The variables to write
+              * Each entry is either a variable name, or a dictionary of keyword
+                arguments as for NCSource.load() (variable, name, heightIdx, and
+                processor)
+              * Example: ["U50M", dict(variable="T2M", name="air_temp", processor=...)]
+
+        chunkCells : int, optional
+            The number of grid cells stored together in each chunk
+
+        maxMemory : numeric, optional
+            The most bytes to hold in memory for each block of grid rows
+
+        Returns
+        -------
+        LocationMajorSource
+        """
+        timeN = source.timeindex.size
+        latN, lonN = source.lats.shape[0], source.lons.shape[-1]
+        dtype = source.dtype
+        rows = int(max(1, min(latN, maxMemory//(timeN*lonN*dtype.itemsize))))
+
+        ds = nc.Dataset(path, "w")
+        ds.createDimension("time", timeN)
+        ds.createDimension("cell", latN*lonN)
+
+        ds.createVariable("time", "i8", ("time",)).units = "nanoseconds since 1970-01-01 00:00:00"
+        ds["time"][:] = source._timeindex_raw[source._timeStart:source._timeStop].values.astype("datetime64[ns]").astype(np.int64)
+
+        # Remember named timezones (pytz and zoneinfo name them differently)
+        tz = source.timeindex.tz
+        tz = getattr(tz, "zone", None) or getattr(tz, "key", None)
+        if isinstance(tz, str): ds.tz = tz
+
+        ds.maxLonDiff = source._maximal_lon_difference
+        ds.maxLatDiff = source._maximal_lat_difference
+
+        # Write coordinates
+        if source.dependent_coordinates:
+            ds.createDimension("y", latN)
+            ds.createDimension("x", lonN)
+            ds.createVariable("lat", "f8", ("y","x"))[:] = source.lats
+            ds.createVariable("lon", "f8", ("y","x"))[:] = source.lons
+        else:
+            ds.createDimension("lat", latN)
+            ds.createDimension("lon", lonN)
+            ds.createVariable("lat", "f8", ("lat",))[:] = source.lats
+            ds.createVariable("lon", "f8", ("lon",))[:] = source.lons
+
+        # Write variables a block of rows at a time
+        for request in variables:
+            request = dict(variable=request) if isinstance(request, str) else dict(request)
+            variable = request["variable"]
+            name = request.get("name") or variable
+            heightIdx = request.get("heightIdx")
+            processor = request.get("processor")
+            if verbose: print("Writing %s as %s"%(variable, name))
+
+            segments, fill = source._timeSegments(variable)
+            var = ds.createVariable(name, dtype, ("cell", "time"), chunksizes=(min(chunkCells, latN*lonN), timeN))
+
+            for r0 in range(0, latN, rows):
+                r1 = min(r0+rows, latN)
+                block = _readSegments(segments, variable, heightIdx,
+                                      slice(source._latStart+r0, source._latStart+r1),
+                                      slice(source._lonStart, source._lonStop),
+                                      (timeN, r1-r0, lonN), dtype=dtype, fill=fill)
+                if not processor is None:
+                    block = np.asarray(processor(block), dtype=dtype)
+
+                var[r0*lonN:r1*lonN, :] = block.reshape(timeN, -1).T
+        ds.close()
+
+        return LocationMajorSource(path, verbose=verbose)
@@ -1,5 +1,47 @@
 from ..NCSource import *
 
+
+def _windSpeed(uData, vData):
+    speed = uData*uData
+    speed += vData*vData
+    return np.sqrt(speed, out=speed)  # total speed
+
+
+def _windDirection(uData, vData):
+    return np.arctan2(vData, uData)*(180/np.pi)  # total direction
+
+
+def _windSpeedAndDirection(uData, vData):
+    direction = _windDirection(uData, vData)
+    return _windSpeed(uData, vData), direction
+
+
+def _shearExponent(*components, heights, minSpeed, alphaRange):
+    """Fits the power law exponent to the wind speeds at several heights, as the
+    least squares slope of log(speed) over log(height)"""
+    x = np.log(np.asarray(heights, dtype=float))
+    x -= x.mean()
+    x /= (x*x).sum()
+
+    alpha = None
+    for xi, uData, vData in zip(x, components[0::2], components[1::2]):
+        speed = _windSpeed(uData, vData)
+        np.maximum(speed, minSpeed, out=speed)
+        np.log(speed, out=speed)
+        speed *= xi
+        if alpha is None: alpha = speed
+        else: alpha += speed
+
+    if not alphaRange is None:
+        np.clip(alpha, alphaRange[0], alphaRange[1], out=alpha)
+    return alpha
+
+
+def _kelvinToCelsius(x):
+    x -= 273.15  # in place, since loaded data is newly read
+    return x
+
+
 # Define constants
 
 
@@ -56,7 +98,7 @@ class MerraSource(NCSource):
                           indexPad=indexPad, _maxLonDiff=s.MAX_LON_DIFFERENCE, _maxLatDiff=s.MAX_LAT_DIFFERENCE,
                           tz="GMT", **kwargs)
 
-    def loc2Index(s, loc, outsideOkay=False, asInt=True):
+    def loc2Index(s, loc, outsideOkay=False, asInt=True, _asSet=False):
         """Returns the closest X and Y indexes corresponding to a given location 
         or set of locations
 
@@ -82,8 +124,8 @@ class MerraSource(NCSource):
             * y index can be accessed with '.yi'
             * x index can be accessed with '.xi'
 
-        If multiple locations are given: list
-            * Format: [ (yIndex1, xIndex1), (yIndex2, xIndex2), ...]
+        If multiple locations are given: IndexSet
+            * Behaves like [ (yIndex1, xIndex1), (yIndex2, xIndex2), ...]
             * Order matches the given order of locations
 
         """
@@ -94,27 +136,22 @@ class MerraSource(NCSource):
         latI = (locations.lats - s.lats[0])/0.5
         lonI = (locations.lons - s.lons[0])/0.625
 
-        # Check for out of bounds
-        s = (latI < 0) | (latI >= s._latN) | (lonI < 0) | (lonI >= s._lonN)
-        if s.any():
+        # Check for out of bounds (the closest cell must be in the working window)
+        latN, lonN = s.lats.shape[0], s.lons.shape[0]
+        outside = (latI < -0.5) | (latI >= latN-0.5) | (lonI < -0.5) | (lonI >= lonN-0.5)
+        if outside.any():
             if not outsideOkay:
                 print("The following locations are out of bounds")
-                print(locations[s])
+                print(locations[outside])
                 raise ResError("Locations are outside the boundaries")
 
-        # As int?
-        if asInt:
-            latI = np.round(latI).astype(int)
-            lonI = np.round(lonI).astype(int)
-
         # Make output
-        if locations.count == 1:
-            if s[0] is True:
-                return None
-            else:
-                return Index(yi=latI[0], xi=lonI[0])
+        idx = IndexSet(np.round(latI), np.round(lonI), latI, lonI, valid=~outside, 
+                       fingerprint=s.fingerprint, asInt=asInt)
+        if locations.count == 1 and not _asSet:
+            return idx[0]
         else:
-            return [None if ss else Index(yi=y, xi=x) for ss, y, x in zip(s, latI, lonI)]
+            return idx
 
     def contextAreaAtIndex(s, latI, lonI):
         """Compute the context area surrounding the a specified index"""
@@ -126,10 +163,13 @@ class MerraSource(NCSource):
 
         return gk.geom.box(lowLon, lowLat, highLon, highLat, srs=gk.srs.EPSG4326)
 
-    def loadWindSpeed(s, height=50, winddir=False):
+    def loadWindSpeed(s, height=50, winddir=False, maxMemory=256e6):
         """Load the U and V wind speed data at the specified height, and compute
         the overall windspeed and winddir
 
+        * U and V are read a chunk of time steps at a time, and are not kept in
+          the data table
+
         Parameters
         ----------
         height : int, optional
@@ -140,22 +180,50 @@ class MerraSource(NCSource):
         winddir : bool, optional
             If True, the wind direction is calculated and saved under a variable
             named 'winddir'
+
+        maxMemory : numeric, optional
+            The most bytes of U and V to read at once
         """
-        # read raw data
-        s.load("U%dM" % height)
-        s.load("V%dM" % height)
+        variables = ["U%dM" % height, "V%dM" % height]
+        if winddir:
+            s.loadDerived(variables, _windSpeedAndDirection, ["windspeed", "winddir"], maxMemory=maxMemory)
+        else:
+            s.loadDerived(variables, _windSpeed, "windspeed", maxMemory=maxMemory)
 
-        # read the data
-        uData = s.data["U%dM" % height]
-        vData = s.data["V%dM" % height]
+    def loadShear(s, heights=(2, 10, 50), minSpeed=0.5, alphaRange=(0, 0.6), maxMemory=256e6):
+        """Compute the power law shear exponent of each grid cell at each time 
+        step, and add it to the data table as 'alpha'
 
-        # combine into a single time series matrix
-        speed = np.sqrt(uData*uData+vData*vData)  # total speed
-        s.data["windspeed"] = speed
+        * The exponent is the least squares slope of log(wind speed) over 
+          log(height), across the wind speed levels at the given heights
+        * The wind components are read a chunk of time steps at a time, and are
+          not kept in the data table
+        * Placements can extract 'alpha' along with 'windspeed' and project to
+          their hub height with windutil.projectByPowerLaw()
 
-        if winddir:
-            direction = np.arctan2(vData, uData)*(180/np.pi)  # total direction
-            s.data["winddir"] = direction
+        Parameters
+        ----------
+        heights : list of int, optional
+            The heights of the wind speed levels to fit, in meters
+              * Options are 2, 10, 50
+
+        minSpeed : float, optional
+            Wind speeds below this value (in m/s) are raised to it before fitting,
+            to keep calm hours from giving extreme exponents
+
+        alphaRange : tuple, optional
+            The (min, max) range to clip the exponents to
+              * If None, exponents are not clipped
+
+        maxMemory : numeric, optional
+            The most bytes of wind components to read at once
+        """
+        if len(heights) < 2: raise ResError("At least two heights are needed to compute the shear")
+        variables = []
+        for height in heights: variables.extend(["U%dM" % height, "V%dM" % height])
+
+        s.loadDerived(variables, partial(_shearExponent, heights=heights, minSpeed=minSpeed, alphaRange=alphaRange), 
+                      "alpha", maxMemory=maxMemory)
 
     def loadRadiation(s):
         """Load the SWGDN variable into the data table with the name 'ghi'
@@ -191,7 +259,7 @@ class MerraSource(NCSource):
             raise ResMerraError("sub group '%s' not understood" % which)
 
         # load
-        s.load(varName, name=which+"_temp", processor=lambda x: x-273.15)
+        s.load(varName, name=which+"_temp", processor=_kelvinToCelsius)
 
     def loadPressure(s):
         """Load the PS Merra variable into the data table with the name 'pressure'"""
@@ -204,43 +272,38 @@ class MerraSource(NCSource):
           * 'dni' from SWGDN 
           * 'air_temp' from T2M
           * 'pressure' from PS
+          * All variables are read at the same time (see loadMany()), so U2M 
+            and V2M are held in full until the wind speed is computed
         """
         if verbose:
             from datetime import datetime as dt
             if _clockstart is None:
                 _clockstart = dt.now()
-            print(_header, "Loading wind speeds at: +%.2fs" %
+            print(_header, "Loading PV variables at: +%.2fs" %
                   (dt.now()-_clockstart).total_seconds())
 
-        s.loadWindSpeed(height=2)
-        del s.data["U2M"]
-        del s.data["V2M"]
-
-        if verbose:
-            print(_header, "Loading ghi at: +%.2fs" %
-                  (dt.now()-_clockstart).total_seconds())
-        s.load("SWGDN", "ghi")
-        # s.loadRadiation()
-        if verbose:
-            print(_header, "Loading temperature at: +%.2fs" %
-                  (dt.now()-_clockstart).total_seconds())
-        s.loadTemperature('air', height=2)
-        s.loadTemperature('dew', height=2)
-
-        if verbose:
-            print(_header, "Loading pressure at: +%.2fs" %
-                  (dt.now()-_clockstart).total_seconds())
-        s.loadPressure()
+        s.loadMany([dict(variable="SWGDN", name="ghi"),
+                    dict(variable="T2M", name="air_temp", processor=_kelvinToCelsius),
+                    dict(variable="T2MDEW", name="dew_temp", processor=_kelvinToCelsius),
+                    dict(variable="PS", name="pressure"),
+                    dict(variable=["U2M", "V2M"], name="windspeed", processor=_windSpeed), ])
 
         if verbose:
             print(_header, "Done loading data at: +%.2fs" %
                   (dt.now()-_clockstart).total_seconds())
 
-    def loadSet_Wind(s):
+    def loadSet_Wind(s, densityCorrection=False, shear=False):
         """Load basic Wind power simulation variables
 
           * 'windspeed' from U50M and V50M
+          * If densityCorrection is True:
+            - 'air_temp' from T2M
+            - 'pressure' from PS
+          * If shear is True:
+            - 'alpha' from U2M, V2M, U10M, V10M, U50M, and V50M (see loadShear)
         """
+        if densityCorrection:
+            s.loadMany([dict(variable="PS", name="pressure"),
+                        dict(variable="T2M", name="air_temp", processor=_kelvinToCelsius)])
         s.loadWindSpeed(height=50)
-        del s.data["U50M"]
-        del s.data["V50M"]
+        if shear: s.loadShear()
@@ -1,16 +1,598 @@
-from os import listdir
-from os.path import join, isfile, dirname, basename, isdir
+from os import listdir, makedirs, replace, getpid, remove, close as closeFile, name as osName
+from os.path import join, isfile, dirname, basename, isdir, getsize, getmtime, abspath
+from hashlib import md5
 from glob import glob
 from scipy.interpolate import RectBivariateSpline, interp2d, bisplrep, bisplev, interp1d
+from scipy.interpolate import make_interp_spline
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
 from pickle import load, dump
+from copy import copy
+import json
+from functools import partial
+from types import FunctionType
+from threading import RLock, Lock
+import sqlite3
 
 from reskit.util.util_ import *
 
 # make a data handler
 Index = namedtuple("Index", "yi xi")
+
+class IndexSet(object):
+    """The IndexSet object holds the grid indices of many locations as a set of
+    arrays, rather than as a list of Index tuples
+
+    Attributes
+    ----------
+    yi, xi : numpy.ndarray
+        The integer (closest) y and x indices of each location
+
+    yf, xf : numpy.ndarray
+        The fractional y and x indices of each location
+
+    valid : numpy.ndarray
+        A boolean mask which is False for locations outside of the source's grid
+          * The integer indices of invalid locations are 0, and the fractional 
+            indices are NaN
+
+    fingerprint : str
+        The fingerprint of the source which the indices were computed for
+
+    Note
+    ----
+    Iterating over (or integer-indexing) an IndexSet yields Index tuples, or 
+    None for invalid locations, so that it can be used in place of a list of 
+    Index tuples
+    """
+    def __init__(s, yi, xi, yf=None, xf=None, valid=None, fingerprint=None, asInt=True):
+        s.valid = np.ones(np.size(yi), dtype=bool) if valid is None else np.array(valid, dtype=bool)
+        s.yf = np.array(yi if yf is None else yf, dtype=np.float64)
+        s.xf = np.array(xi if xf is None else xf, dtype=np.float64)
+        s.yf[~s.valid] = np.nan
+        s.xf[~s.valid] = np.nan
+
+        s.yi = np.where(s.valid, yi, 0).astype(int)
+        s.xi = np.where(s.valid, xi, 0).astype(int)
+
+        s.fingerprint = fingerprint
+        s.asInt = asInt
+        s._weights = dict()
+
+    @staticmethod
+    def load(indicies, fingerprint=None):
+        """Creates an IndexSet from an Index, a list of Index tuples (which may 
+        contain None), or another IndexSet"""
+        if isinstance(indicies, IndexSet): return indicies
+        if indicies is None or isinstance(indicies, Index): indicies = [indicies, ]
+
+        valid = np.array([not i is None for i in indicies], dtype=bool)
+        yf = np.array([np.nan if i is None else i[0] for i in indicies], dtype=np.float64)
+        xf = np.array([np.nan if i is None else i[1] for i in indicies], dtype=np.float64)
+        asInt = all(isinstance(i[0], (int, np.integer)) for i in indicies if not i is None)
+
+        return IndexSet(np.round(np.nan_to_num(yf)), np.round(np.nan_to_num(xf)), yf, xf, valid=valid, fingerprint=fingerprint, asInt=asInt)
+
+    @property
+    def count(s): return s.valid.size
+
+    def __len__(s): return s.valid.size
+
+    def __iter__(s):
+        for i in range(s.count): yield s[i]
+
+    def __getitem__(s, i):
+        if isinstance(i, (int, np.integer)):
+            if not s.valid[i]: return None
+            if s.asInt: return Index(yi=s.yi[i], xi=s.xi[i])
+            else: return Index(yi=s.yf[i], xi=s.xf[i])
+        else:
+            return IndexSet(s.yi[i], s.xi[i], s.yf[i], s.xf[i], valid=s.valid[i], fingerprint=s.fingerprint, asInt=s.asInt)
+
+    def __repr__(s):
+        return "IndexSet of %d locations (%d valid)"%(s.count, s.valid.sum())
+
+# The netCDF4 library is not thread safe, so calls into it from the threads of 
+# one process are serialized. Reads which should run at the same time are made
+# in worker processes instead (see _readHyperslabs)
+_NC_LOCK = RLock()
+
+def _readValues(path, variable, heightIdx, fileStart, fileStop, ySlice, xSlice):
+    """Reads the time steps [fileStart, fileStop) of a variable from one file"""
+    ds = nc.Dataset(path, keepweakref=True)
+    try:
+        if heightIdx is None: 
+            return ds[variable][fileStart:fileStop, ySlice, xSlice]
+        else: 
+            return ds[variable][fileStart:fileStop, heightIdx, ySlice, xSlice]
+    finally:
+        ds.close()
+
+def _storeValues(out, values):
+    """Copies read values into out, with masked values as NaN"""
+    out[:] = np.ma.getdata(values)
+    if np.ma.is_masked(values): out[np.ma.getmaskarray(values)] = np.nan
+
+def _readSegmentMapped(path, shape, dtype, segment, variable, heightIdx, ySlice, xSlice):
+    """Reads a segment into an output which is mapped from a scratch file (runs
+    in a worker process)"""
+    source, fileStart, fileStop, outStart = segment
+    values = _readValues(source, variable, heightIdx, fileStart, fileStop, ySlice, xSlice)
+    output = np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+    _storeValues(output[outStart:outStart+fileStop-fileStart], values)
+    output.flush()
+
+# Scratch files for concurrent reads are made in memory where possible
+_SCRATCH_DIR = "/dev/shm" if isdir("/dev/shm") else None
+
+# The worker processes for concurrent reads, as (pid, workers, executor)
+_READ_POOL = None
+_READ_POOL_LOCK = Lock()
+
+def _readPool(workers):
+    """Returns the pool of worker processes for concurrent reads
+
+    * The pool is kept for later reads, and is only made again when another
+      number of workers is asked for, or in a forked process
+    """
+    global _READ_POOL
+    with _READ_POOL_LOCK:
+        if not _READ_POOL is None and _READ_POOL[:2] != (getpid(), workers):
+            if _READ_POOL[0] == getpid(): _READ_POOL[2].shutdown()
+            _READ_POOL = None
+        if _READ_POOL is None:
+            from concurrent.futures import ProcessPoolExecutor
+            _READ_POOL = (getpid(), workers, ProcessPoolExecutor(workers))
+        return _READ_POOL[2]
+
+def _shutdownReadPool():
+    """Stops the worker processes for concurrent reads, if there are any"""
+    global _READ_POOL
+    with _READ_POOL_LOCK:
+        if not _READ_POOL is None and _READ_POOL[0] == getpid(): _READ_POOL[2].shutdown()
+        _READ_POOL = None
+
+def _canReadConcurrently():
+    """Worker processes can not be started from daemonic processes (such as 
+    the workers of a multiprocessing.Pool), and scratch files can only be 
+    removed while they are mapped on POSIX systems"""
+    from multiprocessing import current_process
+    return osName == "posix" and not current_process().daemon
+
+def _readHyperslabs(jobs, workers=1, finish=None):
+    """Reads several (time, lat, lon) hyperslabs, each of which may be spread 
+    over several files, into preallocated arrays
+
+    * jobs is a list of dictionaries with the arguments of _readSegments() 
+      (segments, variable, heightIdx, ySlice, xSlice, shape, dtype, fill)
+    * When workers > 1, the segments of all jobs are read at the same time by
+      a pool of as many worker processes, which write directly into memory 
+      mapped scratch files
+      * The returned arrays are views of the mapped files, which are removed
+        once they are no longer used
+      * Inside daemonic processes, the segments are read one after another
+    * finish is called as finish(i, array) as soon as the i-th job has been
+      read, while other jobs are still being read, and its result is returned
+      in place of the array
+    """
+    tasks = [(i, segment) for i, job in enumerate(jobs) for segment in job["segments"]]
+    remaining = [len(job["segments"]) for job in jobs]
+    results = [None]*len(jobs)
+
+    def done(i, output):
+        if jobs[i].get("fill", False): output[-1] = output[-2]
+        results[i] = output if finish is None else finish(i, output)
+
+    if workers > 1 and len(tasks) > 1 and _canReadConcurrently():
+        from concurrent.futures import as_completed, wait
+        from concurrent.futures.process import BrokenProcessPool
+        from tempfile import mkstemp
+
+        paths, outputs, futures = [], [], {}
+        try:
+            for job in jobs:
+                handle, path = mkstemp(suffix=".read", dir=_SCRATCH_DIR)
+                closeFile(handle)
+                paths.append(path)
+                outputs.append(np.memmap(path, dtype=job.get("dtype", np.float32), mode="w+", shape=tuple(job["shape"])))
+
+            pool = _readPool(workers)
+            for i, segment in tasks:
+                future = pool.submit(_readSegmentMapped, paths[i], outputs[i].shape, outputs[i].dtype.str, segment, 
+                                     jobs[i]["variable"], jobs[i]["heightIdx"], jobs[i]["ySlice"], jobs[i]["xSlice"])
+                futures[future] = i
+            try:
+                for future in as_completed(futures):
+                    future.result() # raises any errors
+                    i = futures[future]
+                    remaining[i] -= 1
+                    if remaining[i] == 0: done(i, outputs[i].view(np.ndarray))
+            except BrokenProcessPool:
+                _shutdownReadPool()
+                raise
+        finally:
+            for future in futures: future.cancel()
+            wait(futures)
+            for path in paths: remove(path) # The mapped memory stays until the outputs are freed
+
+    else:
+        outputs = [np.empty(job["shape"], dtype=job.get("dtype", np.float32)) for job in jobs]
+        for i, (path, fileStart, fileStop, outStart) in tasks:
+            job = jobs[i]
+            with _NC_LOCK:
+                values = _readValues(path, job["variable"], job["heightIdx"], fileStart, fileStop, job["ySlice"], job["xSlice"])
+            _storeValues(outputs[i][outStart:outStart+fileStop-fileStart], values)
+            remaining[i] -= 1
+            if remaining[i] == 0: done(i, outputs[i])
+
+    for i, job in enumerate(jobs): # Jobs without any segments
+        if not job["segments"]: done(i, np.empty(job["shape"], dtype=job.get("dtype", np.float32)))
+    return results
+
+def _readSegments(segments, variable, heightIdx, ySlice, xSlice, shape, dtype=np.float32, fill=False, workers=1):
+    """Reads a (time, lat, lon) hyperslab of a variable which is spread over 
+    several files into a single preallocated array of the given dtype
+
+    * segments is a list of (path, fileStart, fileStop, outputStart) tuples, as
+      made by NCSource._timeSegments()
+    * Masked values become NaN
+    * Segments are read by a pool of worker processes when workers > 1
+    """
+    job = dict(segments=segments, variable=variable, heightIdx=heightIdx, ySlice=ySlice, 
+               xSlice=xSlice, shape=shape, dtype=dtype, fill=fill)
+    return _readHyperslabs([job, ], workers=workers)[0]
+
+def _clipSegments(segments, start, stop):
+    """Clips segments, as made by NCSource._timeSegments(), to the time steps
+    [start, stop) of the time window, and shifts them to begin at start"""
+    clipped = []
+    for path, fileStart, fileStop, outStart in segments:
+        lo, hi = max(outStart, start), min(outStart+fileStop-fileStart, stop)
+        if lo < hi: clipped.append( (path, fileStart+lo-outStart, fileStart+hi-outStart, lo-start) )
+    return clipped
+
+def _timeChunks(timeN, chunk):
+    """Splits the time steps [0, timeN) into (start, stop) chunks of at most 
+    'chunk' steps, but never leaves a single step to be forward filled"""
+    starts = list(range(0, timeN, int(max(2, chunk))))
+    if len(starts) > 1 and timeN-starts[-1] < 2: starts.pop()
+    return list(zip(starts, starts[1:]+[timeN]))
+
+def _selectOutput(func, i, *inputs):
+    """Computes one of the outputs of a function with several outputs"""
+    return func(*inputs)[i]
+
+class _LazyVariable(object):
+    """A handle to a (time, lat, lon) variable which is only read from its
+    netCDF4 file once specific grid cells are requested"""
+    BLOCK_SIZE = 16
+
+    def __init__(s, segments, variable, latStart, lonStart, shape, dtype=np.float32, heightIdx=None, processor=None, fill=False):
+        s.segments = segments
+        s.dtype = dtype
+        s.variable = variable
+        s.latStart = latStart
+        s.lonStart = lonStart
+        s.shape = shape
+        s.heightIdx = heightIdx
+        s.processor = processor
+        s.fill = fill
+
+    @property
+    def ndim(s): return 3
+
+    def subset(s, ySlice, xSlice):
+        """Makes a handle to a rectangular part of the variable's working grid"""
+        out = copy(s)
+        out.latStart = s.latStart+ySlice.start
+        out.lonStart = s.lonStart+xSlice.start
+        out.shape = (s.shape[0], ySlice.stop-ySlice.start, xSlice.stop-xSlice.start)
+        return out
+
+    def read(s, ySlice, xSlice):
+        """Reads a rectangular (time, lat, lon) hyperslab of the working grid"""
+        ys = slice(s.latStart+ySlice.start, s.latStart+ySlice.stop)
+        xs = slice(s.lonStart+xSlice.start, s.lonStart+xSlice.stop)
+        shape = (s.shape[0], ys.stop-ys.start, xs.stop-xs.start)
+
+        tmp = _readSegments(s.segments, s.variable, s.heightIdx, ys, xs, shape, dtype=s.dtype, fill=s.fill)
+        if not s.processor is None:
+            tmp = np.asarray(s.processor(tmp), dtype=s.dtype)
+        return tmp
+
+    def take(s, yi, xi):
+        """Extracts the time series at the given cells of the working grid as a
+        (time, cells) matrix
+
+        Cells are grouped into square blocks of the working grid, and each group
+        is read with a single hyperslab read spanning only the cells within it
+        """
+        yi = np.asarray(yi, dtype=int)
+        xi = np.asarray(xi, dtype=int)
+        if yi.size == 0: return np.empty((s.shape[0], 0))
+
+        blocks = (yi//s.BLOCK_SIZE)*(s.shape[2]//s.BLOCK_SIZE+1) + xi//s.BLOCK_SIZE
+        order = np.argsort(blocks, kind="mergesort")
+        splits = np.flatnonzero(np.diff(blocks[order]))+1
+
+        output = None
+        for members in np.split(order, splits):
+            y0, y1 = yi[members].min(), yi[members].max()+1
+            x0, x1 = xi[members].min(), xi[members].max()+1
+
+            box = s.read(slice(y0,y1), slice(x0,x1))
+            if output is None:
+                output = np.empty((box.shape[0], yi.size), dtype=np.result_type(box.dtype, np.float32))
+            output[:, members] = np.ma.filled(box[:, yi[members]-y0, xi[members]-x0], np.nan)
+
+        return output
+
+class _QuantizedVariable(_LazyVariable):
+    """A variable which is held in memory as 16-bit integers with a scale and
+    offset, and is only decoded for the cells which are requested"""
+    MISSING = -32768
+
+    def __init__(s, packed, scale, offset, dtype=np.float32):
+        s.packed = packed
+        s.scale = scale
+        s.offset = offset
+        s.dtype = dtype
+        
+    @property
+    def shape(s): return s.packed.shape
+
+    @staticmethod
+    def encode(data, dtype=np.float32, chunk=256):
+        """Packs a float matrix into 16-bit integers, with NaN kept as MISSING
+
+        * The scale and offset spread the data's range over all other values,
+          so the rounding error is at most 1/131070th of the range
+        * The data is packed a few time steps at a time to limit temporary memory
+        """
+        lo, hi = np.nanmin(data), np.nanmax(data)
+        if not np.isfinite(lo): lo, hi = 0, 0
+        offset = (float(hi)+float(lo))/2
+        scale = (float(hi)-float(lo))/65534 if hi > lo else 1.0
+
+        packed = np.empty(data.shape, dtype=np.int16)
+        for t in range(0, data.shape[0], chunk):
+            tmp = (data[t:t+chunk]-offset)/scale
+            missing = np.isnan(tmp)
+            tmp[missing] = 0
+            packed[t:t+chunk] = np.round(tmp)
+            packed[t:t+chunk][missing] = _QuantizedVariable.MISSING
+
+        return _QuantizedVariable(packed, scale, offset, dtype=dtype)
+
+    def decode(s, packed):
+        """Decodes packed values into the variable's dtype"""
+        out = packed.astype(s.dtype)
+        out *= s.scale
+        out += s.offset
+        out[packed == s.MISSING] = np.nan
+        return out
+
+    def subset(s, ySlice, xSlice):
+        return _QuantizedVariable(s.packed[:, ySlice, xSlice], s.scale, s.offset, dtype=s.dtype)
+
+    def take(s, yi, xi):
+        return s.decode(s.packed[:, yi, xi])
+
+    def read(s, ySlice, xSlice):
+        return s.decode(s.packed[:, ySlice, xSlice])
+
+class _DerivedVariable(_LazyVariable):
+    """A lazy variable which is computed from other lazy variables as they
+    are read"""
+    def __init__(s, func, inputs, **kwargs):
+        s.func = func
+        s.inputs = inputs
+        s.kwargs = kwargs
+        s.shape = inputs[0].shape
+
+    def subset(s, ySlice, xSlice):
+        inputs = [i.subset(ySlice, xSlice) if isinstance(i, _LazyVariable) else i[:, ySlice, xSlice] for i in s.inputs]
+        return _DerivedVariable(s.func, inputs, **s.kwargs)
+
+    def read(s, ySlice, xSlice):
+        data = [i.read(ySlice, xSlice) if isinstance(i, _LazyVariable) else i[:, ySlice, xSlice] for i in s.inputs]
+        return s.func(*data, **s.kwargs)
+
+class _Catalog(object):
+    """Metadata of netCDF4 files, which can be persisted to a JSON sidecar file
+    so that the files do not need to be scanned again
+
+    * Entries are keyed by the absolute path of each file, and are discarded 
+      when the file's size or modification time changes
+    * Each entry holds the shape, units, standard name, and dimensions of the
+      file's variables, as well as any coordinate arrays and decoded time indices 
+      which have been requested
+    """
+    def __init__(s, path=None):
+        s.path = path
+        s.changed = False
+        s.entries = dict()
+
+        if not path is None and isfile(path):
+            with open(path) as fi:
+                s.entries = json.load(fi)
+
+    def info(s, src):
+        """Returns the catalog entry of a file, scanning it if needed"""
+        key = abspath(src)
+        entry = s.entries.get(key)
+        if entry is None or entry["size"] != getsize(src) or entry["mtime"] != getmtime(src):
+            ds = nc.Dataset(src, keepweakref=True)
+            variables = OrderedDict()
+            for var in ds.variables:
+                try: unit = ds[var].units
+                except: unit = "Unknown"
+                
+                try: name = ds[var].standard_name
+                except: name = "Unknown"
+
+                variables[var] = [list(ds[var].shape), unit, name, list(ds[var].dimensions)]
+            ds.close()
+            
+            entry = dict(size=getsize(src), mtime=getmtime(src), variables=variables, arrays=dict(), times=dict())
+            s.entries[key] = entry
+            s.changed = True
+        return entry
+
+    def array(s, src, var):
+        """Returns the full array of a (coordinate) variable in a file"""
+        entry = s.info(src)
+        if not var in entry["arrays"]:
+            ds = nc.Dataset(src, keepweakref=True)
+            values = ds[var][:]
+            ds.close()
+
+            entry["arrays"][var] = [values.dtype.str, np.ma.getdata(values).tolist()]
+            s.changed = True
+
+        dtype, values = entry["arrays"][var]
+        return np.array(values, dtype=dtype)
+
+    def times(s, src, var):
+        """Returns the decoded time index of a time variable in a file"""
+        entry = s.info(src)
+        if not var in entry["times"]:
+            ds = nc.Dataset(src, keepweakref=True)
+            timeVar = ds[var]
+            timeindex = pd.DatetimeIndex(nc.num2date(timeVar[:], timeVar.units))
+            ds.close()
+
+            entry["times"][var] = timeindex.values.astype("datetime64[ns]").astype(np.int64).tolist()
+            s.changed = True
+
+        return pd.DatetimeIndex(np.array(entry["times"][var], dtype="datetime64[ns]"))
+
+    def save(s):
+        """Writes the catalog to its sidecar file, if anything has changed"""
+        if s.path is None or not s.changed: return
+        tmpPath = "%s.%d.tmp"%(s.path, getpid())
+        with open(tmpPath, "w") as fo:
+            json.dump(s.entries, fo)
+        replace(tmpPath, s.path) # So that a reader never sees a partial file
+        s.changed = False
+
+class _ExtractionCache(object):
+    """A sqlite database of extracted time series, so that the same locations 
+    do not need to be extracted again
+
+    * Series are stored as float32, and are keyed by an identifier of the 
+      source, variable, and interpolation, as well as by the location rounded
+      to a millionth of a degree
+    * Only the path is pickled, and each process opens its own connection
+    """
+    def __init__(s, path):
+        s.path = abspath(path)
+        s._conn = None
+
+    def __getstate__(s): return dict(path=s.path)
+
+    def __setstate__(s, state): 
+        s.path = state["path"]
+        s._conn = None
+
+    def _connection(s):
+        if s._conn is None or s._conn[0] != getpid():
+            conn = sqlite3.connect(s.path, timeout=60, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL") # Readers and a writer do not block one another
+            conn.execute("CREATE TABLE IF NOT EXISTS series (key TEXT, lon INTEGER, lat INTEGER, data BLOB, "
+                         "PRIMARY KEY (key, lon, lat)) WITHOUT ROWID")
+            conn.execute("CREATE TEMP TABLE request (i INTEGER, lon INTEGER, lat INTEGER)")
+            conn.commit()
+            s._conn = (getpid(), conn, Lock())
+        return s._conn[1:]
+
+    @staticmethod
+    def _coordinates(lons, lats):
+        return np.round(np.asarray(lons)*1e6).astype(np.int64).tolist(), np.round(np.asarray(lats)*1e6).astype(np.int64).tolist()
+
+    def fetch(s, key, lons, lats, timeN):
+        """Returns a (time, locations) matrix of the stored series, and a mask
+        of the locations which were not found"""
+        lons, lats = s._coordinates(lons, lats)
+        output = np.full((timeN, len(lons)), np.nan, dtype=np.float32)
+        missing = np.ones(len(lons), dtype=bool)
+
+        conn, lock = s._connection()
+        with lock:
+            conn.execute("DELETE FROM request")
+            conn.executemany("INSERT INTO request VALUES (?,?,?)", zip(range(len(lons)), lons, lats))
+            rows = conn.execute("SELECT request.i, series.data FROM request JOIN series ON series.key=? AND "
+                                "series.lon=request.lon AND series.lat=request.lat", (key, )).fetchall()
+
+        for i, data in rows:
+            if len(data) != timeN*4: continue
+            output[:, i] = np.frombuffer(data, dtype=np.float32)
+            missing[i] = False
+        return output, missing
+
+    def store(s, key, lons, lats, values):
+        """Stores the columns of a (time, locations) matrix"""
+        lons, lats = s._coordinates(lons, lats)
+        values = np.ascontiguousarray(np.asarray(values, dtype=np.float32).T)
+
+        conn, lock = s._connection()
+        with lock:
+            conn.executemany("INSERT OR REPLACE INTO series VALUES (?,?,?,?)", 
+                             ((key, lon, lat, v.tobytes()) for lon, lat, v in zip(lons, lats, values)))
+            conn.commit()
+
+_SharedArray = namedtuple("_SharedArray", "name shape dtype")
+
+def _attachSharedArray(desc):
+    """Attaches to a shared memory block, returning the block and an array view
+    on it"""
+    from multiprocessing import shared_memory
+    try:
+        shm = shared_memory.SharedMemory(name=desc.name, track=False)
+    except TypeError: # Python < 3.13 does not know 'track'
+        shm = shared_memory.SharedMemory(name=desc.name)
+    return shm, np.ndarray(desc.shape, dtype=desc.dtype, buffer=shm.buf)
+
+def _processorKey(processor):
+    """Identifies a processor by its code, or returns None if it cannot be 
+    identified (such as partials, callable objects, and functions which capture
+    values or have default arguments)"""
+    if processor is None: return ("none", )
+    if not isinstance(processor, FunctionType): return None
+    if processor.__closure__ or processor.__defaults__ or processor.__kwdefaults__: return None
+    code = processor.__code__
+    return ("code", code.co_code, repr(code.co_consts), code.co_names)
+
+def _saveAggregate(path, aggregate):
+    """Writes an aggregate as a '.npy' file of its means and a JSON file of its
+    time index, which is written last so that incomplete aggregates are not read"""
+    index = aggregate["index"]
+    if isinstance(index, pd.MultiIndex):
+        desc = dict(tuples=[[int(v) for v in t] for t in index], names=list(index.names))
+    else:
+        desc = dict(times=[int(v) for v in index.values.astype("datetime64[ns]").astype(np.int64)], tz=None if index.tz is None else str(index.tz))
+
+    tmpPath = "%s.%d.tmp"%(path, getpid())
+    np.save(tmpPath+".npy", aggregate["data"])
+    replace(tmpPath+".npy", path+".npy")
+    with open(tmpPath, "w") as fo: json.dump(desc, fo)
+    replace(tmpPath, path+".json")
+
+def _loadAggregate(path):
+    """Reads an aggregate written by _saveAggregate()"""
+    with open(path+".json") as fi: desc = json.load(fi)
+    if "tuples" in desc:
+        index = pd.MultiIndex.from_tuples([tuple(t) for t in desc["tuples"]], names=desc["names"])
+    else:
+        index = pd.DatetimeIndex(np.array(desc["times"], dtype="datetime64[ns]"))
+        if not desc["tz"] is None: index = index.tz_localize("UTC").tz_convert(desc["tz"])
+    return dict(data=np.load(path+".npy"), index=index)
+
 class NCSource(object):
     """The NCSource object manages weather data from a generic set of netCDF4 
     file sources"""
+    MAX_READ_WORKERS = 4
+
     def _loadDS(s, path):
         if isinstance(path, str):
             return nc.Dataset(path, keepweakref=True)
@@ -19,7 +601,7 @@ class NCSource(object):
         else:
             raise ResError("Could not understand data source input. Must be a path or a list of paths")
 
-    def __init__(s, source, bounds=None, indexPad=0, timeName="time", latName="lat", lonName="lon", tz=None, _maxLonDiff=0.6, _maxLatDiff=0.6, verbose=True, forwardFill=True):
+    def __init__(s, source, bounds=None, indexPad=0, timeName="time", latName="lat", lonName="lon", tz=None, timeBounds=None, lazy=False, catalog=None, dtype=np.float32, extractionCache=None, _maxLonDiff=0.6, _maxLatDiff=0.6, verbose=True, forwardFill=True):
         """Initialize a generic netCDF4 file source
 
         Note
@@ -56,6 +638,41 @@ class NCSource(object):
             Applies the indicated timezone onto the time axis
             * For example, use "GMT" for unadjusted time
 
+        timeBounds : tuple of length 2, optional
+            Used to employ a slice of the time dimension
+              * Expects two values acceptable to pandas.Timestamp. The first 
+                indicates the point to start collecting data, and the second 
+                indicates the end (both are inclusive)
+              * Only the selected time steps are read when loading variables
+
+        lazy : bool, optional
+            If True, loading a variable only registers a handle to it, and the 
+            data is read from the netCDF4 file when it is retrieved with get()
+              * Only the grid cells needed by the requested locations (and their
+                interpolation stencils) are ever read
+              * Useful when sparse locations are spread over large bounds
+              * Processors given to load() must then act element-wise, since 
+                they are applied to each hyperslab read separately
+
+        dtype : numpy dtype, optional
+            The data type in which loaded variables are held
+              * Masked values are always stored as NaN
+              * Use numpy.float64 if the extra precision is needed, at double
+                the memory
+
+        catalog : str, optional
+            The path to a JSON catalog file in which the metadata of the source
+            files is stored
+              * The variables, coordinates, and time index of each file are 
+                then read from the catalog instead of from the file, as long as
+                the file's size and modification time have not changed
+              * The catalog is created if it does not exist, and is updated 
+                with any files which are not yet in it
+
+        extractionCache : str, optional
+            The path to a sqlite database in which extracted time series are 
+            stored
+              * See NCSource.setExtractionCache()
 
         """
         # Collect sources
@@ -89,27 +706,21 @@ class NCSource(object):
         units = []
         names = []
 
+        cat = _Catalog(catalog)
         for src in sources:
             if verbose: print(src)
-            ds = nc.Dataset(src, keepweakref=True)
-            for var in ds.variables:
+            for var, (shape, unit, name, dims) in cat.info(src)["variables"].items():
+                shape = tuple(shape)
                 if not var in s.variables:
                     s.variables[var] = src
-                    expectedShape[var] = ds[var].shape
-
-                    try: unit = ds[var].units
-                    except: unit = "Unknown"
-                    
-                    try: name = ds[var].standard_name
-                    except: name = "Unknown"
+                    expectedShape[var] = shape
 
                     names.append(name)
                     units.append(unit)
 
                 else:
-                    if ds[var].shape[1:] != expectedShape[var][1:]:
+                    if shape[1:] != expectedShape[var][1:]:
                         raise ResError("Variable %s does not match expected shape %s. From %s"%(var, expectedShape[var], src))
-            ds.close()
 
         tmp = pd.DataFrame(columns=["name","units","path",], index=s.variables.keys())
         tmp["name"] = names
@@ -119,13 +730,8 @@ class NCSource(object):
         s.variables = tmp
         
         # set basic variables
-        ds = nc.Dataset( s.variables["path"][latName] , keepweakref=True)
-        s._allLats = ds[latName][:]
-        ds.close()
-
-        ds = nc.Dataset( s.variables["path"][lonName] , keepweakref=True)
-        s._allLons = ds[lonName][:]
-        ds.close()
+        s._allLats = cat.array(s.variables["path"][latName], latName)
+        s._allLons = cat.array(s.variables["path"][lonName], lonName)
         
         s._maximal_lon_difference=_maxLonDiff
         s._maximal_lat_difference=_maxLatDiff
@@ -142,6 +748,97 @@ class NCSource(object):
             raise ResError("latitude and longitude shapes are not usable")
 
         # set lat and lon selections
+        s._selectWindow(bounds, indexPad)
+
+        # Read working lats/lon
+        if s.dependent_coordinates:
+            s.lats = s._allLats[s._latStart:s._latStop, s._lonStart:s._lonStop]
+            s.lons = s._allLons[s._latStart:s._latStop, s._lonStart:s._lonStop]
+        else:
+            s.lats = s._allLats[s._latStart:s._latStop]
+            s.lons = s._allLons[s._lonStart:s._lonStop]
+
+        # Make a fingerprint which identifies the source files and working grid
+        s._sources = sources
+        fingerprint = [(src, getsize(src), getmtime(src)) for src in sources]
+        fingerprint.append( (int(s._latStart), int(s._latStop), int(s._lonStart), int(s._lonStop)) )
+        s.fingerprint = md5(repr(fingerprint).encode()).hexdigest()
+
+        # Build a spatial index over the working grid so that locations can be
+        # searched in bulk
+        if s.dependent_coordinates:
+            s._buildSpatialIndex()
+        
+        s.extent = gk.Extent(s.lons.min(), s.lats.min(), s.lons.max(), s.lats.max(), srs=gk.srs.EPSG4326)
+
+        # compute time index
+        s.timeName = timeName
+
+        # Files may be split over time (as well as over variables), so the time
+        # index is made from the times of every file
+        fileTimes = OrderedDict()
+        for src in sources:
+            if timeName in cat.info(src)["variables"]:
+                fileTimes[src] = cat.times(src, timeName)
+        s._timeindex_raw = pd.DatetimeIndex(np.unique(np.concatenate([v.values for v in fileTimes.values()])))
+
+        # Map the time steps of each variable to the files which contain them
+        s._fileMap = OrderedDict()
+        for src in sources:
+            for var, (shape, unit, name, dims) in cat.info(src)["variables"].items():
+                if len(dims)==0 or dims[0] != timeName: continue
+                if src in fileTimes: 
+                    start = s._timeindex_raw.searchsorted(fileTimes[src][0])
+                else: # Assume the variable starts with the time index
+                    start = 0
+                s._fileMap.setdefault(var, []).append( (src, start, start+shape[0]) )
+        for var in s._fileMap: s._fileMap[var].sort(key=lambda x: x[1])
+        
+        cat.save()
+
+        # Select the time window
+        if timeBounds is None:
+            s._timeStart = 0
+            s._timeStop = s._timeindex_raw.size
+        else:
+            start, stop = [s._toRawTime(t, tz) for t in timeBounds]
+            if stop < start: raise ResError("The end of timeBounds must not come before its start")
+
+            s._timeStart = s._timeindex_raw.searchsorted(start, side="left")
+            s._timeStop = s._timeindex_raw.searchsorted(stop, side="right")
+            if s._timeStop <= s._timeStart: raise ResError("No time steps found within timeBounds")
+
+        timeindex = s._timeindex_raw[s._timeStart:s._timeStop]
+        if not tz is None:
+            s.timeindex=timeindex.tz_localize(tz)
+        else:
+            s.timeindex=timeindex
+
+        # initialize the data container
+        s.dtype = np.dtype(dtype)
+        s.lazy = lazy
+        s.data = OrderedDict()
+        s.setExtractionCache(extractionCache)
+
+    def setExtractionCache(s, path):
+        """Stores the time series which get(), get_many(), and the methods which
+        rely on them extract in a sqlite database, so that extracting the same 
+        locations again does not touch the weather data
+
+          * Series are identified by the source's files, grid, and time window,
+            as well as by the variable's name, the interpolation, and the 
+            location, so a variable which is loaded with a different processor 
+            under the same name must use a different database
+          * Extracted series are returned as float32 while a cache is used
+          * Combine with lazy=True so that repeated extractions do not read
+            the weather data at all
+          * If path is None, the cache is no longer used
+        """
+        s._extractionCache = None if path is None else _ExtractionCache(path)
+
+    def _selectWindow(s, bounds, indexPad=0):
+        """Sets the bounds, and the start and stop indices of the working grid 
+        within the source's complete grid"""
         if not bounds is None:
             s.bounds = gk.Extent.load(bounds).castTo(4326).xyXY
             if abs(s.bounds[0]-s.bounds[2]) <= 0.625:
@@ -166,7 +863,11 @@ class NCSource(object):
                 s._lonStart =           np.argmin( ( bot | left | top          ).all(0))       - 1 - indexPad
                 s._lonStop  = s._lonN - np.argmin( ( bot |        top  | right ).all(0)[::-1]) + 1 + indexPad
                 s._latStart =           np.argmin( ( bot | left |        right ).all(1))       - 1 - indexPad
-                s._latStop  = s._latN - np.argmax( (       left | top  | right ).all(1)[::-1]) + 1 + indexPad
+                s._latStop  = s._latN - np.argmin( (       left | top  | right ).all(1)[::-1]) + 1 + indexPad
+
+                # Keep the window on the grid when the bounds reach its edges
+                s._lonStart, s._lonStop = max(0, s._lonStart), min(s._lonN, s._lonStop)
+                s._latStart, s._latStop = max(0, s._latStart), min(s._latN, s._latStop)
 
             else:
                 tmp = np.logical_and(s._allLons >= s.bounds[0], s._allLons <= s.bounds[2])
@@ -186,7 +887,7 @@ class NCSource(object):
                 # s._lonStop = np.argmax(s._allLons > s.bounds[2]) + indexPad
                 # s._latStart = np.argmin(s._allLats < s.bounds[1]) - 1 - indexPad
                 # s._latStop = np.argmax(s._allLats > s.bounds[3]) + indexPad
-                
+            
         else:
             s.bounds = None
             s._lonStart = 0
@@ -199,32 +900,14 @@ class NCSource(object):
                 s._lonStop = s._allLons.size
                 s._latStop = s._allLats.size
 
-        # Read working lats/lon
-        if s.dependent_coordinates:
-            s.lats = s._allLats[s._latStart:s._latStop, s._lonStart:s._lonStop]
-            s.lons = s._allLons[s._latStart:s._latStop, s._lonStart:s._lonStop]
-        else:
-            s.lats = s._allLats[s._latStart:s._latStop]
-            s.lons = s._allLons[s._lonStart:s._lonStop]
-        
-        s.extent = gk.Extent(s.lons.min(), s.lats.min(), s.lons.max(), s.lats.max(), srs=gk.srs.EPSG4326)
-
-        # compute time index
-        s.timeName = timeName
-
-        ds = nc.Dataset( s.variables["path"][timeName] , keepweakref=True)
-        timeVar = ds[timeName]
-        timeindex = nc.num2date(timeVar[:], timeVar.units)
-        ds.close()
-        
-        s._timeindex_raw = pd.DatetimeIndex(timeindex)
-        if not tz is None:
-            s.timeindex=s._timeindex_raw.tz_localize(tz)
-        else:
-            s.timeindex=s._timeindex_raw
-
-        # initialize the data container
-        s.data = OrderedDict()
+    @staticmethod
+    def _toRawTime(t, tz=None):
+        """Converts a time value into the (timezone-naive) frame of the raw time 
+        index of a source with the given timezone"""
+        t = pd.Timestamp(t)
+        if not t.tz is None:
+            t = t.tz_convert("UTC" if tz is None else tz).tz_localize(None)
+        return t
 
     def varInfo(s, var):
         """Prints more information about the given parameter"""
@@ -238,18 +921,193 @@ class NCSource(object):
         raise KeyError(str(v))
     
     def pickle(s, path):
-        """Save the source as a pickle file, so it can be quickly reopened later"""
-        with open(path, 'wb') as fo:
-            dump(s, fo)
+        """Save the source to a cache directory, so it can be quickly reopened later
+
+          * Each loaded variable is written as a raw '.npy' file, while the
+            coordinates, time index, bounds and other attributes are written to
+            a small metadata file
+          * Masked values are stored as NaN
+          * Reopen the source with NCSource.fromPickle()
+        """
+        if not isdir(path): makedirs(path)
+
+        state = s.__dict__.copy()
+        state.pop("_indexCache", None)
+        state.pop("_shared", None)
+        state.pop("_attached", None)
+        data = state.pop("data")
+
+        names = list(data.keys())
+        files = OrderedDict()
+        handles = OrderedDict()
+        for i, name in enumerate(names):
+            values = data[name]
+            if isinstance(values, _QuantizedVariable): # write the packed values
+                handles[name] = _QuantizedVariable(None, values.scale, values.offset, dtype=values.dtype)
+                values = values.packed
+            elif isinstance(values, _LazyVariable): # nothing to write
+                handles[name] = values
+                continue
+
+            if np.ma.isMaskedArray(values):
+                values = values.filled(np.nan) if values.dtype.kind == "f" else values.data
+            
+            files[name] = "data_%d.npy"%i
+            np.save(join(path, files[name]), values)
+
+        # The metadata is written last, so that an incomplete cache cannot be opened
+        with open(join(path, "meta.pkl"), 'wb') as fo:
+            dump(dict(cls=type(s), state=state, names=names, files=files, handles=handles), fo)
+
+    def toSharedMemory(s):
+        """Moves the loaded variables into shared memory blocks, so that the 
+        source can be handed to other processes without copying its data
+
+          * When the source is pickled afterwards (as happens when it is given 
+            to a multiprocessing worker) only the names of the blocks are 
+            transferred, and the unpickled source attaches to the same memory
+          * The creating process must call releaseSharedMemory() once all 
+            workers are finished
+          * Lazy variables are left as they are
+
+        Returns
+        -------
+        The source itself
+        """
+        from multiprocessing import shared_memory
+        shared = s.__dict__.setdefault("_shared", OrderedDict())
+
+        for name, data in s.data.items():
+            if name in shared: continue
+            if isinstance(data, _QuantizedVariable): # share the packed values
+                handle, data = data, data.packed
+            elif isinstance(data, _LazyVariable): 
+                continue
+            else:
+                handle = None
+
+            if np.ma.isMaskedArray(data):
+                data = data.filled(np.nan) if data.dtype.kind == "f" else data.data
+            
+            shm = shared_memory.SharedMemory(create=True, size=max(1, data.nbytes))
+            view = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+            view[:] = data
+
+            if handle is None: s.data[name] = view
+            else: s.data[name] = _QuantizedVariable(view, handle.scale, handle.offset, dtype=handle.dtype)
+            shared[name] = shm
+
+        return s
+
+    def releaseSharedMemory(s, keep=True):
+        """Frees the shared memory blocks created by toSharedMemory()
+
+          * If keep is True, the shared variables are first copied back into
+            the source's own memory, otherwise they are removed from the data
+            table
+        """
+        shared = s.__dict__.pop("_shared", OrderedDict())
+        for name, shm in shared.items():
+            data = s.data[name]
+            if not keep: del s.data[name]
+            elif isinstance(data, _QuantizedVariable): data.packed = np.array(data.packed)
+            else: s.data[name] = np.array(data)
+            data = None
+
+            try: shm.close()
+            except BufferError: pass # the data is still referenced elsewhere, 
+                                     # but is freed once those references are gone
+            shm.unlink()
+
+    def __getstate__(s):
+        state = s.__dict__.copy()
+        state.pop("_attached", None)
+        shared = state.pop("_shared", None)
+        if shared:
+            state["data"] = OrderedDict()
+            for name, data in s.data.items():
+                if not name in shared: 
+                    state["data"][name] = data
+                elif isinstance(data, _QuantizedVariable):
+                    desc = _SharedArray(shared[name].name, data.packed.shape, data.packed.dtype.str)
+                    state["data"][name] = _QuantizedVariable(desc, data.scale, data.offset, dtype=data.dtype)
+                else:
+                    state["data"][name] = _SharedArray(shared[name].name, data.shape, data.dtype.str)
+        return state
+
+    def __setstate__(s, state):
+        s.__dict__.update(state)
+        for name, data in s.data.items():
+            if isinstance(data, _SharedArray):
+                shm, s.data[name] = _attachSharedArray(data)
+                s.__dict__.setdefault("_attached", []).append(shm)
+            elif isinstance(data, _QuantizedVariable) and isinstance(data.packed, _SharedArray):
+                shm, data.packed = _attachSharedArray(data.packed)
+                s.__dict__.setdefault("_attached", []).append(shm)
 
     @staticmethod
-    def fromPickle(path):
-        """Load a source from a pickle file"""
-        with open(path, 'rb') as fo:
-            out = load(fo)
+    def fromPickle(path, mmap=True):
+        """Load a source from a cache directory created with NCSource.pickle()
+
+          * If mmap is True, the loaded variables are memory-mapped from their
+            '.npy' files rather than read, so that reopening is nearly instant 
+            and concurrent processes share the same pages in memory
+          * Mapped variables are read-only
+          * Pickle files created by older versions are also accepted
+        """
+        if not isdir(path): # Assume it is a legacy pickle file
+            with open(path, 'rb') as fo:
+                out = load(fo)
+            out._upgradeLegacy()
+            return out
+
+        with open(join(path, "meta.pkl"), 'rb') as fo:
+            meta = load(fo)
+
+        out = meta["cls"].__new__(meta["cls"])
+        out.__dict__.update(meta["state"])
+        out.data = OrderedDict()
+        for name in meta["names"]:
+            if name in meta["files"]:
+                values = np.load(join(path, meta["files"][name]), mmap_mode='r' if mmap else None)
+            if name in meta["handles"]:
+                out.data[name] = meta["handles"][name]
+                if isinstance(out.data[name], _QuantizedVariable): out.data[name].packed = values
+            else:
+                out.data[name] = values
+        
         return out
-    
-    def load(s, variable, name=None, heightIdx=None, processor=None):
+
+    def _upgradeLegacy(s):
+        """Fills in the attributes which sources pickled by older versions lack,
+        as they would be set by __init__ on the same files
+
+          * The time window is the full time index of the pickled source
+          * Every variable is assumed to be in a single file which starts with
+            the time index, as older versions required
+        """
+        if not "_sources" in s.__dict__:
+            s._sources = sorted(set(s.variables["path"]))
+        if not "fingerprint" in s.__dict__:
+            fingerprint = [(src, getsize(src), getmtime(src)) if isfile(src) else (src, ) for src in s._sources]
+            fingerprint.append( (int(s._latStart), int(s._latStop), int(s._lonStart), int(s._lonStop)) )
+            s.fingerprint = md5(repr(fingerprint).encode()).hexdigest()
+        if s.dependent_coordinates and not "_kdtree" in s.__dict__:
+            s._buildSpatialIndex()
+        if not "_fileMap" in s.__dict__:
+            s._fileMap = OrderedDict()
+            timeN = s._timeindex_raw.shape[0]
+            for var, path, shape in zip(s.variables.index, s.variables["path"], s.variables["shape"]):
+                if len(shape) > 2 and shape[0] == timeN: s._fileMap[var] = [(path, 0, timeN), ]
+        if not "_timeStart" in s.__dict__:
+            s._timeStart = 0
+            s._timeStop = s._timeindex_raw.shape[0]
+        if not "dtype" in s.__dict__: s.dtype = np.dtype(np.float32)
+        if not "lazy" in s.__dict__: s.lazy = False
+        if not "fill" in s.__dict__: s.fill = True
+        if not "_extractionCache" in s.__dict__: s.setExtractionCache(None)
+
+    def load(s, variable, name=None, heightIdx=None, processor=None, quantize=False):
         """Load a variable into the source's data table
 
         Parameters
@@ -272,40 +1130,377 @@ class NCSource(object):
             the loaded data table
               * This function must take a single matrix argument with dimensions 
                 (time, lat, lon), and must return a matrix of the same shape
+              * The matrix is newly read and can be modified in place, which 
+                saves memory
               * Example:If the NC file has temperature in Kelvin and you need C:
                   processor = lambda x: x+273.15
 
+        quantize : bool, optional
+            If True, the variable is held as 16-bit integers with a scale and
+            offset, which takes half (or a quarter of) the memory
+              * Values are only decoded for the cells which get() extracts
+              * The rounding error is at most 1/131070th of the variable's 
+                range, which is far below the precision of weather data
+              * Not available for lazy sources
+
+        Note
+        ----
+        If the variable is split over time across several files (such as daily
+        files), the files are read concurrently and joined along the time axis
         """
         
-        # read the data
-        ds = nc.Dataset(s.variables["path"][variable], keepweakref=True)
-        var = ds[variable]
+        if name is None: name = variable
+        s.data[name] = s._read(variable, heightIdx=heightIdx, processor=processor, quantize=quantize)
 
-        if heightIdx is None:
-            tmp = var[ : ,s._latStart:s._latStop,s._lonStart:s._lonStop]
+    def loadMany(s, variables, workers=None):
+        """Load several variables into the source's data table at once
+
+        * The files of all variables are read at the same time by worker 
+          processes, each with its own file handles
+        * Inside daemonic processes (such as the workers of a 
+          multiprocessing.Pool) the files are read one after another
+        * Processors are applied as soon as their variables have been read, 
+          while other variables are still being read
+
+        Parameters
+        ----------
+        variables : list
+            The variables to load
+              * Each entry is either a variable name, or a dictionary of keyword 
+                arguments for load()
+              * When an entry's variable is a list of variables, they are read 
+                along with the others, and the processor combines them as 
+                processor(*variables)
+              * Example: ["U2M", dict(variable="PS", name="pressure"),
+                          dict(variable=["U2M", "V2M"], name="windspeed", 
+                               processor=lambda u,v: np.sqrt(u*u+v*v))]
+
+        workers : int, optional
+            The most files to read at the same time
+              * If None, NCSource.MAX_READ_WORKERS is used
+        """
+        requests = [dict(variable=v) if isinstance(v, str) else dict(v) for v in variables]
+        for r in requests:
+            r["variable"] = [r["variable"], ] if isinstance(r["variable"], str) else list(r["variable"])
+            if len(r["variable"]) > 1 and r.get("processor", None) is None:
+                raise ResError("A processor is needed to combine the variables %s"%", ".join(r["variable"]))
+        names = [r.pop("name", None) or r["variable"][0] for r in requests]
+        if workers is None: workers = s.MAX_READ_WORKERS
+
+        if s.lazy:
+            results = []
+            for r in requests:
+                if len(r["variable"]) == 1: 
+                    results.append(s._read(r["variable"][0], **{k:v for k,v in r.items() if k != "variable"}))
+                elif r.get("quantize", False): 
+                    raise ResError("Lazy variables cannot be quantized")
+                else: 
+                    inputs = [s._read(v, heightIdx=r.get("heightIdx", None)) for v in r["variable"]]
+                    results.append(_DerivedVariable(r["processor"], inputs))
         else:
-            tmp = var[ : ,heightIdx,s._latStart:s._latStop,s._lonStart:s._lonStop]
+            # Each request is finished once all of its variables have been read
+            owners = [(k, j) for k, r in enumerate(requests) for j in range(len(r["variable"]))]
+            jobs = [s._readJob(requests[k]["variable"][j], requests[k].get("heightIdx", None)) for k, j in owners]
+            inputs = [[None]*len(r["variable"]) for r in requests]
+            results = [None]*len(requests)
+
+            def finish(i, tmp):
+                k, j = owners[i]
+                inputs[k][j] = tmp
+                if all(v is not None for v in inputs[k]):
+                    results[k] = s._finishRead(inputs[k], requests[k].get("processor", None), requests[k].get("quantize", False))
+                    inputs[k] = None
+
+            _readHyperslabs(jobs, workers=workers, finish=finish)
+
+        # Add in the order of the request
+        for name, tmp in zip(names, results):
+            s.data[name] = tmp
+
+    def loadDerived(s, variables, func, name, heightIdx=None, maxMemory=256e6):
+        """Computes new variables from variables in the source files, and adds
+        them to the data table without loading the variables themselves
+
+          * The variables are read in chunks of time steps, and the outputs of
+            func are written into arrays which are allocated once, so the peak
+            memory is about the size of the outputs plus a chunk
+          * The variables of each chunk are read at the same time, as in 
+            loadMany()
+          * For lazy sources, the outputs are lazy and func is applied to each 
+            hyperslab as it is read, so func must act element-wise
+
+        Parameters
+        ----------
+        variables : list of str
+            The variables to read
+
+        func : function
+            Computes the new variable(s) from a chunk of the variables, as
+            func(*variables)
+              * The chunks are newly read and can be modified in place
+              * When several names are given, func must return a tuple with one
+                matrix for each name
+
+        name : str or list of str
+            The name(s) to give to the outputs in the data table
+
+        heightIdx : int, optional
+            The height index of the variables, as for load()
+
+        maxMemory : numeric, optional
+            The most bytes to read at once
+
+        Example
+        -------
+        The wind speed from wind components:
+            >>> source.loadDerived(["U50M", "V50M"], lambda u,v: np.sqrt(u*u+v*v), "windspeed")
+        """
+        single = isinstance(name, str)
+        names = [name, ] if single else list(name)
+
+        if s.lazy:
+            inputs = [s._read(v, heightIdx=heightIdx) for v in variables]
+            for i, n in enumerate(names):
+                s.data[n] = _DerivedVariable(func if single else partial(_selectOutput, func, i), inputs)
+            return
+
+        timeN = s.timeindex.shape[0]
+        cellShape = (s._latStop-s._latStart, s._lonStop-s._lonStart)
+        segments = [s._timeSegments(v) for v in variables]
+        outputs = [np.empty((timeN, )+cellShape, dtype=s.dtype) for n in names]
+
+        chunk = maxMemory//(cellShape[0]*cellShape[1]*s.dtype.itemsize*len(variables))
+        for start, stop in _timeChunks(timeN, chunk):
+            jobs = [dict(segments=_clipSegments(segs, start, stop), variable=v, heightIdx=heightIdx, 
+                         ySlice=slice(s._latStart, s._latStop), xSlice=slice(s._lonStart, s._lonStop), 
+                         shape=(stop-start, )+cellShape, dtype=s.dtype, fill=fill and stop == timeN)
+                    for v, (segs, fill) in zip(variables, segments)]
+            data = _readHyperslabs(jobs, workers=s.MAX_READ_WORKERS)
+            results = func(*data)
+            if single: results = (results, )
+            for output, result in zip(outputs, results):
+                output[start:stop] = result
+
+        for n, output in zip(names, outputs):
+            s.data[n] = output
+
+    AGGREGATIONS = ["daily", "monthly", "diurnal"]
+
+    def loadAggregate(s, variables, aggregation="monthly", name=None, heightIdx=None, processor=None, 
+                      maxMemory=256e6, cacheDir=None, cacheKey=None):
+        """Computes the temporal mean of a variable over the source's bounds and 
+        time window, and adds it to the data table as "<name>@<aggregation>"
+
+          * The variables are read in chunks of time steps, so the full hourly
+            cube is never held in memory
+          * Results are saved next to the source's first file (or in cacheDir),
+            as a '.npy' file of the means and a JSON file of their time index, 
+            and are reused when the same aggregate is requested again
+          * get() and get_many() extract aggregates like any other variable, 
+            with the aggregate's own time index
+          * NaN values are left out of the means
+
+        Parameters
+        ----------
+        variables : str or list of str
+            The variable(s) to aggregate
+              * When several variables are given, the processor combines them
+
+        aggregation : str, optional
+            The aggregation to compute
+              * "daily" -> The mean of each day
+              * "monthly" -> The mean of each month
+              * "diurnal" -> The mean of each hour of the day, in each month of 
+                the year, indexed by (month, hour)
+              * Days, months, and hours follow the source's timezone
+
+        name : str, optional
+            The name to give to the aggregate, before the "@<aggregation>" suffix
+              * If None, the name of the first variable is used
+
+        heightIdx : int, optional
+            The height index of the variables, as for load()
+
+        processor : function, optional
+            A function which is applied to each chunk of the variables before
+            they are aggregated, as processor(*variables)
+              * Example: The monthly mean wind speed from wind components
+                  source.loadAggregate(["U50M", "V50M"], "monthly", name="windspeed",
+                                       processor=lambda u,v: np.sqrt(u*u+v*v))
+              * Saved aggregates are identified by the processor's code, so the
+                aggregate is only saved if the processor is a plain function 
+                without captured values or default arguments (or if cacheKey is
+                given)
+              * Global values which the processor uses are not part of its code
+
+        maxMemory : numeric, optional
+            The most bytes to read at once
+
+        cacheDir : str, optional
+            The directory to save aggregates in
+
+        cacheKey : str, optional
+            Identifies the processor in saved aggregates, instead of its code
+              * Use this to save aggregates made with partials, callable 
+                objects, or closures
+
+        Returns
+        -------
+        str : The name of the aggregate in the data table
+        """
+        if isinstance(variables, str): variables = [variables, ]
+        if not aggregation in s.AGGREGATIONS:
+            raise ResError("aggregation must be one of: %s"%", ".join(s.AGGREGATIONS))
+        name = "%s@%s"%(name or variables[0], aggregation)
+
+        # Identify the aggregate (unless the processor cannot be identified)
+        processorKey = _processorKey(processor) if cacheKey is None else ("key", cacheKey)
+        if processorKey is None:
+            path = None
+        else:
+            key = [s.fingerprint, s._timeStart, s._timeStop, str(s.timeindex.tz), variables, heightIdx, 
+                   aggregation, name, processorKey]
+            key = md5(repr(key).encode()).hexdigest()
+            if cacheDir is None: cacheDir = dirname(abspath(s._sources[0]))
+            path = join(cacheDir, "%s.%s.aggregate"%(basename(s._sources[0].rstrip("/")), key))
+
+        if not path is None and isfile(path+".json") and isfile(path+".npy"):
+            cached = _loadAggregate(path)
+        else:
+            cached = s._aggregate(variables, aggregation, heightIdx, processor, maxMemory)
+            if not path is None:
+                try:
+                    _saveAggregate(path, cached)
+                except OSError:
+                    pass # The aggregate is still usable, it just is not kept
+
+        s.data[name] = cached["data"]
+        s.__dict__.setdefault("_aggregateIndex", OrderedDict())[name] = cached["index"]
+        return name
+
+    def _aggregate(s, variables, aggregation, heightIdx, processor, maxMemory):
+        """Computes a temporal mean in chunks of time steps"""
+        # Group the time steps by local time
+        local = s.timeindex if s.timeindex.tz is None else s.timeindex.tz_localize(None)
+        if aggregation == "daily": 
+            codes, index = pd.factorize(local.normalize())
+            if not s.timeindex.tz is None: index = index.tz_localize(s.timeindex.tz)
+        elif aggregation == "monthly": 
+            codes, index = pd.factorize(local.to_period("M").to_timestamp())
+            if not s.timeindex.tz is None: index = index.tz_localize(s.timeindex.tz)
+        else: 
+            codes, index = pd.factorize(pd.MultiIndex.from_arrays([local.month, local.hour], names=["month", "hour"]))
+            index = pd.MultiIndex.from_tuples(index, names=["month", "hour"])
+
+        timeN = s.timeindex.size
+        cellShape = (s._latStop-s._latStart, s._lonStop-s._lonStart)
+        sums = np.zeros((index.size, )+cellShape)
+        counts = np.zeros((index.size, )+cellShape, dtype=np.int64)
+        segments = [s._timeSegments(v) for v in variables]
+
+        # Read chunks of time steps
+        chunk = maxMemory//(cellShape[0]*cellShape[1]*s.dtype.itemsize*len(variables))
+        for start, stop in _timeChunks(timeN, chunk):
+            data = [_readSegments(_clipSegments(segs, start, stop), v, heightIdx, 
+                                  slice(s._latStart, s._latStop), slice(s._lonStart, s._lonStop), 
+                                  (stop-start, )+cellShape, dtype=s.dtype, fill=fill and stop == timeN)
+                    for v, (segs, fill) in zip(variables, segments)]
+            data = data[0] if processor is None else processor(*data)
+
+            chunkCodes = codes[start:stop]
+            for code in np.unique(chunkCodes):
+                values = data[chunkCodes == code]
+                valid = ~np.isnan(values)
+                sums[code] += np.where(valid, values, 0).sum(0)
+                counts[code] += valid.sum(0)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = (sums/counts).astype(s.dtype)
+        return dict(data=means, index=index)
+
+    def _read(s, variable, heightIdx=None, processor=None, quantize=False):
+        """Reads a variable over the source's bounds and time window, or makes a
+        lazy handle to it"""
+        if s.lazy: # Only register a handle to the variable
+            if quantize: raise ResError("Lazy variables cannot be quantized")
+            segments, fill = s._timeSegments(variable)
+            shape = (s.timeindex.shape[0], s._latStop-s._latStart, s._lonStop-s._lonStart)
+            return _LazyVariable(segments, variable, s._latStart, s._lonStart, shape, dtype=s.dtype,
+                                 heightIdx=heightIdx, processor=processor, fill=fill)
+
+        tmp = _readHyperslabs([s._readJob(variable, heightIdx), ], workers=s.MAX_READ_WORKERS)[0]
+        return s._finishRead([tmp, ], processor, quantize)
+
+    def _readJob(s, variable, heightIdx=None):
+        """Describes the read of a variable over the source's bounds and time 
+        window, as a job for _readHyperslabs()"""
+        # Find the files which hold the variable over the time window
+        segments, fill = s._timeSegments(variable)
+        shape = (s.timeindex.shape[0], s._latStop-s._latStart, s._lonStop-s._lonStart)
+        return dict(segments=segments, variable=variable, heightIdx=heightIdx, ySlice=slice(s._latStart, s._latStop), 
+                    xSlice=slice(s._lonStart, s._lonStop), shape=shape, dtype=s.dtype, fill=fill)
+
+    def _finishRead(s, inputs, processor=None, quantize=False):
+        """Processes and quantizes variables which have just been read, where 
+        the processor combines several inputs as processor(*inputs)"""
+        # process, maybe? (the result is kept in the source's dtype)
+        if processor is None:
+            tmp = inputs[0]
+        else:
+            tmp = np.asarray(processor(*inputs), dtype=s.dtype)
+
+        if quantize:
+            tmp = _QuantizedVariable.encode(tmp, dtype=s.dtype)
+
+        return tmp
+
+    def _timeSegments(s, variable):
+        """Finds the parts of each file which hold a variable within the 
+        source's time window
+
+        Returns
+        -------
+        tuple : (segments, fill)
+            * segments is a list of (path, fileStart, fileStop, outputStart) 
+              tuples, where the file's time steps [fileStart, fileStop) belong
+              at outputStart within the time window
+            * fill is True if the last time step is missing and should be 
+              forward filled
+        """
+        if not variable in s._fileMap:
+            raise ResError("Variable %s does not have a time dimension called '%s'"%(variable, s.timeName))
+
+        segments = []
+        covered = np.zeros(s.timeindex.shape[0], dtype=bool)
+        for path, start, stop in s._fileMap[variable]:
+            lo, hi = max(start, s._timeStart), min(stop, s._timeStop)
+            if lo >= hi: continue
+
+            segments.append( (path, lo-start, hi-start, lo-s._timeStart) )
+            covered[lo-s._timeStart:hi-s._timeStart] = True
 
-        # process, maybe?
-        if not processor is None:
-            tmp = processor(tmp)
-        
         # forward fill the last time step since it can sometimes be missing
-        if not tmp.shape[0] == s._timeindex_raw.shape[0]:
+        fill = False
+        if not covered.all():
             if not s.fill:
-                raise ResError("Time mismatch with variable %s. Expected %d, got %d"%(variable, s.timeindex.shape[0], tmp.shape[0]))
-            
-            lastTimeIndex = nc.num2date( ds[s.timeName][-1], ds[s.timeName].units )
-            
-            if not lastTimeIndex in s._timeindex_raw: raise ResError("Filling is only intended to fill the last missing hour")
-            tmp = np.append( tmp, tmp[np.newaxis, -1, :, :], axis=0) 
+                raise ResError("Time mismatch with variable %s. Expected %d, got %d"%(variable, covered.size, covered.sum()))
+            if covered.size < 2 or covered[-1] or not covered[:-1].all():
+                raise ResError("Filling is only intended to fill the last missing hour")
+            fill = True
 
-        # save the data
-        if name is None: name = variable
-        s.data[name] = tmp
+        return segments, fill
 
-        # Clean up
-        ds.close()
+    def _derive(s, func, *names, **kwargs):
+        """Computes a new variable from loaded variables as func(*variables, **kwargs)
+
+          * If any of the variables is lazy, the result is also lazy and func is
+            applied to each hyperslab as it is read, so func must act element-wise
+        """
+        inputs = [s.data[n] for n in names]
+        if any(isinstance(i, _LazyVariable) for i in inputs):
+            return _DerivedVariable(func, inputs, **kwargs)
+        else:
+            return func(*inputs, **kwargs)
 
     def addData(s, name, data):
         """Manually add a variable to the loaded data table
@@ -330,7 +1525,125 @@ class NCSource(object):
         # Add to data
         s.data[name] = data
 
-    def loc2Index(s, loc, outsideOkay=False, asInt=True):
+    def subset(s, bounds, indexPad=0):
+        """Makes a new source over a part of this source's working grid, without
+        copying or re-reading any data
+
+          * The new source's lats, lons, and loaded variables are views into this
+            source's arrays, so changing them in place changes both sources
+          * The window is selected as when a source is opened with the same 
+            bounds and indexPad, and is then clipped to this source's window
+          * Lazy and quantized variables stay lazy and quantized
+
+        Parameters
+        ----------
+        bounds : Anything acceptable to geokit.Extent.load()
+            The boundaries of the new source
+
+        indexPad : int, optional
+            The number of extra grid cells to include around the bounds
+
+        Returns
+        -------
+        NCSource
+        """
+        out = copy(s)
+        for key in ["_indexCache", "_shared", "_attached", "_kdtree"]: out.__dict__.pop(key, None)
+        out._selectWindow(bounds, indexPad)
+
+        out._latStart, out._latStop = max(out._latStart, s._latStart), min(out._latStop, s._latStop)
+        out._lonStart, out._lonStop = max(out._lonStart, s._lonStart), min(out._lonStop, s._lonStop)
+        if out._latStart >= out._latStop or out._lonStart >= out._lonStop:
+            raise ResError("The bounds do not overlap the source's working grid")
+
+        # Slices of the new window within this source's window
+        ys = slice(out._latStart-s._latStart, out._latStop-s._latStart)
+        xs = slice(out._lonStart-s._lonStart, out._lonStop-s._lonStart)
+        if s.dependent_coordinates:
+            out.lats = s.lats[ys, xs]
+            out.lons = s.lons[ys, xs]
+        else:
+            out.lats = s.lats[ys]
+            out.lons = s.lons[xs]
+
+        if "_aggregateIndex" in s.__dict__: out._aggregateIndex = OrderedDict(s._aggregateIndex)
+        out.data = OrderedDict()
+        for name, data in s.data.items():
+            out.data[name] = data.subset(ys, xs) if isinstance(data, _LazyVariable) else data[:, ys, xs]
+
+        window = (int(out._latStart), int(out._latStop), int(out._lonStart), int(out._lonStop))
+        out.fingerprint = md5(repr([s.fingerprint, window]).encode()).hexdigest()
+        if out.dependent_coordinates:
+            out._buildSpatialIndex()
+        out.extent = gk.Extent(out.lons.min(), out.lats.min(), out.lons.max(), out.lats.max(), srs=gk.srs.EPSG4326)
+
+        return out
+
+    def tileLocations(s, locations, memoryBudget, variables=1, pad=0, indexPad=0):
+        """Splits locations into tiles of the grid, so that a source which is 
+        opened around the locations of any one tile holds no more than the 
+        given number of bytes 
+
+          * Tiles start as squares of grid cells which would fit the budget, 
+            and are halved until the window which is selected around their 
+            locations (including the padding) fits
+          * Empty tiles are skipped
+
+        Parameters
+        ----------
+        locations : Anything acceptable by geokit.LocationSet
+            The locations to split
+
+        memoryBudget : numeric
+            The most bytes which the loaded variables of each tile may use
+
+        variables : int, optional
+            The number of (time, lat, lon) variables which are held at once 
+            when a tile is loaded
+
+        pad : numeric, optional
+            The padding, in degrees, which is added to the extent of each tile's
+            locations when it is opened
+
+        indexPad : int, optional
+            The indexPad with which each tile is opened
+
+        Returns
+        -------
+        list of geokit.LocationSet
+        """
+        locations = LocationSet(locations)
+        itemsize = np.dtype(np.float32 if s.dtype is None else s.dtype).itemsize
+        maxCells = memoryBudget/(s.timeindex.size*itemsize*variables)
+
+        # Start from squares of the grid which would fit the budget without padding
+        idx = s.loc2IndexSet(locations)
+        size = max(1, int(np.sqrt(maxCells)))
+        tiles = (idx.yi//size)*(s._lonN//size+1) + idx.xi//size
+        order = np.argsort(tiles, kind="mergesort")
+        queue = np.split(order, np.flatnonzero(np.diff(tiles[order]))+1)
+
+        # Halve tiles until the window which would be opened around them fits
+        window = copy(s)
+        output = []
+        while queue:
+            members = queue.pop(0)
+            window._selectWindow(Extent.fromLocationSet(LocationSet(locations[members])).pad(pad), indexPad)
+            cells = (window._latStop-window._latStart)*(window._lonStop-window._lonStart)
+
+            if cells <= maxCells: 
+                output.append(LocationSet(locations[members]))
+            elif members.size == 1:
+                raise ResError("A memory budget of %d bytes is too small for a single tile"%memoryBudget)
+            else:
+                yi, xi = idx.yi[members], idx.xi[members]
+                axis = yi if np.ptp(yi) >= np.ptp(xi) else xi
+                members = members[np.argsort(axis, kind="mergesort")]
+                queue[0:0] = [members[:members.size//2], members[members.size//2:]]
+
+        return output
+
+    def loc2Index(s, loc, outsideOkay=False, asInt=True, _asSet=False):
         """Returns the closest X and Y indexes corresponding to a given location 
         or set of locations
 
@@ -356,8 +1669,8 @@ class NCSource(object):
             * y index can be accessed with '.yi'
             * x index can be accessed with '.xi'
 
-        If multiple locations are given: list
-            * Format: [ (yIndex1, xIndex1), (yIndex2, xIndex2), ...]
+        If multiple locations are given: IndexSet
+            * Behaves like [ (yIndex1, xIndex1), (yIndex2, xIndex2), ...]
             * Order matches the given order of locations
 
         """
@@ -365,63 +1678,192 @@ class NCSource(object):
         locations = LocationSet(loc)
 
         # get closest indices
-        idx = []
-        for lat,lon in zip(locations.lats, locations.lons):
-            # Check the distance
-            latDist = lat-s.lats
-            lonDist = lon-s.lons
-            
-            # Get the best indices 
-            if s.dependent_coordinates:
-                dist = lonDist*lonDist+latDist*latDist
-                latI,lonI = np.unravel_index(np.argmin(dist),dist.shape)
-
-                latDists = []
-                if latI<s._latN-1: latDists.append( (s.lats[latI+1,lonI]-s.lats[latI,lonI]) )
-                if latI>0        : latDists.append( (s.lats[latI,lonI]-s.lats[latI-1,lonI]) )
-                latDistI = latDist[latI,lonI]/np.mean(latDists)
-
-                lonDists = []
-                if lonI<s._lonN-1: lonDists.append( (s.lons[latI,lonI+1]-s.lons[latI,lonI]) )
-                if lonI>0        : lonDists.append( (s.lons[latI,lonI]-s.lons[latI,lonI-1]) )
-                lonDistI = lonDist[latI,lonI]/np.mean(lonDists)
-
-            else:
-                lonI = np.argmin(np.abs(lonDist))
-                latI = np.argmin(np.abs(latDist))
-
-                latDists = []
-                if latI<s._latN-1: latDists.append( (s.lats[latI+1]-s.lats[latI]) )
-                if latI>0        : latDists.append( (s.lats[latI]-s.lats[latI-1]) )
-                latDistI = latDist[latI]/np.mean(latDists)
-
-                lonDists = []
-                if lonI<s._latN-1: lonDists.append( (s.lons[lonI+1]-s.lons[lonI]) )
-                if lonI>0        : lonDists.append( (s.lons[lonI]-s.lons[lonI-1]) )
-                lonDistI = lonDist[lonI]/np.mean(lonDists)
-
-            # Check for out of bounds
-            if np.abs(latDistI) > s._maximal_lat_difference or np.abs(lonDistI) > s._maximal_lon_difference:
-                if not outsideOkay:
-                    raise ResError("(%f,%f) are outside the boundaries"%(lat,lon))
-                else:
-                    idx.append(None)
-                    continue
+        if s.dependent_coordinates:
+            latI, lonI, latDistI, lonDistI = s._locateOnCurvilinearGrid(locations.lats, locations.lons)
+        else:
+            latI, latDistI = s._locateOnAxis(s.lats, locations.lats)
+            lonI, lonDistI = s._locateOnAxis(s.lons, locations.lons)
 
-            # As int?
-            if not asInt:
-                latI = latI+latDistI
-                lonI = lonI+lonDistI
-            
-            # append
-            idx.append( Index(yi=latI,xi=lonI) )
+        # Check for out of bounds
+        outside = (np.abs(latDistI) > s._maximal_lat_difference) | (np.abs(lonDistI) > s._maximal_lon_difference)
+        if outside.any() and not outsideOkay:
+            lat, lon = locations.lats[outside][0], locations.lons[outside][0]
+            raise ResError("(%f,%f) are outside the boundaries"%(lat,lon))
 
         # Make output
-        if locations.count==1:
+        idx = IndexSet(latI, lonI, latI+latDistI, lonI+lonDistI, valid=~outside, fingerprint=s.fingerprint, asInt=asInt)
+        if locations.count==1 and not _asSet:
             return idx[0]
         else:
             return idx
 
+    def loc2IndexSet(s, loc, outsideOkay=False):
+        """Returns an IndexSet with the closest and the fractional indexes 
+        corresponding to a given location or set of locations
+
+        * Accepts the same inputs as loc2Index
+        * The result can be given directly to get() for the same locations
+        """
+        return s.loc2Index(loc, outsideOkay=outsideOkay, asInt=False, _asSet=True)
+
+    @staticmethod
+    def _locateOnAxis(axis, values):
+        """Finds the closest indices, and the fractional offsets to them, for 
+        many values at once along a sorted 1-dimensional coordinate axis
+
+        * The axis may be ascending or descending, and does not need to be 
+          uniformly spaced
+
+        Returns
+        -------
+        tuple of numpy.ndarray : (I, distI)
+            * I is the integer index of the closest axis point
+            * distI is the offset from that point, given in units of the axis 
+              spacing on the side of the point where the value lies
+        """
+        axis = np.asarray(axis)
+        values = np.asarray(values)
+        if axis.size < 2: raise ResError("At least two coordinate values are needed to locate positions")
+
+        descending = axis[0] > axis[-1]
+        if descending: axis = axis[::-1]
+
+        # Find the axis interval containing each value (the first or last 
+        # interval is used when the value lies beyond the axis)
+        lo = np.clip(np.searchsorted(axis, values)-1, 0, axis.size-2)
+        frac = (values-axis[lo])/(axis[lo+1]-axis[lo])
+
+        # Choose the closest end of the interval
+        upper = frac > 0.5
+        I = lo + upper
+        distI = frac - upper
+
+        if descending: 
+            I = axis.size-1-I
+            distI = -distI
+
+        return I, distI
+
+    def _cachedIndexSet(s, locations, outsideOkay=False):
+        """Returns the IndexSet for the given LocationSet, reusing the result 
+        of a recent call with the same locations when possible"""
+        key = md5(locations.lons.tobytes()+locations.lats.tobytes()).hexdigest(), outsideOkay
+        cache = s.__dict__.setdefault("_indexCache", OrderedDict())
+
+        if not key in cache:
+            cache[key] = s.loc2IndexSet(locations, outsideOkay)
+            if len(cache) > 16: cache.popitem(last=False)
+        return cache[key]
+
+    def _interpolationWeights(s, indicies, interpolation):
+        """Computes the weights which interpolate each valid location in an 
+        IndexSet from the source's grid cells
+
+        * Weights are computed in 'index space' using the fractional indices
+        * 'bilinear' uses the surrounding 2x2 cells of each location, while 
+          'cubic' fits a cubic spline through the surrounding 9x9 cells
+        * The result is stored on the IndexSet so that it can be reused for 
+          other variables
+
+        Returns
+        -------
+        tuple : (cells, weights)
+            * cells holds the flattened grid index of each cell which is used
+            * weights is a sparse matrix with shape (valid locations, cells)
+        """
+        latN, lonN = (s.lats.shape[0], s.lons.shape[-1])
+        key = (interpolation, latN, lonN)
+        if key in indicies._weights: return indicies._weights[key]
+
+        valid = indicies.valid
+        yNodes, yWeights = s._axisWeights(indicies.yf[valid], latN, interpolation)
+        xNodes, xWeights = s._axisWeights(indicies.xf[valid], lonN, interpolation)
+
+        # Combine axes into a (locations, y-nodes, x-nodes) stencil
+        cols = yNodes[:,:,None]*lonN + xNodes[:,None,:]
+        vals = yWeights[:,:,None]*xWeights[:,None,:]
+        rows = np.repeat(np.arange(valid.sum()), vals[0].size)
+
+        # Only keep the cells which are actually used
+        cells, cols = np.unique(cols.ravel(), return_inverse=True)
+        weights = csr_matrix( (vals.ravel(), (rows, cols.ravel())), shape=(valid.sum(), cells.size) )
+
+        indicies._weights[key] = cells, weights
+        return indicies._weights[key]
+
+    @staticmethod
+    def _axisWeights(positions, size, interpolation):
+        """Computes the 1-dimensional interpolation nodes and weights for 
+        fractional positions along a grid axis of the given size
+
+        * Positions must lie on the axis, since values beyond it cannot be 
+          interpolated
+
+        Returns
+        -------
+        tuple of numpy.ndarray : (nodes, weights)
+            * Both have the shape (positions, stencil size)
+        """
+        if size < 2 or (positions < -1e-6).any() or (positions > size-1+1e-6).any(): 
+            raise ResError("Insufficient data. Try expanding the boundary of the extracted data")
+        positions = np.clip(positions, 0, size-1) # Only removes rounding errors
+
+        if interpolation == "bilinear":
+            start = np.minimum(np.floor(positions).astype(int), size-2)
+            t = positions-start
+            weights = np.column_stack([1-t, t])
+            n = 2
+
+        elif interpolation == "cubic":
+            n = min(9, size)
+            start = np.clip(np.round(positions).astype(int)-4, 0, size-n)
+
+            # The weights of each node are the spline which interpolates a unit
+            # value at that node
+            basis = make_interp_spline(np.arange(n), np.eye(n), k=min(3,n-1))
+            weights = basis(positions-start)
+
+        else:
+            raise ResError("Interpolation scheme not one of: 'near', 'cubic', or 'bilinear'")
+
+        return start[:,None]+np.arange(n), weights
+
+    def _buildSpatialIndex(s):
+        """Builds a KD-tree over the working lat/lon grid of a source with 
+        dependent coordinates"""
+        s._kdtree = cKDTree( np.column_stack([np.asarray(s.lons).ravel(), np.asarray(s.lats).ravel()]) )
+
+    def _locateOnCurvilinearGrid(s, lats, lons):
+        """Finds the closest grid cells, and the fractional offsets to them, for 
+        many locations at once on a grid with dependent coordinates
+
+        Returns
+        -------
+        tuple of numpy.ndarray : (latI, lonI, latDistI, lonDistI)
+            * latI and lonI are the integer indices of the closest grid cells
+            * latDistI and lonDistI are the offsets from those cells, given in 
+              units of the local grid spacing
+        """
+        # Query all locations in bulk
+        _, flatI = s._kdtree.query( np.column_stack([lons, lats]) )
+        latI, lonI = np.unravel_index(flatI, s.lats.shape)
+
+        # Local spacing is the mean over the available neighbouring cells (at 
+        # the edge of the grid only one neighbour is available)
+        latN, lonN = s.lats.shape
+        up = np.minimum(latI+1, latN-1)
+        dw = np.maximum(latI-1, 0)
+        rt = np.minimum(lonI+1, lonN-1)
+        lt = np.maximum(lonI-1, 0)
+
+        latSpacing = (s.lats[up,lonI]-s.lats[dw,lonI])/(up-dw)
+        lonSpacing = (s.lons[latI,rt]-s.lons[latI,lt])/(rt-lt)
+
+        latDistI = (lats-s.lats[latI,lonI])/latSpacing
+        lonDistI = (lons-s.lons[latI,lonI])/lonSpacing
+
+        return latI, lonI, np.asarray(latDistI), np.asarray(lonDistI)
+
     def get(s, variable, locations, interpolation='near', forceDataFrame=False, outsideOkay=False, _indicies=None):
         """
         Retrieve complete time series for a variable from the source's loaded data 
@@ -476,88 +1918,150 @@ class NCSource(object):
         # Ensure loc is a list
         locations = LocationSet(locations)
         
-        # Get the indicies
-        if _indicies is None:
-            # compute the closest indices
-            if not s.dependent_coordinates or interpolation == 'near': asInt=True
-            else: asInt = False
-            indicies = s.loc2Index(locations, outsideOkay, asInt=asInt)
+        # Do interpolation
+        output = s._cachedExtract(variable, locations, interpolation, lambda: s._resolveIndicies(locations, outsideOkay, _indicies))
+
+        # Make output as Series objects
+        if forceDataFrame or (len(output.shape)>1 and output.shape[1]>1):
+            return pd.DataFrame(output, index=s._timeindexOf(variable), columns=locations)
         else: 
-            # Assume indicies match locations
-            indicies = _indicies
+            try:
+                return pd.Series(output[:,0], index=s._timeindexOf(variable), name=locations[0])
+            except:
+                return pd.Series(output, index=s._timeindexOf(variable), name=locations[0])
 
-        if isinstance(indicies, Index): indicies = [indicies, ]
+    def get_many(s, variables, locations, interpolation='near', outsideOkay=False, _indicies=None):
+        """
+        Retrieve complete time series for several variables from the source's 
+        loaded data table at the given location(s)
 
-        # Do interpolation
-        if interpolation == 'near':            
-            # arrange the output data
-            tmp = []
-            for i in indicies:
-                if not i is None: tmp.append(s.data[variable][:, i.yi, i.xi])
-                else: tmp.append( np.array([np.nan,]*s.timeindex.size) ) 
-            output = np.column_stack(tmp)
+        * Indicies and interpolation weights are only computed once, and are 
+          shared by all variables
 
-        elif interpolation == "cubic" or interpolation == "bilinear":
-            # set some arguments for later use
-            if interpolation == "cubic":
-                win = 4
-                rbsArgs = dict()
-            else:
-                win = 2
-                rbsArgs = dict(kx=1, ky=1)
-
-            # Set up interpolation arrays
-            yiMin = np.round( min([i.yi for i in indicies])-win).astype(int)
-            yiMax = np.round( max([i.yi for i in indicies])+win).astype(int)
-            xiMin = np.round( min([i.xi for i in indicies])-win).astype(int)
-            xiMax = np.round( max([i.xi for i in indicies])+win).astype(int)
-
-            # ensure boundaries are okay
-            if yiMin < 0 or xiMin < 0 or yiMax > s._latN or xiMax > s._lonN: 
-                raise ResError("Insufficient data. Try expanding the boundary of the extracted data")
-
-            ##########
-            ## TODO: Update interpolation schemes to handle out-of-bounds indices 
-            ##########
-            
-            if s.dependent_coordinates: # do interpolations in 'index space'               
-                if isinstance(indicies[0][0], int): raise ResError("Index must be float type for interpolation")
+        Parameters
+        ----------
+            variables : list of str
+                The variables within the data container to extract
 
-                gridYVals = np.arange(yiMin,yiMax+1)
-                gridXVals = np.arange(xiMin,xiMax+1)
+            locations : Anything acceptable by geokit.LocationSet
+                The location(s) to search for
+                  * See NCSource.get
 
-                yInterp = [i.yi for i in indicies]
-                xInterp = [i.xi for i in indicies]
-                
-            else: # do interpolation in the expected 'coordinate space'
-                gridYVals = s.lats[yiMin:yiMax+1]
-                gridXVals = s.lons[xiMin:xiMax+1]
-                
-                yInterp = [loc.lat for loc in locations]
-                xInterp = [loc.lon for loc in locations]
-            
-            # Do interpolation
-            output = []
-            for ts in range(s.data[variable].shape[0]):
-                # set up interpolation
-                rbs = RectBivariateSpline(gridYVals,gridXVals,s.data[variable][ts, yiMin:yiMax+1, xiMin:xiMax+1], **rbsArgs)
+            interpolation : str, optional
+                The interpolation method to use
+                  * Can be 'near', 'bilinear', or 'cubic'
+                  * See NCSource.get
+
+            outsideOkay : bool, optional
+                Determines if points which are outside the source's lat/lon grid
+                are allowed
+                * If True, points outside this space will return as NaN
+                * If False, an error is raised 
+        
+        Returns
+        -------
+        OrderedDict of pandas.DataFrame
+          * Keys match to the given variables
+          * Indexes match to times, and are shared by all variables other than
+            aggregates, which have their own index
+          * Columns match to the given order of locations
+        
+        """
+        # Ensure loc is a list
+        locations = LocationSet(locations)
+        
+        # Extract all variables, with the indicies computed once when they are needed
+        resolve = lambda: s._resolveIndicies(locations, outsideOkay, _indicies)
+        output = OrderedDict()
+        for variable in variables:
+            output[variable] = pd.DataFrame(s._cachedExtract(variable, locations, interpolation, resolve), index=s._timeindexOf(variable), columns=locations)
+
+        return output
+
+    def _timeindexOf(s, variable):
+        """The time index of a variable in the data table"""
+        return s.__dict__.get("_aggregateIndex", {}).get(variable, s.timeindex)
+
+    def _resolveIndicies(s, locations, outsideOkay=False, indicies=None):
+        """Returns the IndexSet to use for the given LocationSet, checking that
+        precomputed indicies match the source and locations"""
+        if indicies is None:
+            # compute the closest indices (or reuse those from a previous call)
+            return s._cachedIndexSet(locations, outsideOkay)
+
+        # Assume indicies match locations
+        indicies = IndexSet.load(indicies, s.fingerprint)
+        if not indicies.fingerprint in (None, s.fingerprint):
+            raise ResError("The given indicies were not computed for this source")
+        if indicies.count != locations.count: 
+            raise ResError("The given indicies do not match the given locations")
+        return indicies
+
+    def _cachedExtract(s, variable, locations, interpolation, resolve):
+        """Extracts a variable at each location as _extract() does, reusing the
+        series in the source's extraction cache when it has one
+
+          * resolve is called to get the IndexSet of all locations, but only if
+            some of them are not in the cache
+        """
+        cache = s.__dict__.get("_extractionCache")
+        if cache is None: return s._extract(variable, resolve(), interpolation)
+
+        key = s._extractionKey(variable, interpolation)
+        output, missing = cache.fetch(key, locations.lons, locations.lats, s._timeindexOf(variable).size)
+        if missing.any():
+            indicies = resolve()[missing]
+            values = s._extract(variable, indicies, interpolation)
+            output[:, missing] = values
+
+            # Locations outside of the grid are not stored
+            valid = indicies.valid
+            cache.store(key, locations.lons[missing][valid], locations.lats[missing][valid], values[:, valid])
+        return output
+
+    def _extractionKey(s, variable, interpolation):
+        """Identifies the series of a variable in the extraction cache"""
+        return md5(repr([s.fingerprint, int(s._timeStart), int(s._timeStop), variable, interpolation]).encode()).hexdigest()
+
+    def _extract(s, variable, indicies, interpolation):
+        """Extracts the time series of a loaded variable at each location in 
+        an IndexSet, returning a (time, locations) matrix"""
+        valid = indicies.valid
+
+        if not valid.any():
+            output = np.empty((s.data[variable].shape[0], 0))
+
+        elif interpolation == 'near':            
+            # gather all columns at once
+            output = s._gather(variable, indicies.yi[valid], indicies.xi[valid])
 
-                # interpolate for each location
-                output.append(rbs(yInterp, xInterp, grid=False)) # lat/lon order switched to match index order
-     
-            output = np.stack(output)
+        elif interpolation == "cubic" or interpolation == "bilinear":
+            # Gather the cells used by any location, and apply the weights to
+            # all time steps at once
+            cells, weights = s._interpolationWeights(indicies, interpolation)
+
+            cellsY, cellsX = np.divmod(cells, s.lons.shape[-1])
+            output = weights.dot( s._gather(variable, cellsY, cellsX).T ).T
 
         else:
             raise ResError("Interpolation scheme not one of: 'near', 'cubic', or 'bilinear'")
 
-        # Make output as Series objects
-        if forceDataFrame or (len(output.shape)>1 and output.shape[1]>1):
-            return pd.DataFrame(output, index=s.timeindex, columns=locations)
-        else: 
-            try:
-                return pd.Series(output[:,0], index=s.timeindex, name=locations[0])
-            except:
-                return pd.Series(output, index=s.timeindex, name=locations[0])
+        # Fill in locations which are outside of the grid
+        if not valid.all():
+            tmp = np.full((output.shape[0], indicies.count), np.nan, dtype=np.result_type(output.dtype, np.float32))
+            tmp[:, valid] = output
+            output = tmp
+
+        return output
+
+    def _gather(s, variable, yi, xi):
+        """Gathers the time series of a loaded variable at the given grid cells
+        as a (time, cells) matrix, reading them from disk if the variable is lazy"""
+        data = s.data[variable]
+        if isinstance(data, _LazyVariable):
+            return data.take(yi, xi)
+        else:
+            return np.ma.filled(data[:, yi, xi], np.nan)
 
     def contextAreaAt(s,location):
         """Compute the sources-index's context area surrounding the given location"""
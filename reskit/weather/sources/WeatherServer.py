@@ -0,0 +1,322 @@
+from .NCSource import *
+from .NCSource import _LazyVariable
+
+import json
+import socket
+import socketserver
+from os import stat, remove, getpid, umask
+from os.path import exists, abspath
+from stat import S_ISSOCK
+from struct import pack, unpack
+from threading import Thread, Lock
+
+# Only plain numeric arrays are accepted from the other side of a connection
+_ARRAY_KINDS = "biufcmM"
+
+def _sendMessage(sock, header, *arrays):
+    """Sends a JSON header, followed by the raw buffers of any arrays
+
+    * Each part is prefixed with its length in bytes
+    * The dtype and shape of each array is given in the header
+    """
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header, arrays=[(a.dtype.str, a.shape) for a in arrays])
+    parts = [json.dumps(header).encode()] + [a.data for a in arrays]
+    for part in parts:
+        sock.sendall(pack("!Q", memoryview(part).nbytes))
+        sock.sendall(part)
+
+def _recvExactly(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0: raise EOFError("The connection was closed")
+        received += n
+    return buf
+
+def _recvMessage(sock):
+    """Receives a header and its arrays, as sent by _sendMessage()
+
+    * Nothing which is received is ever unpickled, and arrays which are not
+      plain numeric arrays of the size given in the header are refused
+    """
+    size, = unpack("!Q", _recvExactly(sock, 8))
+    header = json.loads(_recvExactly(sock, size).decode())
+
+    arrays = []
+    for dtype, shape in header.pop("arrays"):
+        dtype, shape = np.dtype(dtype), tuple(int(n) for n in shape)
+        size, = unpack("!Q", _recvExactly(sock, 8))
+        if not dtype.kind in _ARRAY_KINDS or size != int(np.prod(shape))*dtype.itemsize:
+            raise ResError("Received an invalid array")
+        arrays.append(np.frombuffer(_recvExactly(sock, size), dtype=dtype).reshape(shape))
+    return header, arrays
+
+# Attributes of served sources which are not sent, but are made again by clients
+_LOCAL_ATTRIBUTES = ["data", "extent", "_kdtree", "_extractionCache", "_indexCache", "_shared", "_attached"]
+
+def _describe(value, arrays):
+    """Describes an attribute of a source as JSON, with any arrays appended to
+    arrays and referenced by their position"""
+    if value is None or isinstance(value, (bool, str)): return value
+    if isinstance(value, (np.bool_, )): return bool(value)
+    if isinstance(value, (int, np.integer)): return int(value)
+    if isinstance(value, (float, np.floating)): return float(value)
+    if isinstance(value, list): return [_describe(v, arrays) for v in value]
+    if isinstance(value, tuple): return {"tuple": [_describe(v, arrays) for v in value]}
+    if isinstance(value, dict): return {"dict": [[_describe(k, arrays), _describe(v, arrays)] for k, v in value.items()]}
+    if isinstance(value, np.dtype): return {"dtype": value.str}
+    if isinstance(value, pd.DatetimeIndex):
+        arrays.append(value.asi8)
+        return {"times": len(arrays)-1, "tz": None if value.tz is None else str(value.tz)}
+    if isinstance(value, pd.MultiIndex):
+        return {"multiIndex": _describe(list(value), arrays), "names": list(value.names)}
+    if isinstance(value, pd.DataFrame):
+        return {"frame": [[c, _describe(list(value[c]), arrays)] for c in value.columns], 
+                "index": _describe(list(value.index), arrays)}
+    if isinstance(value, np.ndarray) and value.dtype.kind in _ARRAY_KINDS: 
+        arrays.append(value)
+        return {"array": len(arrays)-1}
+    raise ResError("Sources with a %s attribute cannot be served"%type(value).__name__)
+
+def _rebuild(spec, arrays):
+    """Makes an attribute of a source from its description, as made by _describe()"""
+    if isinstance(spec, list): return [_rebuild(v, arrays) for v in spec]
+    if not isinstance(spec, dict): return spec
+    if "tuple" in spec: return tuple(_rebuild(v, arrays) for v in spec["tuple"])
+    if "dict" in spec: return OrderedDict((_rebuild(k, arrays), _rebuild(v, arrays)) for k, v in spec["dict"])
+    if "dtype" in spec: return np.dtype(spec["dtype"])
+    if "times" in spec: 
+        times = pd.DatetimeIndex(np.asarray(arrays[spec["times"]], dtype="datetime64[ns]"))
+        return times if spec["tz"] is None else times.tz_localize("UTC").tz_convert(spec["tz"])
+    if "multiIndex" in spec: return pd.MultiIndex.from_tuples(_rebuild(spec["multiIndex"], arrays), names=spec["names"])
+    if "frame" in spec:
+        frame = pd.DataFrame(index=_rebuild(spec["index"], arrays))
+        for column, values in spec["frame"]: frame[column] = _rebuild(values, arrays)
+        return frame
+    if "array" in spec: return np.array(arrays[spec["array"]])
+    raise ResError("Could not understand a source description")
+
+def _sourceClass(name):
+    """Finds the weather source class with the given qualified name"""
+    classes = [NCSource]
+    while classes:
+        cls = classes.pop()
+        if "%s.%s"%(cls.__module__, cls.__name__) == name: return cls
+        classes.extend(cls.__subclasses__())
+    raise ResError("Source type %s is not known"%name)
+
+# Connections of this process, keyed by the server's address
+_CONNECTIONS = {}
+_CONNECTIONS_LOCK = Lock()
+
+def _request(address, header, *arrays):
+    """Sends a request to a weather server and returns its response
+
+    * A single connection to each server is kept open per process, and requests
+      from several threads take turns on it
+    * A broken connection (such as after the server restarted) is opened again
+      once
+    """
+    for attempt in range(2):
+        with _CONNECTIONS_LOCK:
+            conn = _CONNECTIONS.get(address)
+            if conn is None or conn[0] != getpid(): # Connections are not shared with forked processes
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(address)
+                conn = _CONNECTIONS[address] = (getpid(), sock, Lock())
+
+        _, sock, lock = conn
+        try:
+            with lock:
+                _sendMessage(sock, header, *arrays)
+                response, values = _recvMessage(sock)
+            break
+        except (OSError, EOFError):
+            with _CONNECTIONS_LOCK:
+                if _CONNECTIONS.get(address) is conn: del _CONNECTIONS[address]
+            sock.close()
+            if attempt == 1: raise
+
+    if "error" in response: raise ResError("Weather server: %s"%response["error"])
+    return response, values
+
+class _RemoteVariable(_LazyVariable):
+    """A handle to a variable which is held by a weather server"""
+    def __init__(s, address, source, variable, shape, dtype=np.float32):
+        s.address = address
+        s.source = source
+        s.variable = variable
+        s.shape = shape
+        s.dtype = dtype
+        s.latStart = 0
+        s.lonStart = 0
+
+    def take(s, yi, xi):
+        """Fetches the time series at the given cells of the working grid as a
+        (time, cells) matrix"""
+        yi = np.asarray(yi, dtype=np.int64)+s.latStart
+        xi = np.asarray(xi, dtype=np.int64)+s.lonStart
+        _, (values, ) = _request(s.address, dict(op="take", source=s.source, variable=s.variable), yi, xi)
+        return values
+
+    def read(s, ySlice, xSlice):
+        """Fetches a rectangular (time, lat, lon) hyperslab of the working grid"""
+        yi, xi = np.mgrid[ySlice, xSlice]
+        return s.take(yi.ravel(), xi.ravel()).reshape(s.shape[0], yi.shape[0], yi.shape[1])
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(s):
+        while True:
+            try:
+                header, arrays = _recvMessage(s.request)
+            except (EOFError, ValueError, ResError): # Closed, or not a client
+                return
+
+            try:
+                header, arrays = s.server.weatherServer._respond(header, arrays)
+            except Exception as e:
+                header, arrays = dict(error="%s: %s"%(type(e).__name__, str(e))), []
+            _sendMessage(s.request, header, *arrays)
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class WeatherServer(object):
+    """The WeatherServer keeps loaded weather sources in memory, and answers
+    extraction requests from other processes over a Unix domain socket
+
+    * Clients open a served source with WeatherServer.connect(), which returns
+      a source of the same type (such as a MerraSource) whose variables are
+      fetched from the server, and which can be used anywhere a loaded source
+      can be used
+    * Only the time series of the grid cells which a client needs are sent, as
+      raw array buffers
+    * Messages are JSON headers and plain numeric arrays, and sources are sent
+      as a description of their attributes, so nothing is ever unpickled
+    * The socket is only accessible to the user who opened the server
+    * The simulation workflows accept a server's address as their source
+
+    Example:
+    --------
+    In a long-running process:
+
+        >>> source = MerraSource("path/to/merra", bounds=...)
+        >>> source.loadSet_Wind()
+        >>> WeatherServer("/tmp/weather.sock", merra=source).serveForever()
+
+    Elsewhere:
+
+        >>> source = WeatherServer.connect("/tmp/weather.sock#merra")
+        >>> windpower.workflowOnshore(placements, source="/tmp/weather.sock#merra", ...)
+
+    """
+    def __init__(s, address, **sources):
+        """Opens a weather server
+
+        Parameters
+        ----------
+        address : str
+            The path of the Unix domain socket to listen on
+              * An existing socket at this path is replaced
+
+        **sources : NCSource
+            The sources to serve, with the keyword as the name by which clients
+            select them
+              * The first source is served to clients which do not give a name
+        """
+        if len(sources) == 0: raise ResError("No sources were given")
+        s.address = abspath(address)
+        s.sources = OrderedDict(sources)
+
+        if exists(s.address) and S_ISSOCK(stat(s.address).st_mode): remove(s.address)
+        mask = umask(0o177) # Only the owner may connect
+        try:
+            s._server = _UnixServer(s.address, _RequestHandler)
+        finally:
+            umask(mask)
+        s._server.weatherServer = s
+        s._thread = None
+
+    def serveForever(s):
+        """Answers requests until the server is closed"""
+        s._server.serve_forever()
+
+    def start(s):
+        """Answers requests from a background thread, and returns the server"""
+        s._thread = Thread(target=s.serveForever, daemon=True)
+        s._thread.start()
+        return s
+
+    def close(s):
+        """Stops answering requests and removes the socket"""
+        if not s._thread is None:
+            s._server.shutdown()
+            s._thread = None
+        s._server.server_close()
+        if exists(s.address): remove(s.address)
+
+    def _respond(s, header, arrays):
+        name = header.get("source") or next(iter(s.sources))
+        if not name in s.sources: raise ResError("Source %s is not served"%name)
+        source = s.sources[name]
+
+        if header["op"] == "open":
+            # Describe the source without its data, which clients replace by 
+            # remote handles
+            arrays = []
+            attributes = [[k, _describe(v, arrays)] for k, v in source.__dict__.items() if not k in _LOCAL_ATTRIBUTES]
+            variables = [[var, data.shape, np.result_type(getattr(data, "dtype", np.float32), np.float32).str] 
+                         for var, data in source.data.items()]
+            cls = type(source)
+            return dict(source=name, cls="%s.%s"%(cls.__module__, cls.__name__), attributes=attributes, variables=variables), arrays
+
+        elif header["op"] == "take":
+            yi, xi = arrays
+            if not (yi.dtype.kind in "iu" and xi.dtype.kind in "iu"): raise ResError("Cell indices must be integers")
+            return dict(), [source._gather(header["variable"], yi, xi)]
+
+        else:
+            raise ResError("Request %s is not understood"%header["op"])
+
+    @staticmethod
+    def isAddress(source):
+        """Checks if the given source is the address of a weather server"""
+        if not isinstance(source, str): return False
+        path = source.split("#")[0]
+        return exists(path) and S_ISSOCK(stat(path).st_mode)
+
+    @staticmethod
+    def connect(address):
+        """Opens a source which is served by a weather server
+
+        Parameters
+        ----------
+        address : str
+            The path to the server's socket, optionally followed by '#' and the
+            name of the source
+              * Example: "/tmp/weather.sock#merra"
+
+        Returns
+        -------
+        A source of the same type as the served source
+        """
+        path, _, name = address.partition("#")
+        header, arrays = _request(path, dict(op="open", source=name or None))
+
+        cls = _sourceClass(header["cls"])
+        source = cls.__new__(cls)
+        for key, spec in header["attributes"]: 
+            source.__dict__[key] = _rebuild(spec, arrays)
+
+        # Make the attributes which are not sent
+        source.extent = gk.Extent(source.lons.min(), source.lats.min(), source.lons.max(), source.lats.max(), srs=gk.srs.EPSG4326)
+        if source.dependent_coordinates: source._buildSpatialIndex()
+        source.setExtractionCache(None)
+        
+        source.data = OrderedDict()
+        for var, shape, dtype in header["variables"]:
+            source.data[var] = _RemoteVariable(path, header["source"], var, tuple(shape), dtype=np.dtype(dtype))
+        return source
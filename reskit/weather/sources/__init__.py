@@ -1,5 +1,7 @@
-from .NCSource import NCSource
+from .NCSource import NCSource, IndexSet
 from .MerraSource import MerraSource
 #from .TrySource import TrySource
 #from .CordexSource import CordexSource
 from .CosmoSource import CosmoSource
+from .LocationMajorSource import LocationMajorSource
+from .WeatherServer import WeatherServer
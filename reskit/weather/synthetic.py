@@ -0,0 +1,302 @@
+"""Writes synthetic weather datasets which follow the conventions of the MERRA2
+and COSMO-REA6 sources, so that weather sources can be exercised and benchmarked
+at any grid size and time span
+"""
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from os import makedirs
+from os.path import join, isdir
+
+from reskit.util.util_ import ResError, rotateToLatLon
+
+# Variables as (standard_name, long_name, units, kind, height)
+MERRA_VARIABLES = OrderedDict([
+    ("U2M", ("2-meter_eastward_wind", "2-meter_eastward_wind", "m s-1", "u", 2)),
+    ("V2M", ("2-meter_northward_wind", "2-meter_northward_wind", "m s-1", "v", 2)),
+    ("U10M", ("10-meter_eastward_wind", "10-meter_eastward_wind", "m s-1", "u", 10)),
+    ("V10M", ("10-meter_northward_wind", "10-meter_northward_wind", "m s-1", "v", 10)),
+    ("U50M", ("eastward_wind_at_50_meters", "eastward_wind_at_50_meters", "m s-1", "u", 50)),
+    ("V50M", ("northward_wind_at_50_meters", "northward_wind_at_50_meters", "m s-1", "v", 50)),
+    ("T2M", ("2-meter_air_temperature", "2-meter_air_temperature", "K", "temperature", 2)),
+    ("T2MDEW", ("dew_point_temperature_at_2_m", "dew_point_temperature_at_2_m", "K", "dewpoint", 2)),
+    ("PS", ("surface_pressure", "surface_pressure", "Pa", "pressure", 0)),
+    ("SWGDN", ("surface_incoming_shortwave_flux", "surface_incoming_shortwave_flux", "W m-2", "ghi", 0)),
+])
+
+COSMO_VARIABLES = OrderedDict([
+    ("windspeed_10", ("wind_speed", "wind speed at 10 m", "m s-1", "speed", 10)),
+    ("windspeed_50", ("wind_speed", "wind speed at 50 m", "m s-1", "speed", 50)),
+    ("windspeed_100", ("wind_speed", "wind speed at 100 m", "m s-1", "speed", 100)),
+    ("windspeed_140", ("wind_speed", "wind speed at 140 m", "m s-1", "speed", 140)),
+    ("SWDIFDS_RAD", ("surface_diffuse_downwelling_shortwave_flux_in_air", "diffuse shortwave radiation at the surface", "W m-2", "dhi", 0)),
+    ("SWDIRS_RAD", ("surface_direct_downwelling_shortwave_flux_in_air", "direct shortwave radiation at the surface", "W m-2", "dni_flat", 0)),
+    ("sp", ("surface_air_pressure", "surface pressure", "Pa", "pressure", 0)),
+    ("2t", ("air_temperature", "2 metre temperature", "K", "temperature", 2)),
+])
+
+# The rotated grid of COSMO-REA6, as assumed by CosmoSource.loc2Index()
+REA6_GRID = dict(lonSouthPole=18, latSouthPole=-39.25, rlonRes=0.0550000113746, rlatRes=0.0550001976179,
+                 rlonStart=-28.40246773, rlatStart=-23.40240860, latN=824, lonN=848)
+
+_PERIOD_FORMATS = dict(year="%Y", month="%Y%m", day="%Y%m%d")
+_MERRA_FILL = np.float32(1e15)
+
+
+def _fields(variables, times, lats, lons, seed):
+    """Computes smooth, plausible values of the given variables at the given
+    times over a grid
+
+    * Every variable is derived from the same underlying wind and solar state,
+      so that for instance wind speeds increase with height
+    * Values only depend on the time, location, and seed, so files which are
+      written separately fit together
+    """
+    hours = (times.values.astype("datetime64[s]").astype(np.int64)/3600.0)[:, None, None]
+    lats = lats[None, :, :]
+    lons = lons[None, :, :]
+
+    # A reproducible 'weather' signal, made of a few travelling waves
+    rng = np.random.RandomState(seed)
+    waves = rng.uniform(0, 2*np.pi, size=(4, 3))
+    periods = np.array([9.0, 31.0, 97.0, 240.0])
+
+    signal = np.zeros((hours.shape[0], lats.shape[1], lats.shape[2]), dtype=np.float32)
+    for period, (phase, ky, kx) in zip(periods, waves):
+        signal += np.sin(2*np.pi*hours/period + phase + 0.3*np.cos(ky)*lats + 0.3*np.sin(kx)*lons).astype(np.float32)
+    signal /= len(periods)
+
+    dayOfYear = (hours/24.0) % 365.25
+    solarTime = (hours + lons/15.0) % 24
+    elevation = np.sin(np.radians(lats))*np.sin(np.radians(23.44*np.sin(2*np.pi*(dayOfYear-80)/365.25))) + \
+                np.cos(np.radians(lats))*np.cos(np.radians(23.44*np.sin(2*np.pi*(dayOfYear-80)/365.25)))*np.cos(2*np.pi*(solarTime-12)/24)
+    elevation = np.clip(elevation, 0, None).astype(np.float32)
+    season = np.cos(2*np.pi*(dayOfYear-200)/365.25).astype(np.float32)
+
+    speed10 = 5 + 3*signal + 0.5*np.cos(np.radians(lats*7))
+    angle = np.pi*signal + np.radians(lons*5)
+
+    out = OrderedDict()
+    for var, (_, _, _, kind, height) in variables.items():
+        shear = (max(height, 1)/10.0)**0.14
+        if kind == "u": values = speed10*shear*np.cos(angle)
+        elif kind == "v": values = speed10*shear*np.sin(angle)
+        elif kind == "speed": values = np.abs(speed10*shear)
+        elif kind == "temperature": values = 283 + 10*season + 5*elevation + 2*signal - 0.3*(lats-45)
+        elif kind == "dewpoint": values = 278 + 8*season + 2*signal - 0.3*(lats-45)
+        elif kind == "pressure": values = 101000 + 1000*signal - 50*(lats-45)
+        elif kind == "ghi": values = 1000*elevation*(0.75+0.25*signal)
+        elif kind == "dhi": values = 1000*elevation*(0.25-0.1*signal)
+        elif kind == "dni_flat": values = 1000*elevation*(0.5+0.35*signal)
+        else: raise ResError("Unknown kind of variable: %s"%kind)
+        out[var] = np.asarray(values, dtype=np.float32)
+    return out
+
+
+def _writeDataset(directory, fileName, grid, variables, times, timeUnits, split, byVariable, maxMemory, seed, globalAttrs, fill=None):
+    """Writes a synthetic dataset as a set of netCDF4 files, split over time
+    and optionally over variables"""
+    if not split in _PERIOD_FORMATS: raise ResError("split must be one of %s"%list(_PERIOD_FORMATS))
+    if not isdir(directory): makedirs(directory)
+
+    lats, lons, writeCoordinates, dims = grid
+    latN, lonN = lats.shape
+    groups = [OrderedDict([(v, variables[v])]) for v in variables] if byVariable else [variables]
+    periods = times.strftime(_PERIOD_FORMATS[split])
+
+    paths = []
+    for period in pd.unique(periods):
+        sel = np.flatnonzero(periods == period)
+        periodTimes = times[sel]
+        for group in groups:
+            tag = period + ("."+next(iter(group)) if byVariable else "")
+            path = join(directory, fileName%tag)
+
+            ds = nc.Dataset(path, "w")
+            for k, v in globalAttrs.items(): ds.setncattr(k, v)
+            ds.createDimension("time", None)
+            writeCoordinates(ds)
+
+            timeV = ds.createVariable("time", "f8", ("time",))
+            timeV.standard_name = "time"
+            timeV.long_name = "time"
+            timeV.units = timeUnits%periodTimes[0].strftime("%Y-%m-%d %H:%M:%S")
+            timeV.calendar = "standard"
+            timeV.axis = "T"
+            timeV[:] = nc.date2num(periodTimes.to_pydatetime(), timeV.units, calendar="standard")
+
+            for var, (standardName, longName, units, _, _) in group.items():
+                kwargs = dict(fill_value=fill) if not fill is None else dict()
+                v = ds.createVariable(var, "f4", ("time",)+dims, zlib=False, chunksizes=(1, latN, lonN), **kwargs)
+                v.standard_name = standardName
+                v.long_name = longName
+                v.units = units
+                if not fill is None:
+                    v.missing_value = fill
+                    v.fmissing_value = fill
+                    v.vmax = fill
+                    v.vmin = -fill
+
+            # Write a block of time steps at a time
+            step = int(max(1, maxMemory//(latN*lonN*4*(len(group)+4))))
+            for t0 in range(0, sel.size, step):
+                t1 = min(t0+step, sel.size)
+                values = _fields(group, periodTimes[t0:t1], lats, lons, seed)
+                for var, data in values.items(): ds[var][t0:t1] = data
+
+            ds.close()
+            paths.append(path)
+    return paths
+
+
+def makeMerraLike(directory, latN=20, lonN=16, years=1, startYear=2015, lat0=40.0, lon0=-5.0, split="year",
+                  byVariable=True, variables=None, maxMemory=256e6, seed=0):
+    """Writes a synthetic dataset which follows the conventions of the MERRA2
+    files read by MerraSource
+
+    * The grid is regular, with 0.5 degree latitude and 0.625 degree longitude
+      steps, as assumed by MerraSource.loc2Index()
+    * Time steps are hourly and centered on the half hour
+    * Variable names, attributes, and fill values match the MERRA2 files
+
+    Parameters
+    ----------
+    directory : str
+        The directory to write into
+
+    latN, lonN : int, optional
+        The number of grid rows and columns
+
+    years : int, optional
+        The number of years to write, starting at 'startYear'
+
+    lat0, lon0 : float, optional
+        The coordinates of the southwestern-most grid cell
+
+    split : str, optional
+        How to split the data over files
+          * 'year', 'month', or 'day'
+
+    byVariable : bool, optional
+        If True, each variable is written to its own files, as in
+        'MERRA_tavg1_2d.2015.Europe.U50M.nc4'
+
+    variables : list, optional
+        The variables to write
+          * By default, all of MERRA_VARIABLES are written
+
+    maxMemory : numeric, optional
+        The most bytes to generate at once
+
+    seed : int, optional
+        Seeds the generated weather
+
+    Returns
+    -------
+    list : The paths of the written files
+
+    """
+    variables = OrderedDict((v, MERRA_VARIABLES[v]) for v in (variables or MERRA_VARIABLES))
+    lats1 = lat0 + 0.5*np.arange(latN)
+    lons1 = lon0 + 0.625*np.arange(lonN)
+    lats, lons = np.meshgrid(lats1, lons1, indexing="ij")
+
+    def writeCoordinates(ds):
+        ds.createDimension("lat", latN)
+        ds.createDimension("lon", lonN)
+        for name, values, standardName, units, axis in [("lon", lons1, "longitude", "degrees_east", "X"),
+                                                         ("lat", lats1, "latitude", "degrees_north", "Y")]:
+            v = ds.createVariable(name, "f8", (name,))
+            v.standard_name = standardName
+            v.long_name = standardName
+            v.units = units
+            v.axis = axis
+            v[:] = values
+
+    times = pd.date_range("%d-01-01 00:30:00"%startYear, "%d-12-31 23:30:00"%(startYear+years-1), freq="h")
+    globalAttrs = OrderedDict([("Conventions", "CF-1"), ("Institution", "Synthetic (reskit)"),
+                               ("Title", "Synthetic MERRA2 tavg1_2d"), ("Format", "NetCDF-4/HDF-5"),
+                               ("LatitudeResolution", "0.5"), ("LongitudeResolution", "0.625"),
+                               ("DataResolution", "0.5 x 0.625")])
+
+    return _writeDataset(directory, "MERRA_tavg1_2d.%s.nc4", (lats, lons, writeCoordinates, ("lat", "lon")),
+                         variables, times, "minutes since %s", split=split, byVariable=byVariable,
+                         maxMemory=maxMemory, seed=seed, globalAttrs=globalAttrs, fill=_MERRA_FILL)
+
+
+def makeCosmoLike(directory, latN=40, lonN=50, years=1, startYear=2015, split="year",
+                  byVariable=True, variables=None, maxMemory=256e6, seed=0):
+    """Writes a synthetic dataset which follows the conventions of the
+    COSMO-REA6 files read by CosmoSource
+
+    * The grid is the southwestern corner of the rotated REA6 grid, with
+      2-dimensional latitude and longitude coordinates, so that
+      CosmoSource.loc2Index() applies
+    * Time steps are hourly, on the hour
+
+    Parameters
+    ----------
+    directory : str
+        The directory to write into
+
+    latN, lonN : int, optional
+        The number of grid rows and columns
+
+    years : int, optional
+        The number of years to write, starting at 'startYear'
+
+    split : str, optional
+        How to split the data over files
+          * 'year', 'month', or 'day'
+
+    byVariable : bool, optional
+        If True, each variable is written to its own files
+
+    variables : list, optional
+        The variables to write
+          * By default, all of COSMO_VARIABLES are written
+
+    maxMemory : numeric, optional
+        The most bytes to generate at once
+
+    seed : int, optional
+        Seeds the generated weather
+
+    Returns
+    -------
+    list : The paths of the written files
+
+    """
+    if latN > REA6_GRID["latN"] or lonN > REA6_GRID["lonN"]:
+        raise ResError("The grid is larger than the REA6 grid")
+    variables = OrderedDict((v, COSMO_VARIABLES[v]) for v in (variables or COSMO_VARIABLES))
+
+    rlats1 = REA6_GRID["rlatStart"] + REA6_GRID["rlatRes"]*np.arange(latN)
+    rlons1 = REA6_GRID["rlonStart"] + REA6_GRID["rlonRes"]*np.arange(lonN)
+    rlats, rlons = np.meshgrid(rlats1, rlons1, indexing="ij")
+    lons, lats = rotateToLatLon(rlons.ravel(), rlats.ravel(), lonSouthPole=REA6_GRID["lonSouthPole"],
+                                latSouthPole=REA6_GRID["latSouthPole"])
+    lons = lons.reshape(latN, lonN)
+    lats = lats.reshape(latN, lonN)
+
+    def writeCoordinates(ds):
+        ds.createDimension("rlat", latN)
+        ds.createDimension("rlon", lonN)
+        ds.createVariable("rlat", "f8", ("rlat",))[:] = rlats1
+        ds.createVariable("rlon", "f8", ("rlon",))[:] = rlons1
+        for name, values, standardName, units in [("lat", lats, "latitude", "degrees_north"),
+                                                  ("lon", lons, "longitude", "degrees_east")]:
+            v = ds.createVariable(name, "f8", ("rlat", "rlon"))
+            v.standard_name = standardName
+            v.long_name = standardName
+            v.units = units
+            v[:] = values
+
+    times = pd.date_range("%d-01-01 00:00:00"%startYear, "%d-12-31 23:00:00"%(startYear+years-1), freq="h")
+    globalAttrs = OrderedDict([("Conventions", "CF-1.4"), ("institution", "Synthetic (reskit)"),
+                               ("title", "Synthetic COSMO-REA6")])
+
+    return _writeDataset(directory, "COSMO_REA6.%s.nc4", (lats, lons, writeCoordinates, ("rlat", "rlon")),
+                         variables, times, "hours since %s", split=split, byVariable=byVariable,
+                         maxMemory=maxMemory, seed=seed, globalAttrs=globalAttrs)
@@ -1,12 +1,52 @@
 from ._util import *
 from ._powerCurveConvoluter import *
 from ._simulator import *
-from reskit.weather.sources import MerraSource, CosmoSource
+from reskit.weather.sources import MerraSource, CosmoSource, WeatherServer
 from reskit.weather.windutil import *
 
+def _load_source(source, placements, isCosmo, densityCorrection, verbose, extractionCache=None, hubHeight=None, shear=False):
+    """Opens the weather source around the given placements, and loads the variables needed for simulation
+    
+    * If the source is the address of a weather server, the served source is used as it is
+    * With an extraction cache, variables are loaded lazily, so that placements found in the cache are never read
+    * For COSMO sources, only the wind speed levels which bracket the hub heights are loaded
+    * With shear, the time-varying shear exponent of each MERRA grid cell is loaded as well"""
+    if WeatherServer.isAddress(source): 
+        return WeatherServer.connect(source)
+
+    ext = gk.Extent.fromLocationSet(placements).castTo(gk.srs.EPSG4326).pad(1) # Pad to make sure we only select the data we need
+                                                                               # Otherwise, the NCSource might pull EVERYTHING when
+                                                                               # a smalle area is simulated. IDKY???
+    cacheKwargs = dict(lazy=True, extractionCache=extractionCache) if extractionCache else dict()
+    if isCosmo:
+        source = CosmoSource(source, bounds=ext, indexPad=2, **cacheKwargs)
+        source.loadSet_Wind(densityCorrection=densityCorrection, heights=hubHeight)
+    else:
+        source = MerraSource(source, bounds=ext, indexPad=2, verbose=verbose, **cacheKwargs)
+        source.loadSet_Wind(densityCorrection=densityCorrection, shear=shear)
+
+    return source
+
+def _tile_placements(source, placements, isCosmo, densityCorrection, memoryBudget, verbose, hubHeight=None, shear=False):
+    """Splits placements into tiles of the weather grid, so that the weather data which _load_source() loads for any 
+    one tile fits within the memory budget"""
+    if isCosmo: grid = CosmoSource(source, verbose=False)
+    else: grid = MerraSource(source, verbose=False)
+
+    # The wind speed levels which bracket the hub heights are held (or the wind speed, which is streamed from its
+    # components), as well as the density variables and the shear exponents
+    if isCosmo: variables = len(CosmoSource.bracketingLevels(hubHeight))
+    else: variables = 1
+    if densityCorrection: variables += 2
+    if shear: variables += 1
+    tiles = grid.tileLocations(placements, memoryBudget, variables=variables, pad=1, indexPad=2)
+    if verbose: print("Split placements into %d tiles"%len(tiles))
+
+    return tiles
+
 def _batch_simulator(source, landcover, gwa, adjustMethod, roughness, loss, convScale, convBase, lowBase, lowSharp, lctype, 
                      verbose, extract, powerCurves, pcKey, gid, globalStart, densityCorrection, placements, hubHeight, 
-                     capacity, rotordiam, batchSize, turbineID, output, isCosmo):
+                     capacity, rotordiam, batchSize, turbineID, output, isCosmo, extractionCache=None, shear=False):
     if verbose: 
         groupStartTime = dt.now()
         globalStart = globalStart
@@ -14,22 +54,7 @@ def _batch_simulator(source, landcover, gwa, adjustMethod, roughness, loss, conv
 
     ### Open Source and load weather data
     if isinstance(source, str):
-        ext = gk.Extent.fromLocationSet(placements).castTo(gk.srs.EPSG4326).pad(1) # Pad to make sure we only select the data we need
-                                                                                   # Otherwise, the NCSource might pull EVERYTHING when
-                                                                                   # a smalle area is simulated. IDKY???
-        if isCosmo:
-            source = CosmoSource(source, bounds=ext, indexPad=2)
-            source.loadWindSpeedLevels()
-
-            if densityCorrection:
-                source.loadPressure()
-                source.loadTemperature()
-        else:
-            source = MerraSource(source, bounds=ext, indexPad=2, verbose=verbose)
-            source.loadWindSpeed(50)
-            if densityCorrection:
-                source.loadPressure()
-                source.loadTemperature('air')
+        source = _load_source(source, placements, isCosmo, densityCorrection, verbose, extractionCache, hubHeight, shear)
 
     ### Loop over batch size
     res = []
@@ -42,8 +67,13 @@ def _batch_simulator(source, landcover, gwa, adjustMethod, roughness, loss, conv
         s = np.s_[batchStart: min(batchStart+batchSize,placements.count) ]
 
         ### Read windspeed data and adjust to local context
+        # Variables which share an interpolation scheme are extracted in a single pass
+        densityVars = ["air_temp", "pressure"] if densityCorrection else []
+
         # read and spatially spatially adjust windspeeds
         if isCosmo:
+            weather = source.get_many(densityVars, placements[s], interpolation='bilinear')
+
             ws = source.getWindSpeedAtHeights(placements[s], hubHeight[s], spatialInterpolation='bilinear', forceDataFrame=True)
             gwaVals = gk.raster.interpolateValues( gwa, placements[s], mode="linear-spline")
             cosmo100Means = gk.raster.interpolateValues( '/home/s-ryberg/workspace/1839_cosmo_wind_average/wsMean.tif', placements[s], mode='linear-spline')
@@ -54,22 +84,26 @@ def _batch_simulator(source, landcover, gwa, adjustMethod, roughness, loss, conv
             print(fac.mean(), fac.std() )
             ws *= fac
         else:
+            if adjustMethod == "lra" or adjustMethod is None: wsInterpolation = 'near'
+            elif adjustMethod == "lra-bilinear": wsInterpolation = 'bilinear'
+            elif adjustMethod == "near" or adjustMethod == "bilinear" or adjustMethod == "cubic": wsInterpolation = adjustMethod
+            else: raise ResError("adjustMethod not recognized")
+
+            # Shear exponents are extracted with the same indicies and weights as the wind speeds
+            wsVars = ["windspeed", "alpha"] if shear else ["windspeed", ]
+            if wsInterpolation == 'bilinear':
+                weather = source.get_many(wsVars + densityVars, placements[s], interpolation='bilinear')
+            else:
+                weather = source.get_many(densityVars, placements[s], interpolation='bilinear')
+                weather.update(source.get_many(wsVars, placements[s], interpolation=wsInterpolation))
+            ws = weather["windspeed"]
+
             if adjustMethod == "lra":
-                ws = source.get("windspeed", placements[s], forceDataFrame=True)
                 ws = windutil.adjustLraToGwa( ws, placements[s], longRunAverage=MerraSource.LONG_RUN_AVERAGE_50M_SOURCE, gwa=gwa)
     
             elif adjustMethod == "lra-bilinear":
-                ws = source.get("windspeed", placements[s], forceDataFrame=True, interpolation='bilinear')
                 ws = windutil.adjustLraToGwa( ws, placements[s], longRunAverage=MerraSource.LONG_RUN_AVERAGE_50M_SOURCE, gwa=gwa, 
                                               interpolation='bilinear')
-    
-            elif adjustMethod == "near" or adjustMethod == "bilinear" or adjustMethod == "cubic":
-                ws = source.get("windspeed", placements[s], interpolation=adjustMethod, forceDataFrame=True)
-    
-            elif adjustMethod is None:
-                ws = source.get("windspeed", placements[s], forceDataFrame=True)
-            
-            else: raise ResError("adjustMethod not recognized")
 
             # Look for bad values
             badVals = np.isnan(ws)
@@ -80,7 +114,9 @@ def _batch_simulator(source, landcover, gwa, adjustMethod, roughness, loss, conv
                 raise RuntimeError("Bad windspeed values")
     
             # Get roughnesses from Land Cover
-            if roughness is None and not lctype is None:
+            if shear:
+                pass # The time-varying shear exponents are used instead
+            elif roughness is None and not lctype is None:
                 lcVals = gk.raster.extractValues(landcover, placements[s]).data
                 roughnesses = windutil.roughnessFromLandCover(lcVals, lctype)
     
@@ -93,13 +129,14 @@ def _batch_simulator(source, landcover, gwa, adjustMethod, roughness, loss, conv
                 raise ResError("roughness and lctype are both given or are both None")
     
             # Project WS to hub height
-            ws = windutil.projectByLogLaw(ws, measuredHeight=50, targetHeight=hubHeight[s], roughness=roughnesses)
+            if shear:
+                ws = windutil.projectByPowerLaw(ws, measuredHeight=50, targetHeight=hubHeight[s], alpha=weather["alpha"].values)
+            else:
+                ws = windutil.projectByLogLaw(ws, measuredHeight=50, targetHeight=hubHeight[s], roughness=roughnesses)
         
         # Density correction to windspeeds
         if densityCorrection:
-            t =  source.get("air_temp", placements[s], interpolation='bilinear', forceDataFrame=True)
-            p =  source.get("pressure", placements[s], interpolation='bilinear', forceDataFrame=True)
-            ws = densityAdjustment(ws, pressure=p, temperature=t, height=hubHeight[s])
+            ws = densityAdjustment(ws, pressure=weather["pressure"], temperature=weather["air_temp"], height=hubHeight[s])
 
         ### Do simulations
         capacityGeneration = pd.DataFrame(-1*np.ones(ws.shape), index=ws.index, columns=ws.columns)
@@ -154,7 +191,7 @@ def _batch_simulator(source, landcover, gwa, adjustMethod, roughness, loss, conv
 
 def workflowTemplate(placements, source, landcover, gwa, convScale, convBase, lowBase, lowSharp, adjustMethod, hubHeight, 
                      powerCurve, capacity, rotordiam, cutout, lctype, extract, output, jobs, batchSize, verbose, 
-                     roughness, loss, densityCorrection, isCosmo=False):
+                     roughness, loss, densityCorrection, isCosmo=False, memoryBudget=None, extractionCache=None, shear=False):
     startTime = dt.now()
     if verbose:
         print("Starting at: %s"%str(startTime))
@@ -172,6 +209,8 @@ def workflowTemplate(placements, source, landcover, gwa, convScale, convBase, lo
         if cpus <=0: raise ResError("Bad jobs count")
         useMulti = True
 
+    if shear and isCosmo: raise ResError("Time-varying shear is only available for MERRA sources")
+
     ### Determine the total extent which will be simulated (also make sure the placements input is okay)
     if verbose: print("Arranging placements at +%.2fs"%((dt.now()-startTime).total_seconds()))
     if isinstance(placements, str): # placements is a path to a point-type shapefile
@@ -323,60 +362,84 @@ def workflowTemplate(placements, source, landcover, gwa, convScale, convBase, lo
         densityCorrection=densityCorrection,
         output=output,
         isCosmo=isCosmo,
+        extractionCache=extractionCache,
+        shear=shear,
         )
     
     turbineID=pd.Series(np.arange(placements.shape[0]), index=placements)
 
+    def groupKwargs(gid, placementGroup, batchSize):
+        kwargs = simKwargs.copy()
+        kwargs.update(dict(
+            placements=placementGroup,
+            hubHeight=hubHeight[placementGroup[:]].values,
+            capacity=capacity[placementGroup[:]].values,
+            rotordiam=None if rotordiam is None else rotordiam[placementGroup[:]].values,
+            pcKey = pcKey[placementGroup[:]].values,
+            batchSize=batchSize,
+            gid=gid,
+            turbineID=turbineID[placementGroup[:]].values,
+            ))
+        return kwargs
+
+    # Split placements into tiles which each load no more than their share of the memory budget
+    tiles = None
+    if not memoryBudget is None and isinstance(source, str) and not WeatherServer.isAddress(source):
+        if verbose: print("Tiling placements at +%.2fs"%( (dt.now()-startTime).total_seconds()) )
+        tiles = _tile_placements(source, placements, isCosmo, densityCorrection, memoryBudget/cpus, verbose, hubHeight.values, shear)
+
     if useMulti:
+        if tiles is None:
+            # Load the weather data for all placements once, and share it with the workers
+            if verbose: print("Sharing weather data at +%.2fs"%( (dt.now()-startTime).total_seconds()) )
+            if isinstance(source, str):
+                sharedSource = _load_source(source, placements, isCosmo, densityCorrection, verbose, extractionCache, hubHeight.values, shear)
+            else:
+                sharedSource = source
+            simKwargs["source"] = sharedSource.toSharedMemory()
+
         placements.makePickleable()
         pool = Pool(jobs)
         res = []
 
         # Split locations into groups
-        groups = []
-        for grp in placements.splitKMeans(jobs):
-            if grp.count > (batchSize/jobs)*3:
-                subgroups = int(np.round(grp.count/(3*batchSize/jobs)))
-                for sgi in range(int(subgroups)):
-                    groups.append( gk.LocationSet(grp[sgi::subgroups]) )
-            else:
-                groups.append( grp )
+        if tiles is None:
+            groups = []
+            for grp in placements.splitKMeans(jobs):
+                if grp.count > (batchSize/jobs)*3:
+                    subgroups = int(np.round(grp.count/(3*batchSize/jobs)))
+                    for sgi in range(int(subgroups)):
+                        groups.append( gk.LocationSet(grp[sgi::subgroups]) )
+                else:
+                    groups.append( grp )
+        else: # each worker loads its own tile
+            groups = tiles
+            for grp in groups: grp.makePickleable()
 
         # Submit groups
         if verbose: print("Submitting %d simulation groups at +%.2fs"%( len(groups), (dt.now()-startTime).total_seconds()) )
         for i,placementGroup in enumerate(groups):
-            kwargs = simKwargs.copy()
-            kwargs.update(dict(
-                placements=placementGroup,
-                hubHeight=hubHeight[placementGroup[:]].values,
-                capacity=capacity[placementGroup[:]].values,
-                rotordiam=None if rotordiam is None else rotordiam[placementGroup[:]].values,
-                pcKey = pcKey[placementGroup[:]].values,
-                batchSize=batchSize//jobs,
-                gid=i,
-                turbineID=turbineID[placementGroup[:]].values,
-                ))
-            res.append(pool.apply_async(_batch_simulator, (), kwargs))
-
-        finalRes = []
-        for r in res: finalRes.extend(r.get())
-        res = finalRes
+            res.append(pool.apply_async(_batch_simulator, (), groupKwargs(i, placementGroup, batchSize//jobs)))
 
-        pool.close()
-        pool.join()
-        pool = None
-    else:
-        simKwargs.update(dict(
-            placements=placements,
-            hubHeight=hubHeight.values,
-            capacity=capacity.values,
-            rotordiam=None if rotordiam is None else rotordiam.values,
-            pcKey = pcKey.values,
-            batchSize=batchSize,
-            gid=0,
-            turbineID=turbineID.values,
-            ))
-        res = _batch_simulator(**simKwargs)
+        try:
+            finalRes = []
+            for r in res: finalRes.extend(r.get())
+            res = finalRes
+
+            pool.close()
+            pool.join()
+            pool = None
+        finally:
+            # Free the shared data, but give a user's source its data back
+            if tiles is None:
+                sharedSource.releaseSharedMemory(keep=sharedSource is source)
+                sharedSource = None
+    elif tiles is None:
+        res = _batch_simulator(**groupKwargs(0, placements, batchSize))
+    else: # tiles are loaded and simulated one after the other
+        res = []
+        for i,placementGroup in enumerate(tiles):
+            res.extend(_batch_simulator(**groupKwargs(i, placementGroup, batchSize)))
 
     ## Finalize
     if extract == "capacityFactor": res = pd.concat(res)
@@ -393,7 +456,7 @@ def workflowTemplate(placements, source, landcover, gwa, convScale, convBase, lo
 
     return res
 
-def workflowOnshore(placements, source, landcover, gwa, hubHeight=None, powerCurve=None, capacity=None, rotordiam=None, cutout=None, lctype="clc", extract="totalProduction", output=None, jobs=1, groups=None, batchSize=10000, verbose=True, isCosmo=False, densityCorrection=True):
+def workflowOnshore(placements, source, landcover, gwa, hubHeight=None, powerCurve=None, capacity=None, rotordiam=None, cutout=None, lctype="clc", extract="totalProduction", output=None, jobs=1, groups=None, batchSize=10000, verbose=True, isCosmo=False, densityCorrection=True, memoryBudget=None, extractionCache=None, shear=False):
     """
     Apply the wind simulation method developed by Severin Ryberg, Dilara Caglayan, and Sabrina Schmitt. 
     This method works as follows for a given simulation point:
@@ -431,6 +494,8 @@ def workflowOnshore(placements, source, landcover, gwa, hubHeight=None, powerCur
             The weather data to use for simulation
             * If str -> A path to the MERRA data which will be used for the simulation
             * MUST have the fields 'U50M', 'V50M', 'SP', and 'T2M'
+            * May also be the address of a WeatherServer which serves a source
+              with the wind set loaded
 
         landcover : str
             The path to the land cover source
@@ -483,6 +548,29 @@ def workflowOnshore(placements, source, landcover, gwa, hubHeight=None, powerCur
             The number of placements to simulate across all concurrent jobs
             * Use this to tune performance to your specific machine
 
+        memoryBudget : numeric; optional
+            The most bytes of weather data to hold in memory across all concurrent jobs
+            * Only used when source is a path
+            * Placements are split into tiles of the weather grid, and each job
+              loads the weather data of one tile at a time
+            * If None, the weather data around all placements is loaded at once
+
+        extractionCache : str; optional
+            The path to a sqlite database in which the extracted weather data of
+            each placement is kept
+            * Only used when source is a path
+            * Runs over the same placements (such as with other turbines) then
+              reuse the stored weather data instead of reading the source
+
+        shear : bool; optional
+            If True, wind speeds are projected to hub height with the power law,
+            using the time-varying shear exponent of each MERRA grid cell, which
+            is fitted to the 2, 10, and 50 m wind speeds
+            * Replaces the roughness from the land cover in step 3
+            * Not available for COSMO sources
+            * A WeatherServer source must have 'alpha' loaded (see 
+              MerraSource.loadShear)
+
         verbose : bool; optional
             If True, output progress reports
 
@@ -504,10 +592,10 @@ def workflowOnshore(placements, source, landcover, gwa, hubHeight=None, powerCur
     return workflowTemplate(placements=placements, source=source, landcover=landcover, gwa=gwa, hubHeight=hubHeight, 
                             powerCurve=powerCurve, capacity=capacity, rotordiam=rotordiam, cutout=cutout, lctype=lctype, 
                             extract=extract, output=output, jobs=jobs, batchSize=batchSize, verbose=verbose, isCosmo=isCosmo, 
-                            **kwgs)
+                            memoryBudget=memoryBudget, extractionCache=extractionCache, shear=shear, **kwgs)
 
 
-def workflowOffshore(placements, source, hubHeight=None, powerCurve=None, capacity=None, rotordiam=None, cutout=None, extract="totalProduction", output=None, jobs=1, batchSize=10000, verbose=True, groups=None):
+def workflowOffshore(placements, source, hubHeight=None, powerCurve=None, capacity=None, rotordiam=None, cutout=None, extract="totalProduction", output=None, jobs=1, batchSize=10000, verbose=True, groups=None, memoryBudget=None, extractionCache=None, shear=False):
 
     kwgs = dict()
     kwgs["loss"]=0.00
@@ -523,7 +611,7 @@ def workflowOffshore(placements, source, hubHeight=None, powerCurve=None, capaci
     return workflowTemplate(placements=placements, source=source, landcover=None, gwa=None, hubHeight=hubHeight, 
                             powerCurve=powerCurve, capacity=capacity, rotordiam=rotordiam, cutout=cutout, 
                             extract=extract, output=output, jobs=jobs, batchSize=batchSize, verbose=verbose, 
-                            **kwgs)
+                            memoryBudget=memoryBudget, extractionCache=extractionCache, shear=shear, **kwgs)
 
 
 def _save_to_nc(output, capacityGeneration, lats, lons, capacity, hubHeight, rotordiam, identity, pckey):
@@ -0,0 +1,132 @@
+#### Setup command line arguments
+import argparse
+
+parser = argparse.ArgumentParser(description='Time the main operations of the weather sources on synthetic MERRA-like and COSMO-like datasets, and write the timings as JSON')
+parser.add_argument('-o', dest='oFile', type=str, default="ncsource-benchmark.json",
+                    help='path to the JSON file to write')
+parser.add_argument('-w', dest='workDir', type=str, default="ncsource-benchmark",
+                    help='directory in which the synthetic datasets are written (and kept for later runs)')
+parser.add_argument('--datasets', type=str, default="merra,cosmo",
+                    help='comma separated datasets to benchmark (merra, cosmo)')
+parser.add_argument('--grids', type=str, default="20x16,40x32,80x64",
+                    help='comma separated grid sizes as <lat>x<lon>')
+parser.add_argument('--years', type=str, default="1",
+                    help='comma separated numbers of years')
+parser.add_argument('--splits', type=str, default="year,month",
+                    help='comma separated file splits (year, month, day)')
+parser.add_argument('--byVariable', type=str, default="1",
+                    help='comma separated choices of writing one file per variable (1) or all variables together (0)')
+parser.add_argument('--locations', type=str, default="10,100,1000",
+                    help='comma separated numbers of locations to extract')
+parser.add_argument('--interpolations', type=str, default="near,bilinear,cubic",
+                    help='comma separated spatial interpolation schemes')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='number of times each operation is timed')
+parser.add_argument('--seed', type=int, default=0,
+                    help='seed of the generated weather and of the random locations')
+
+args = parser.parse_args()
+
+#### Imports
+import json
+import platform
+import subprocess
+from os.path import join, isdir, dirname, abspath
+from datetime import datetime as dt
+from time import perf_counter
+
+import numpy as np
+import netCDF4 as nc
+import geokit as gk
+
+from reskit.weather.sources import MerraSource, CosmoSource
+from reskit.weather.synthetic import makeMerraLike, makeCosmoLike
+
+#### Arrange the scaling axes
+DATASETS = dict(merra=(MerraSource, makeMerraLike, "U50M"),
+                cosmo=(CosmoSource, makeCosmoLike, "windspeed_100"))
+
+def splitList(text, kind=str):
+    return [kind(x) for x in text.split(",") if x.strip()]
+
+def timeIt(func, repeat):
+    """Calls func repeatedly and returns the duration of each call in seconds"""
+    durations = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        durations.append(perf_counter()-start)
+    return durations
+
+def record(results, case, operation, durations, **extra):
+    entry = dict(case, operation=operation, **extra)
+    entry["seconds"] = durations
+    entry["best"] = min(durations)
+    entry["median"] = float(np.median(durations))
+    results.append(entry)
+    print("  %-10s %-28s best %.4fs"%(operation, " ".join("%s=%s"%kv for kv in extra.items()), entry["best"]))
+
+def randomLocations(source, count, rng):
+    """Picks random locations inside the working grid, away from its edges so
+    that every interpolation scheme applies"""
+    latN, lonN = source.lats.shape[0], source.lons.shape[-1]
+    yi = rng.randint(2, latN-3, size=count)
+    xi = rng.randint(2, lonN-3, size=count)
+    fy, fx = rng.random_sample(count), rng.random_sample(count)
+    if source.dependent_coordinates:
+        lats = source.lats[yi, xi] + fy*(source.lats[yi+1, xi]-source.lats[yi, xi])
+        lons = source.lons[yi, xi] + fx*(source.lons[yi, xi+1]-source.lons[yi, xi])
+    else:
+        lats = source.lats[yi] + fy*(source.lats[yi+1]-source.lats[yi])
+        lons = source.lons[xi] + fx*(source.lons[xi+1]-source.lons[xi])
+    return gk.LocationSet(list(zip(lons, lats)))
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=dirname(abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+#### Run
+results = []
+rng = np.random.RandomState(args.seed)
+for dataset in splitList(args.datasets):
+    Source, make, variable = DATASETS[dataset]
+    for grid in splitList(args.grids):
+        latN, lonN = [int(x) for x in grid.split("x")]
+        for years in splitList(args.years, int):
+            for split in splitList(args.splits):
+                for byVariable in splitList(args.byVariable, lambda x: bool(int(x))):
+                    case = dict(dataset=dataset, latN=latN, lonN=lonN, years=years, split=split, byVariable=byVariable)
+                    print(case)
+
+                    # Generate the dataset, unless an earlier run already did
+                    directory = join(args.workDir, "%s-%dx%d-%dy-%s-%s"%(dataset, latN, lonN, years, split, "var" if byVariable else "all"))
+                    if not isdir(directory):
+                        start = perf_counter()
+                        paths = make(directory, latN=latN, lonN=lonN, years=years, split=split, byVariable=byVariable, seed=args.seed)
+                        record(results, case, "generate", [perf_counter()-start], files=len(paths))
+
+                    record(results, case, "__init__", timeIt(lambda: Source(directory, verbose=False), args.repeat))
+
+                    source = Source(directory, verbose=False)
+                    record(results, case, "load", timeIt(lambda: source.load(variable), args.repeat), variable=variable)
+
+                    for count in splitList(args.locations, int):
+                        locations = randomLocations(source, count, rng)
+                        record(results, case, "loc2Index", timeIt(lambda: source.loc2Index(locations, _asSet=True), args.repeat), locations=count)
+
+                        for interpolation in splitList(args.interpolations):
+                            def get():
+                                source.__dict__.pop("_indexCache", None) # Time the location search as well
+                                source.get(variable, locations, interpolation=interpolation, forceDataFrame=True)
+                            record(results, case, "get", timeIt(get, args.repeat), locations=count, interpolation=interpolation)
+
+#### Write the results
+meta = dict(date=dt.now().isoformat(), revision=gitRevision(), python=platform.python_version(),
+            platform=platform.platform(), numpy=np.__version__, netCDF4=nc.__version__,
+            arguments=vars(args))
+with open(args.oFile, "w") as fo:
+    json.dump(dict(meta=meta, results=results), fo, indent=1)
+print("Wrote", args.oFile)